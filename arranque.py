@@ -0,0 +1,160 @@
+"""
+Arranque rápido de la app.
+
+main.py (y nucleo.py) ya no importan google.generativeai ni ReportLab al cargarse:
+el modelo se construye en el lifespan (en un hilo) y ReportLab se importa con el primer PDF.
+Así el proceso acepta conexiones antes y /health/ready indica cuándo puede
+responder preguntas.
+
+Con varios workers, `PRELOAD=true` y `gunicorn --preload` hacen lo contrario a
+propósito: el proceso maestro importa los módulos pesados una vez antes de
+crear los workers, y estos comparten esas páginas de memoria (copy-on-write).
+El modelo se sigue construyendo en cada worker, después del fork.
+
+Ejecutar `python arranque.py` mide, en procesos nuevos, el tiempo de importar
+main.py y el tiempo hasta la primera respuesta (liveness, readiness, primer
+/chat y primer /generate-pdf) con carga perezosa y con precarga.
+"""
+import gc
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.error import HTTPError, URLError
+
+
+def preload_heavy_modules() -> None:
+    """Importa los módulos pesados y congela el heap antes del fork de los workers."""
+    start = time.perf_counter()
+    import google.generativeai  # noqa: F401
+    from generador_pdf import render_pdf
+    # Un PDF mínimo importa ReportLab, construye la hoja de estilos y carga las fuentes
+    render_pdf("Precarga", "Precarga", "Elendur")
+    # Los objetos ya creados salen del recolector de basura: al recorrerlos, este
+    # tocaría sus cabeceras y rompería el copy-on-write de sus páginas
+    gc.collect()
+    gc.freeze()
+    print(f"Módulos precargados en {time.perf_counter() - start:.2f}s.")
+
+
+def _benchmark_env(preload: bool) -> dict:
+    return {
+        **os.environ,
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "clave-de-prueba"),
+        "IA_GENERATIVE_MODEL": os.environ.get("IA_GENERATIVE_MODEL", "gemini-1.5-flash"),
+        "PRELOAD": "true" if preload else "false",
+        "MODEL_WARMUP": "false",  # Sin red: el calentamiento llamaría a la API real
+        "RATE_LIMIT_CLIENT_RPS": "0",
+        "CACHE_SQLITE_PATH": "",
+        "TRACE_LOG_PATH": "",
+        "PDF_WORKERS": "0",
+    }
+
+
+def measure_import_seconds(preload: bool, repeats: int = 3) -> float:
+    """Mediana del tiempo de `import main` en un intérprete nuevo."""
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-c", code], env=_benchmark_env(preload),
+                                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _request(url: str, payload: dict = None, timeout: float = 30) -> int:
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+
+def _wait_until(url: str, deadline: float) -> float:
+    while time.perf_counter() < deadline:
+        try:
+            if _request(url, timeout=1) == 200:
+                return time.perf_counter()
+        except (URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"{url} no respondió a tiempo")
+
+
+def measure_first_requests(preload: bool) -> dict:
+    """Tiempos desde que se lanza el servidor hasta cada primera respuesta (en segundos)."""
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", str(port)],
+                              env=_benchmark_env(preload), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + 60
+        live = _wait_until(f"{base}/health/live", deadline)
+        ready = _wait_until(f"{base}/health/ready", deadline)
+        _request(f"{base}/chat", {"message": "¿Quién es Gandalf?"})
+        first_chat = time.perf_counter()
+        pdf_start = time.perf_counter()
+        _request(f"{base}/generate-pdf", {"question": "¿Quién es Gandalf?", "answer": "Un Maia."})
+        first_pdf_seconds = time.perf_counter() - pdf_start
+        pdf_start = time.perf_counter()
+        _request(f"{base}/generate-pdf", {"question": "¿Quién es Frodo?", "answer": "Un hobbit."})
+        second_pdf_seconds = time.perf_counter() - pdf_start
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return {
+        "live": live - start,
+        "ready": ready - start,
+        "first_chat": first_chat - start,
+        "first_pdf_seconds": first_pdf_seconds,
+        "second_pdf_seconds": second_pdf_seconds,
+    }
+
+
+def _serve(port: int) -> None:
+    """
+    Servidor del benchmark: construye el modelo real (import de google.generativeai
+    incluido, sin llamadas de red) y lo sustituye por el modelo falso para responder.
+    """
+    import uvicorn
+    import main
+    import nucleo
+    from modelo_falso import FakeGenerativeModel
+
+    real_load_model = nucleo.load_model
+
+    def load_model_then_fake():
+        real_load_model()
+        nucleo.model_router = nucleo.build_router(
+            lambda name: FakeGenerativeModel(name, latency="fixed:0.05", classification_latency="fixed:0.01"))
+
+    nucleo.load_model = load_model_then_fake
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "serve":
+        _serve(int(sys.argv[2]))
+        sys.exit(0)
+    for label, preload in (("Carga perezosa", False), ("Precarga (PRELOAD=true)", True)):
+        import_seconds = measure_import_seconds(preload)
+        timings = measure_first_requests(preload)
+        print(f"{label}: import main {import_seconds * 1000:.0f} ms; desde el lanzamiento: "
+              f"liveness {timings['live'] * 1000:.0f} ms, readiness {timings['ready'] * 1000:.0f} ms, "
+              f"primer /chat {timings['first_chat'] * 1000:.0f} ms; "
+              f"primer PDF {timings['first_pdf_seconds'] * 1000:.0f} ms, "
+              f"segundo PDF {timings['second_pdf_seconds'] * 1000:.0f} ms")
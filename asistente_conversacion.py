@@ -1,198 +1,242 @@
-import os
-from dotenv import load_dotenv
-import google.generativeai as genai
-# Corregido: Importar la clase datetime directamente
-from datetime import datetime
-import sys # Para salir del script si hay errores
-
-# Importaciones para enviar correo
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
-from email.utils import formataddr
-
-# --- 1. Cargar variables del archivo .env ---
-load_dotenv()
-
-gemini_api_key = os.getenv("GEMINI_API_KEY")
-ia_generative_model_name = os.getenv("IA_GENERATIVE_MODEL")
-
-# Credenciales de correo
-sender_email = os.getenv("EMAIL_ADDRESS")
-sender_password = os.getenv("EMAIL_PASSWORD")
-smtp_server = os.getenv("SMTP_SERVER")
-smtp_port = int(os.getenv("SMTP_PORT", 587)) # Puerto por defecto 587
-
-
-# Verificar que las claves y credenciales necesarias están presentes
-if not gemini_api_key:
-    print("Error: La clave de API de Gemini (GEMINI_API_KEY) no se encontró en el archivo .env")
-    sys.exit(1)
-if not ia_generative_model_name:
-     print("Error: El nombre del modelo generativo (IA_GENERATIVE_MODEL) no se encontró en el archivo .env. Debes especificar qué modelo usar (ej. gemini-pro).")
-     sys.exit(1)
-# Verificar credenciales de correo para la funcionalidad de envío
-if not all([sender_email, sender_password, smtp_server]):
-    print("Advertencia: Las credenciales de correo (EMAIL_ADDRESS, EMAIL_PASSWORD, SMTP_SERVER) no se encontraron en el archivo .env.")
-    print("La funcionalidad de envío de correo NO estará disponible.")
-    email_sending_available = False
-else:
-     email_sending_available = True
-     print("Funcionalidad de envío de correo disponible.")
-
-
-# --- 3. Definir la personalidad o instrucciones del sistema (TU PROMPT DE COMPORTAMIENTO) ---
-persona_prompt = """
-Eres un asistente de IA llamado Elendur.
-Tu rol es el de un **académico y especialista riguroso** en la obra completa de J.R.R. Tolkien y toda la mitología de Arda (incluyendo libros, manuscritos, lenguajes y estudios relevantes).
-Tu objetivo es **proporcionar información precisa y concreta** sobre estos temas, basada estrictamente en el **canon primario y secundario** de Tolkien.
-El tono de tus respuestas debe ser **formal, objetivo y académico**. Evita cualquier expresión de familiaridad, entusiasmo o uso de emojis.
-Responde a las preguntas **directamente y con concisión**, enfocándote en los hechos y detalles relevantes.
-Si la información solicitada es especulativa, no confirmada en las obras de Tolkien, o si no tienes datos disponibles, **indícalo de manera clara y formal**, mencionando la limitación o la fuente (o falta de ella).
-Siempre busca ofrecer la información más **relevante y verificable** dentro del ámbito académico de los estudios de Tolkien.
-Mantén siempre tu identidad como Elendur, el especialista académico en Tolkien.
 """
-# Nota: Eliminamos la instrucción explícita de preguntar por el correo, lo hará el script.
+Asistente de línea de comandos, sobre el mismo núcleo que la API web (nucleo.py).
 
+Modo conversación (por defecto): la respuesta se muestra en streaming según la
+genera el modelo y el correo se envía en segundo plano por la cola de correo,
+así que se puede seguir escribiendo mientras se entrega; el resultado del envío
+se avisa cuando termina. Comparte con la web la caché de respuestas, el
+glosario, la clasificación, el control de admisión y el enrutado de modelos.
 
-# --- 2. Configurar la API de Gemini e inicializar el MODELO CON la personalidad ---
-try:
-    genai.configure(api_key=gemini_api_key)
-    # Pasa la personalidad (persona_prompt) al inicializar el modelo
-    model = genai.GenerativeModel(ia_generative_model_name, system_instruction=persona_prompt)
-    print(f"Modelo '{ia_generative_model_name}' configurado correctamente.")
-except Exception as e:
-    print(f"Error al configurar la API de Gemini o cargar el modelo '{ia_generative_model_name}': {e}")
-    print("Verifica tu clave de API de Gemini o la disponibilidad del modelo especificado en .env para chat.")
-    sys.exit(1)
+Modo carga: lanza las preguntas de un fichero (una por línea) con varias
+conversaciones simultáneas contra el núcleo en este mismo proceso, sin HTTP, y
+muestra la latencia (primer fragmento y total) y de dónde salió cada respuesta.
 
+Uso:
+    python asistente_conversacion.py
+    python asistente_conversacion.py --carga preguntas.txt [--concurrencia 8] [--repeticiones 1]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from contextlib import aclosing
+
+import nucleo
+from nucleo import (
+    ASSISTANT_NAME, EMAIL_SENDING_AVAILABLE, SESSION_TOKEN_BUDGET, SESSION_MAX_TURNS,
+    ModelUnavailable, mail_queue,
+)
+from cola_correo import MailQueueFull, JOB_SENT, JOB_FAILED
+from sesiones import append_turn
+
+EXIT_COMMANDS = ["salir", "adios", "quit", "exit"]
+YES_ANSWERS = ["sí", "si", "ok", "yes"]
+MAIL_POLL_SECONDS = 0.5
+
+
+async def answer_question(question: str, history: list, on_chunk=None) -> tuple:
+    """
+    Responde una pregunta con la tubería común del núcleo (nucleo.answer_events).
+    `on_chunk(texto)` recibe cada fragmento. Retorna (respuesta, es de Tolkien,
+    origen, segundos hasta el primer fragmento).
+    """
+    start = time.perf_counter()
+    answer_source = None
+    is_query_tolkien_related = False
+    parts = []
+    first_chunk_seconds = None
+    async with aclosing(nucleo.answer_events(question, history)) as events:
+        async for kind, value in events:
+            if kind == "start":
+                answer_source = value
+            elif kind == "chunk":
+                if first_chunk_seconds is None:
+                    first_chunk_seconds = time.perf_counter() - start
+                parts.append(value)
+                if on_chunk is not None:
+                    on_chunk(value)
+            else:
+                is_query_tolkien_related = value
+    return "".join(parts), is_query_tolkien_related, answer_source, first_chunk_seconds
 
-# --- Función para enviar el correo electrónico ---
-def send_email(to_email, subject, body):
-    print(f"\nIntentando enviar correo a {to_email} con asunto: '{subject}'...")
 
-    try:
-        msg = MIMEText(body, 'plain', 'utf-8')
-        msg['Subject'] = Header(subject, 'utf-8')
-        msg['From'] = formataddr(("Elendur, tu Asistente Tolkien", sender_email)) # Nombre opcional y correo
-        msg['To'] = to_email
+# --- Modo conversación ---
 
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls() # Iniciar encriptación TLS (para puerto 587)
-            server.login(sender_email, sender_password) # Iniciar sesión
-            server.sendmail(sender_email, to_email, msg.as_string()) # Enviar correo
+async def read_line(prompt: str) -> str:
+    """input() en un hilo: el event loop sigue atendiendo el streaming y los correos."""
+    return await asyncio.to_thread(input, prompt)
 
-        print("Correo enviado con éxito.")
-        return True
 
-    except Exception as e:
-        print(f"Error al enviar el correo: {e}")
-        print("Verifica la configuración SMTP, credenciales y dirección del destinatario.")
-        print("Si usas Gmail, asegúrate de usar una contraseña de aplicación (altamente recomendado) y permitir acceso a aplicaciones menos seguras si aplica a tu configuración.")
-        return False
+def _print_chunk(text: str) -> None:
+    print(text, end="", flush=True)
 
 
-# --- 4. Iniciar una sesión de chat ---
-try:
-    chat = model.start_chat(history=[]) # Empezamos una nueva conversación sin historial previo
+async def report_mail_job(job_id: str, recipient: str) -> None:
+    """Avisa, sin bloquear la conversación, de cómo terminó un envío encolado."""
+    while True:
+        job = mail_queue.get_job(job_id)
+        if job is None or job["status"] in (JOB_SENT, JOB_FAILED):
+            break
+        await asyncio.sleep(MAIL_POLL_SECONDS)
+    if job is not None and job["status"] == JOB_SENT:
+        print(f"\n[{ASSISTANT_NAME}: La información ha sido enviada a {recipient}.]")
+    else:
+        error = job["error"] if job is not None else "envío desconocido"
+        print(f"\n[{ASSISTANT_NAME}: No se pudo enviar el correo a {recipient}: {error}]")
 
-    # Intenta sacar el nombre de la personalidad para el saludo
+
+def send_email_in_background(recipient: str, body: str, mail_tasks: set) -> None:
+    subject = f"Información de Tolkien de {ASSISTANT_NAME}"
     try:
-        # Busca la línea que contiene "llamado " y extrae lo que sigue
-        name_line = next((line for line in persona_prompt.splitlines() if "llamado " in line), "")
-        # Asegúrate de que la extracción del nombre es robusta si cambias el prompt
-        if "llamado " in name_line:
-             nombre_asistente = name_line.split('llamado ')[-1].split('.')[0].strip() # Extrae hasta el punto si existe
-        else:
-             nombre_asistente = "Elendur (Asistente Académico)" # Nombre por defecto o si el prompt no lo dice claro
-
-    except Exception as e:
-         print(f"Error al extraer nombre del prompt: {e}") # Debugging si falla la extracción
-         nombre_asistente = "Elendur (Asistente Académico)" # Nombre genérico si falla
-
-
-    print(f"\nSaludos. Soy {nombre_asistente}, su asistente académico especializado en la obra de J.R.R. Tolkien. Estoy a su disposición para consultas rigurosas.") # Saludo adaptado al tono formal
-    if email_sending_available:
-        print("Si desea recibir por correo la información que le proporcione, por favor, indíquelo tras recibir mi respuesta (ej. 'enviar por correo').")
+        job_id = mail_queue.enqueue(recipient, subject, body)
+    except MailQueueFull:
+        print(f"{ASSISTANT_NAME}: Hay demasiados correos pendientes de envío. Inténtelo de nuevo en unos segundos.")
+        return
+    print(f"{ASSISTANT_NAME}: El envío a {recipient} se ha puesto en cola; puede seguir escribiendo.")
+    task = asyncio.create_task(report_mail_job(job_id, recipient))
+    mail_tasks.add(task)
+    task.add_done_callback(mail_tasks.discard)
+
+
+async def offer_email(answer: str, mail_tasks: set) -> None:
+    follow_up = await read_line(f"{ASSISTANT_NAME}: ¿Desea que le envíe esta información por correo? (sí/no) ")
+    if follow_up.lower().strip() not in YES_ANSWERS:
+        return
+    recipient = (await read_line("Dirección de correo: ")).strip()
+    if not recipient or "@" not in recipient or "." not in recipient: # Validación básica
+        print(f"{ASSISTANT_NAME}: '{recipient}' no parece una dirección de correo válida. No podré enviarlo.")
+        return
+    send_email_in_background(recipient, answer, mail_tasks)
+
+
+async def conversation() -> None:
+    print(f"\nSaludos. Soy {ASSISTANT_NAME}, su asistente académico especializado en la obra de J.R.R. Tolkien. "
+          "Estoy a su disposición para consultas rigurosas.")
+    if EMAIL_SENDING_AVAILABLE:
+        print("Tras cada respuesta sobre Tolkien podrá pedir que se la envíe por correo.")
     else:
-         print("Nota: La funcionalidad de envío de correo no se encuentra disponible debido a la falta de configuración.")
-
+        print("Nota: La funcionalidad de envío de correo no se encuentra disponible debido a la falta de configuración.")
     print("Para finalizar la sesión, escriba 'salir' o 'adios'.")
     print("-" * 30)
 
-except Exception as e:
-     print(f"Error al iniciar la sesión de chat después de configurar el modelo: {e}")
-     sys.exit(1)
-
-# --- 5. Bucle de conversación ---
-last_ai_response_text = "" # Variable para guardar la última respuesta de la IA
-
-while True:
-    # --- Get primary user input ---
-    user_input = input("Tú: ")
-
-    # --- Detectar comandos de salida ---
-    if user_input.lower() in ["salir", "adios", "quit", "exit"]:
-        print(f"{nombre_asistente}: ¡Adiós! Que los caminos te sean leves. 😊")
-        break
+    history = []
+    mail_tasks = set()
+    while True:
+        try:
+            user_input = (await read_line("Tú: ")).strip()
+        except EOFError:
+            break
+        if not user_input:
+            continue
+        if user_input.lower() in EXIT_COMMANDS:
+            print(f"{ASSISTANT_NAME}: Adiós. Que los caminos le sean leves.")
+            break
+
+        print(f"{ASSISTANT_NAME}: ", end="", flush=True)
+        try:
+            answer, is_query_tolkien_related, _source, _ttfb = await answer_question(user_input, history, _print_chunk)
+        except ModelUnavailable as e:
+            print(f"\n{e}")
+            continue
+        except asyncio.TimeoutError:
+            print(f"\nEl modelo no respondió en {nucleo.CHAT_TIMEOUT_SECONDS} segundos. Por favor, intente de nuevo.")
+            continue
+        except Exception as e:
+            print(f"\nOcurrió un error al comunicarse con Gemini: {e}")
+            print("Por favor, intente de nuevo.")
+            continue
+        print()
+        if not answer:
+            print(f"{ASSISTANT_NAME}: (No pude generar una respuesta en este momento. ¿Podría formularlo de otra forma?)")
+            continue
+        history = append_turn(history, user_input, answer, SESSION_TOKEN_BUDGET, SESSION_MAX_TURNS)
+
+        if mail_queue is not None and is_query_tolkien_related:
+            await offer_email(answer, mail_tasks)
+
+    if mail_tasks:
+        print(f"Esperando a {len(mail_tasks)} envío(s) de correo pendiente(s)...")
+        await asyncio.gather(*mail_tasks, return_exceptions=True)
+    print("-" * 30)
+    print("Conversación terminada.")
+
+
+# --- Modo carga ---
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] * 1000 if values else 0.0
+
+
+async def run_load(questions: list, concurrency: int) -> dict:
+    """Responde `questions` con `concurrency` conversaciones simultáneas (sin historial)."""
+    queue = asyncio.Queue()
+    for question in questions:
+        queue.put_nowait(question)
+    totals, first_chunks, sources = [], [], {}
+
+    async def worker():
+        while not queue.empty():
+            question = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                _answer, _verdict, source, first_chunk_seconds = await answer_question(question, [])
+            except Exception as e:
+                source = f"error: {type(e).__name__}"
+                first_chunk_seconds = None
+            totals.append(time.perf_counter() - start)
+            if first_chunk_seconds is not None:
+                first_chunks.append(first_chunk_seconds)
+            sources[source] = sources.get(source, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "questions": len(questions),
+        "seconds": elapsed,
+        "throughput": len(questions) / elapsed if elapsed else 0.0,
+        "total_p50_ms": _percentile(totals, 0.50),
+        "total_p95_ms": _percentile(totals, 0.95),
+        "first_chunk_p50_ms": _percentile(first_chunks, 0.50),
+        "first_chunk_p95_ms": _percentile(first_chunks, 0.95),
+        "sources": sources,
+    }
+
+
+def read_questions(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+async def main(argv: list) -> int:
+    parser = argparse.ArgumentParser(description=f"Conversa con {ASSISTANT_NAME} o genera carga contra el núcleo.")
+    parser.add_argument("--carga", metavar="FICHERO", help="Preguntas (una por línea) para el modo carga")
+    parser.add_argument("--concurrencia", type=int, default=8, help="Conversaciones simultáneas en el modo carga")
+    parser.add_argument("--repeticiones", type=int, default=1, help="Veces que se lanza cada pregunta en el modo carga")
+    args = parser.parse_args(argv)
 
-    # --- Si no es un comando de salida, enviar mensaje a Gemini ---
     try:
-        # Enviamos la entrada del usuario al modelo de chat
-        response = chat.send_message(user_input)
-
-        # Procesar la respuesta del modelo
-        if response.text:
-             ai_response_text = response.text
-             print(f"{nombre_asistente}: {ai_response_text}")
-             # Guardar la respuesta válida por si el usuario pide enviarla por correo
-             last_ai_response_text = ai_response_text
-        else:
-             # Manejar casos donde la respuesta no es texto (ej. seguridad bloqueada)
-             print(f"{nombre_asistente}: (No pude generar una respuesta en este momento. ¿Podrías intentar de otra forma? 😊)")
-             last_ai_response_text = "" # Limpiar la respuesta guardada si no fue texto
-
-
-    except Exception as e:
-        print(f"Ocurrió un error al comunicarse con Gemini: {e}")
-        print("Por favor, intenta de nuevo.")
-        last_ai_response_text = "" # Limpiar la respuesta guardada en caso de error de API
-        # break # Opcional: rompe el bucle si hay un error persistente
-
-    # --- DESPUÉS de obtener y imprimir la respuesta de la IA, preguntar sobre el correo ---
-    # Solo preguntar si el envío de correo está configurado Y si hubo una respuesta válida de la IA para enviar
-    if email_sending_available and last_ai_response_text:
-        # Preguntamos directamente desde el script
-        email_follow_up_input = input(f"{nombre_asistente}: ¿Te gustaría que te envíe esta información por correo? (sí/no) 😊 ")
-
-        # --- Verificar la respuesta del seguimiento para detectar afirmación ---
-        if email_follow_up_input.lower().strip() in ["sí", "si", "ok", "yes"]:
-            print(f"{nombre_asistente}: ¡Claro! ¿A qué dirección de correo electrónico debo enviarte la información? 😊")
-            recipient_input = input("Dirección de correo: ")
-
-            if not recipient_input or "@" not in recipient_input or "." not in recipient_input: # Validación básica
-                print(f"{nombre_asistente}: Hmm, parece que '{recipient_input}' no es una dirección de correo válida. No podré enviarlo. 😟")
-                # No email sent, loop continues
-            else:
-                # Preparar asunto del correo
-                subject = f"Información de Tolkien de {nombre_asistente}"
-                print("Preparando para enviar correo...")
-                # Llamar a la función de envío de correo con la última respuesta guardada
-                success = send_email(recipient_input, subject, last_ai_response_text)
-
-                if success:
-                    print(f"{nombre_asistente}: ¡Listo! He enviado la información a {recipient_input}. 😊")
-                    # Limpiar la última respuesta guardada después de enviarla
-                    last_ai_response_text = ""
-                else:
-                    print(f"{nombre_asistente}: Lo siento, hubo un problema al enviar el correo. Verifica las credenciales o intenta de nuevo. 😟")
-                    # Limpiar la última respuesta guardada si falla el envío
-                    last_ai_response_text = ""
-
-        # Si la respuesta al seguimiento NO fue una afirmación, o si el envío de correo no estaba disponible,
-        # o no había respuesta que enviar, el bucle simplemente continúa a la siguiente iteración,
-        # pidiendo la próxima entrada principal del usuario.
-
-
-print("-" * 30)
-print("Conversación terminada.")
+        await nucleo.start()
+    except nucleo.ConfigurationError:
+        return 1
+    try:
+        if args.carga is None:
+            await conversation()
+            return 0
+        questions = read_questions(args.carga) * args.repeticiones
+        result = await run_load(questions, args.concurrencia)
+        print(f"{result['questions']} preguntas en {result['seconds']:.2f}s ({result['throughput']:.1f}/s)")
+        print(f"Total: p50 {result['total_p50_ms']:.0f} ms, p95 {result['total_p95_ms']:.0f} ms")
+        print(f"Primer fragmento: p50 {result['first_chunk_p50_ms']:.0f} ms, p95 {result['first_chunk_p95_ms']:.0f} ms")
+        print("Origen de las respuestas: " + ", ".join(f"{source}={count}" for source, count in sorted(result["sources"].items())))
+        return 1 if any(source.startswith("error") for source in result["sources"]) else 0
+    finally:
+        await nucleo.stop()
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(asyncio.run(main(sys.argv[1:])))
+    except KeyboardInterrupt:
+        print("\nConversación terminada.")
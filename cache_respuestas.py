@@ -0,0 +1,215 @@
+"""
+Caché de respuestas para /chat.
+
+Dos niveles:
+- Memoria: LRU con TTL dentro de cada proceso.
+- SQLite (opcional): compartido entre varios workers de uvicorn. Una tarea de
+  fondo elimina las entradas caducadas y, si se supera `max_rows`, las más antiguas.
+
+La clave se calcula a partir del texto normalizado de la pregunta (mayúsculas,
+acentos, puntuación y espacios), el nombre del modelo y un hash del prompt de
+personalidad, de modo que cambiar cualquiera de los dos invalida las entradas.
+Solo se guarda el hash de la pregunta, nunca el texto original.
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Optional
+
+from clasificador_local import normalize_text
+
+
+def make_cache_key(question: str, model_name: str, persona_prompt: str) -> str:
+    """Clave de caché: hash de (pregunta normalizada, modelo, hash del prompt)."""
+    persona_hash = hashlib.sha256(persona_prompt.encode("utf-8")).hexdigest()
+    raw = "\x1f".join((normalize_text(question), model_name, persona_hash))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """LRU en memoria con caducidad por entrada."""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # clave -> (expira_en, valor)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def set(self, key: str, value: dict, expires_at: Optional[float] = None) -> None:
+        if expires_at is None:
+            expires_at = time.time() + self.ttl_seconds
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def purge(self) -> int:
+        count = len(self._entries)
+        self._entries.clear()
+        return count
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "size": len(self._entries), "max_entries": self.max_entries}
+
+
+class SQLiteCache:
+    """
+    Caché persistente en SQLite, compartida entre procesos. Cada hilo usa su propia
+    conexión, abierta la primera vez que la necesita y reutilizada después.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 3600, max_rows: int = 100000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0}
+        # Conexión temporal: los workers creados con fork no deben heredar una abierta
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer_cache ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS answer_cache_expires_at ON answer_cache (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+        return conn
+
+    def get(self, key: str) -> Optional[tuple]:
+        """Retorna (expira_en, valor) o None."""
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM answer_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            value, expires_at = row
+            if expires_at < time.time():
+                conn.execute("DELETE FROM answer_cache WHERE key = ?", (key,))
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+        self.stats["hits"] += 1
+        return expires_at, json.loads(value)
+
+    def set(self, key: str, value: dict) -> float:
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO answer_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+        return expires_at
+
+    def purge(self) -> int:
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM answer_cache").rowcount
+
+    def purge_expired(self) -> int:
+        """Elimina las entradas caducadas y, por encima de `max_rows`, las más antiguas."""
+        with self._lock, self._connect() as conn:
+            expired = conn.execute("DELETE FROM answer_cache WHERE expires_at < ?", (time.time(),)).rowcount
+            excess = conn.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0] - self.max_rows
+            evicted = 0
+            if excess > 0:
+                # Con un TTL fijo, la que antes caduca es la más antigua
+                evicted = conn.execute(
+                    "DELETE FROM answer_cache WHERE key IN"
+                    " (SELECT key FROM answer_cache ORDER BY expires_at LIMIT ?)", (excess,)
+                ).rowcount
+        self.stats["expirations"] += expired
+        self.stats["evictions"] += evicted
+        return expired + evicted
+
+    def get_stats(self) -> dict:
+        with self._lock, self._connect() as conn:
+            size = conn.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0]
+        return {**self.stats, "size": size, "max_rows": self.max_rows, "path": self.path}
+
+
+class AnswerCache:
+    """
+    Caché por niveles usada por la ruta /chat: primero memoria, después SQLite.
+    Las operaciones sobre SQLite se ejecutan en un hilo para no bloquear el event loop.
+    """
+
+    def __init__(self, memory: MemoryCache, shared: Optional[SQLiteCache] = None):
+        self.memory = memory
+        self.shared = shared
+
+    async def get(self, key: str) -> Optional[dict]:
+        value = self.memory.get(key)
+        if value is not None or self.shared is None:
+            return value
+        entry = await asyncio.to_thread(self.shared.get, key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        # Promocionar al nivel de memoria conservando la caducidad original
+        self.memory.set(key, value, expires_at=expires_at)
+        return value
+
+    async def set(self, key: str, value: dict) -> None:
+        if self.shared is not None:
+            expires_at = await asyncio.to_thread(self.shared.set, key, value)
+            self.memory.set(key, value, expires_at=expires_at)
+        else:
+            self.memory.set(key, value)
+
+    async def purge(self) -> dict:
+        purged = {"memory": self.memory.purge()}
+        if self.shared is not None:
+            purged["sqlite"] = await asyncio.to_thread(self.shared.purge)
+        return purged
+
+    async def purge_expired(self) -> int:
+        if self.shared is None:
+            return 0
+        return await asyncio.to_thread(self.shared.purge_expired)
+
+    async def get_stats(self) -> dict:
+        stats = {"memory": self.memory.get_stats()}
+        if self.shared is not None:
+            stats["sqlite"] = await asyncio.to_thread(self.shared.get_stats)
+        return stats
+
+
+async def purge_expired_periodically(cache: AnswerCache, interval_seconds: float) -> None:
+    """Tarea de fondo que limpia la caché SQLite cada `interval_seconds`."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            purged = await cache.purge_expired()
+            if purged:
+                print(f"Entradas eliminadas de la caché SQLite: {purged}")
+        except Exception as e:
+            print(f"Error al limpiar la caché SQLite: {e}")
@@ -0,0 +1,350 @@
+"""
+Caché semántica de respuestas para /chat.
+
+Complementa a la caché exacta (cache_respuestas.py): las preguntas se convierten
+en vectores con un embedding local, solo CPU (palabras, pares de palabras
+consecutivas y n-gramas de caracteres, con hashing), y se busca la respuesta de
+la pregunta más parecida con una similitud coseno vectorizada en NumPy. Si la
+similitud supera el umbral se devuelve la respuesta guardada.
+
+El embedding da más peso a lo que cambia la respuesta que a las fórmulas
+compartidas: las entidades (términos del gazetteer de Arda y nombres propios,
+así "¿en qué año murió Boromir?" no es "...Faramir?"), el interrogativo
+("¿dónde nació...?" frente a "¿cuándo nació...?"), el idioma ("who" frente a
+"quién"), la negación ("¿quién no es Gandalf?") y el orden de las palabras
+("¿quién mató a Smaug?" frente a "¿a quién mató Smaug?"). Las peticiones "sobre
+X" ("¿quién era Gandalf?", "háblame de Gandalf el Gris") comparten un mismo
+rasgo de intención.
+
+La búsqueda y la inserción cuestan milisegundos con índices grandes: se llaman
+desde un hilo (asyncio.to_thread) y un lock protege el índice.
+
+Los vectores viven en un array de capacidad fija (memoria acotada, desalojo LRU)
+y se pueden guardar en un fichero .npy que los workers cargan con mmap
+(copy-on-write) para arrancar en caliente.
+
+Ejecutar `python cache_semantica.py [tamaños...]` lanza el benchmark de latencia
+de búsqueda (por defecto con 10k, 100k y 1M entradas).
+"""
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from typing import Optional
+
+import numpy as np
+
+from clasificador_local import normalize_text, TOLKIEN_TERMS, TOLKIEN_PHRASES, WEAK_TERMS
+
+# Versión del embedding: un índice guardado con otra versión se descarta al cargarlo
+EMBEDDING_VERSION = 3
+
+# Palabras vacías del embedding. A diferencia de clasificador_local.STOPWORDS, no
+# incluye los interrogativos: "dónde" y "cuándo" piden respuestas distintas.
+EMBED_STOPWORDS = frozenset({
+    # Español
+    "al", "de", "del", "el", "la", "las", "lo", "los", "un", "una", "unos", "unas",
+    "y", "o", "en", "con", "por", "para", "su", "sus", "se", "me", "te", "mi", "sobre",
+    "es", "son", "era", "eran", "fue", "fueron", "ser", "esta", "estaba", "ha", "habia",
+    "exactamente", "hablame", "cuentame", "dime", "explicame", "explica", "describeme",
+    "puedes", "podrias", "sabes", "quiero", "saber", "informacion", "favor",
+    # Inglés
+    "the", "of", "an", "and", "is", "are", "was", "were", "to", "in", "on", "do",
+    "does", "did", "tell", "me", "describe", "explain", "please", "can", "you", "could",
+    "about",
+})
+
+# Interrogativos: un rasgo propio con el peso de una entidad
+INTERROGATIVES = frozenset({
+    "quien", "quienes", "donde", "cuando", "cual", "cuales", "que", "como", "cuanto",
+    "cuantos", "cuantas", "porque", "who", "whom", "whose", "where", "when", "which",
+    "what", "why", "how",
+})
+
+# Preguntas "sobre X": "¿quién es/era X?", "¿qué son X?" y "háblame de X" piden lo
+# mismo y comparten un único rasgo de intención en lugar de su interrogativo
+_ABOUT_INTERROGATIVES = frozenset({"quien", "quienes", "que", "who", "what"})
+_COPULAS = frozenset({"es", "era", "fue", "son", "eran", "fueron", "is", "was", "are", "were"})
+_ABOUT_REQUESTS = frozenset({"hablame", "cuentame", "explicame", "describeme", "describe", "tell"})
+
+# Negaciones: "¿quién es Gandalf?" y "¿quién no es Gandalf?" tienen respuestas opuestas
+NEGATIONS = frozenset({
+    "no", "nunca", "jamas", "tampoco", "ni", "not", "never", "nor",
+    "dont", "doesnt", "didnt", "isnt", "wasnt", "arent", "werent",
+})
+
+# Idioma de la pregunta (la respuesta se da en ese idioma)
+_ENGLISH_WORDS = frozenset({
+    "who", "whom", "whose", "what", "where", "when", "why", "how", "which", "is", "was",
+    "are", "were", "the", "of", "did", "does", "do", "tell", "about", "please",
+})
+_SPANISH_WORDS = frozenset({"que", "quien", "el", "la", "los", "las", "de", "es", "en", "y"})
+
+# Entidades: términos del gazetteer de Arda que no son palabras corrientes
+_ENTITIES = TOLKIEN_TERMS - WEAK_TERMS
+# Artículos de un epíteto tras una entidad ("Gandalf el Gris"): el epíteto pesa poco
+_EPITHET_ARTICLES = frozenset({"el", "la"})
+# "a" marca el complemento de persona ("mató a Smaug"): se asocia a la palabra siguiente
+_OBJECT_MARKER = "a"
+_OPENING_PUNCTUATION = "¿¡\"'(«"
+
+# Peso de los rasgos. Las entidades (personajes, lugares, nombres propios), el
+# interrogativo, el idioma y la negación pesan más que el resto de palabras,
+# para que "¿en qué año murió Boromir?" no reutilice la respuesta sobre Faramir.
+_WORD_WEIGHT = 1.0
+_ENTITY_WEIGHT = 3.0
+_EPITHET_WEIGHT = 0.5
+_INTERROGATIVE_WEIGHT = 3.0
+_LANGUAGE_WEIGHT = 3.0
+_NEGATION_WEIGHT = 10.0
+_OBJECT_WEIGHT = 4.0
+_BIGRAM_WEIGHT = 1.0
+_CHAR_NGRAM_WEIGHT = 0.2
+_CHAR_NGRAM_SIZES = (3, 4)
+
+
+def _feature_index(feature: str, dim: int) -> tuple:
+    """Índice y signo del rasgo (crc32 es estable entre procesos, a diferencia de hash())."""
+    h = zlib.crc32(feature.encode("utf-8"))
+    return h % dim, 1.0 if (h >> 31) & 1 else -1.0
+
+
+def _tokenize(text: str) -> tuple:
+    """Tokens normalizados y posiciones de los nombres propios (con mayúscula, salvo la primera palabra)."""
+    tokens = []
+    proper = set()
+    for position, word in enumerate(text.split()):
+        capitalized = word.lstrip(_OPENING_PUNCTUATION)[:1].isupper()
+        for token in normalize_text(word).split():
+            if capitalized and position > 0:
+                proper.add(len(tokens))
+            tokens.append(token)
+    return tokens, proper
+
+
+def _stem(token: str) -> str:
+    """Singular aproximado ("silmarils", "anillos"), para que el plural no cuente como otra palabra."""
+    return token[:-1] if len(token) > 4 and token.endswith("s") else token
+
+
+def embed(text: str, dim: int) -> np.ndarray:
+    """Embedding local: TF sublineal de rasgos con hashing, normalizado L2."""
+    indices = []
+    weights = []
+
+    def add(feature: str, weight: float) -> None:
+        index, sign = _feature_index(feature, dim)
+        indices.append(index)
+        weights.append(sign * weight)
+
+    tokens, proper = _tokenize(text)
+    if not tokens:
+        return np.zeros(dim, dtype=np.float32)
+    normalized = " ".join(tokens)
+
+    english = any(t in _ENGLISH_WORDS for t in tokens) and not any(t in _SPANISH_WORDS for t in tokens)
+    add("lang:en" if english else "lang:es", _LANGUAGE_WEIGHT)
+
+    about = tokens[0] in _ABOUT_REQUESTS or (
+        len(tokens) > 1 and tokens[0] in _ABOUT_INTERROGATIVES and tokens[1] in _COPULAS)
+    if about:
+        add("q:about", _INTERROGATIVE_WEIGHT)
+
+    epithets = {
+        i + 2 for i in range(len(tokens) - 2)
+        if tokens[i] in _ENTITIES and tokens[i + 1] in _EPITHET_ARTICLES
+    }
+    kept = [(i, _stem(token)) for i, token in enumerate(tokens)
+            if token not in EMBED_STOPWORDS and not (about and i == 0)]
+    for position, (i, token) in enumerate(kept):
+        if token == _OBJECT_MARKER:
+            if position + 1 < len(kept):
+                add("a:" + kept[position + 1][1], _OBJECT_WEIGHT)
+            continue
+        if token in INTERROGATIVES:
+            add("q:" + token, _INTERROGATIVE_WEIGHT)
+            continue
+        if token in NEGATIONS:
+            add("n:", _NEGATION_WEIGHT)
+            continue
+        if i in epithets:
+            add("w:" + token, _EPITHET_WEIGHT)
+            continue
+        entity = tokens[i] in _ENTITIES or (i in proper and tokens[i] not in WEAK_TERMS)
+        add("w:" + token, _ENTITY_WEIGHT if entity else _WORD_WEIGHT)
+        padded = f" {token} "
+        for n in _CHAR_NGRAM_SIZES:
+            for k in range(len(padded) - n + 1):
+                add(padded[k:k + n], _CHAR_NGRAM_WEIGHT)
+    for phrase in TOLKIEN_PHRASES:
+        if phrase in normalized:
+            add("p:" + phrase, _ENTITY_WEIGHT)
+    for (_, first), (_, second) in zip(kept, kept[1:]):
+        add(f"b:{first} {second}", _BIGRAM_WEIGHT)
+
+    vector = np.zeros(dim, dtype=np.float32)
+    np.add.at(vector, np.asarray(indices), np.asarray(weights, dtype=np.float32))
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class SemanticCache:
+    """
+    Índice vectorial en memoria con capacidad fija.
+    `namespace` identifica el modelo y el prompt: un fichero guardado con otro
+    namespace se descarta al cargarlo.
+    """
+
+    def __init__(self, capacity: int = 10000, dim: int = 512, threshold: float = 0.8,
+                 namespace: str = ""):
+        self.capacity = capacity
+        self.dim = dim
+        self.threshold = threshold
+        self.namespace = namespace
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.answers = [None] * capacity
+        self.count = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    def lookup(self, question: str) -> Optional[dict]:
+        """Devuelve la respuesta de la entrada más parecida si supera el umbral."""
+        query = embed(question, self.dim)
+        with self._lock:
+            if self.count == 0:
+                self.stats["misses"] += 1
+                return None
+            similarities = self.vectors[:self.count] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            self.last_used[best] = time.time()
+            self.stats["hits"] += 1
+            return self.answers[best]
+
+    def add(self, question: str, value: dict) -> None:
+        vector = embed(question, self.dim)
+        if not vector.any():
+            return  # Preguntas sin contenido (solo palabras vacías) no se indexan
+        with self._lock:
+            if self.count < self.capacity:
+                slot = self.count
+                self.count += 1
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.stats["evictions"] += 1
+            self.vectors[slot] = vector
+            self.last_used[slot] = time.time()
+            self.answers[slot] = value
+
+    def purge(self) -> int:
+        with self._lock:
+            purged = self.count
+            self.vectors[:] = 0
+            self.last_used[:] = 0
+            self.answers = [None] * self.capacity
+            self.count = 0
+        return purged
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "size": self.count,
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "memory_bytes": int(self.vectors.nbytes + self.last_used.nbytes),
+        }
+
+    def save(self, path: str) -> None:
+        """Guarda vectores (.npy) y respuestas (.json) de forma atómica."""
+        tmp_vectors = path + ".npy.tmp"
+        tmp_meta = path + ".json.tmp"
+        with self._lock:
+            with open(tmp_vectors, "wb") as f:
+                np.save(f, self.vectors)
+            with open(tmp_meta, "w", encoding="utf-8") as f:
+                json.dump({
+                    "namespace": self.namespace,
+                    "embedding": EMBEDDING_VERSION,
+                    "dim": self.dim,
+                    "count": self.count,
+                    "answers": self.answers[:self.count],
+                    "last_used": self.last_used[:self.count].tolist(),
+                }, f, ensure_ascii=False)
+        os.replace(tmp_vectors, path + ".npy")
+        os.replace(tmp_meta, path + ".json")
+
+    def load(self, path: str) -> bool:
+        """
+        Carga un índice guardado. Los vectores se mapean con mmap en modo
+        copy-on-write, así que los workers comparten las páginas hasta que escriben.
+        """
+        try:
+            with open(path + ".json", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["namespace"] != self.namespace or meta["dim"] != self.dim:
+                print("Caché semántica: el fichero guardado corresponde a otro modelo o prompt; se ignora.")
+                return False
+            if meta.get("embedding") != EMBEDDING_VERSION:
+                print("Caché semántica: el fichero guardado usa otra versión del embedding; se ignora.")
+                return False
+            vectors = np.load(path + ".npy", mmap_mode="c")
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Error al cargar la caché semántica de '{path}': {e}")
+            return False
+
+        if vectors.shape[0] != self.capacity:
+            # Capacidad distinta: se copian solo las entradas que caben
+            count = min(meta["count"], self.capacity)
+            self.vectors[:count] = vectors[:count]
+        else:
+            count = meta["count"]
+            self.vectors = vectors
+        self.count = count
+        self.answers = meta["answers"][:count] + [None] * (self.capacity - count)
+        self.last_used[:count] = meta["last_used"][:count]
+        return True
+
+
+def run_benchmark(sizes=(10_000, 100_000, 1_000_000), dim: int = 256, queries: int = 50) -> list:
+    """Latencia de búsqueda con índices llenos de vectores aleatorios."""
+    rng = np.random.default_rng(0)
+    results = []
+    for size in sizes:
+        cache = SemanticCache(capacity=size, dim=dim)
+        block = 100_000
+        for start in range(0, size, block):
+            chunk = rng.standard_normal((min(block, size - start), dim), dtype=np.float32)
+            chunk /= np.linalg.norm(chunk, axis=1, keepdims=True)
+            cache.vectors[start:start + len(chunk)] = chunk
+        cache.count = size
+        cache.answers = [{"response": "", "is_tolkien_related": False}] * size
+
+        start = time.perf_counter()
+        for i in range(queries):
+            cache.lookup(f"¿Quién era Gandalf? {i}")
+        elapsed = time.perf_counter() - start
+        results.append({
+            "entries": size,
+            "dim": dim,
+            "memory_mb": cache.vectors.nbytes / 2**20,
+            "mean_lookup_ms": elapsed / queries * 1000,
+        })
+        del cache
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    for result in run_benchmark(sizes):
+        print(f"{result['entries']:>9} entradas (dim {result['dim']}, {result['memory_mb']:.0f} MB): "
+              f"{result['mean_lookup_ms']:.2f} ms por búsqueda")
@@ -0,0 +1,193 @@
+"""
+Canal WebSocket con varias peticiones simultáneas por conexión.
+
+Cada mensaje del cliente es un objeto JSON con `type` e `id`; las respuestas
+llevan el mismo `id`, así que una sola conexión transporta muchas preguntas en
+vuelo y sus fragmentos llegan intercalados. `{"type": "cancel", "id": ...}`
+cancela una petición en curso.
+
+Límites por conexión:
+- Peticiones en vuelo: como mucho `max_in_flight`; las que superan el límite
+  reciben un error con `retry_after` en lugar de encolarse sin fin.
+- Tamaño de cada mensaje recibido: `max_message_bytes` (en bytes UTF-8); los
+  frames binarios del cliente se rechazan.
+- Contrapresión de salida: los mensajes salen por una cola acotada que vacía
+  un único escritor. Si el cliente lee despacio, la cola se llena y quienes
+  envían (p. ej. el streaming de una respuesta) esperan, con lo que también se
+  deja de leer del modelo. Si la cola sigue llena tras `send_timeout_seconds`,
+  la conexión se cierra (1013) para no retener huecos de llamada al modelo.
+"""
+import asyncio
+import json
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+# Código de cierre "inténtalo más tarde" (RFC 6455)
+CLOSE_TRY_AGAIN_LATER = 1013
+
+_stats = {
+    "connections_open": 0,
+    "connections_total": 0,
+    "messages_in": 0,
+    "messages_out": 0,
+    "requests_started": 0,
+    "requests_cancelled": 0,
+    "rejected_in_flight": 0,
+    "rejected_invalid": 0,
+    "slow_consumer_closes": 0,
+}
+
+
+def get_channel_stats() -> dict:
+    return dict(_stats)
+
+
+class ChannelClosed(Exception):
+    """La conexión se cerró: quien envía debe dejar de hacerlo."""
+
+
+class WebSocketChannel:
+    """Multiplexa peticiones sobre una conexión WebSocket ya aceptada."""
+
+    def __init__(self, websocket: WebSocket, max_in_flight: int = 4, send_queue_size: int = 256,
+                 send_timeout_seconds: float = 10, max_message_bytes: int = 65536):
+        self.websocket = websocket
+        self.max_in_flight = max_in_flight
+        self.send_timeout_seconds = send_timeout_seconds
+        self.max_message_bytes = max_message_bytes
+        self._outgoing = asyncio.Queue(maxsize=send_queue_size)
+        self._tasks = {}  # id -> tarea de la petición
+        self._closed = asyncio.Event()
+
+    async def send(self, message: dict, data: bytes = None) -> None:
+        """
+        Encola un mensaje JSON. Con `data`, el mensaje va seguido de un frame binario
+        con esos bytes; los dos salen juntos, sin mensajes de otras peticiones en medio.
+        """
+        await self._put((json.dumps(message, ensure_ascii=False), data))
+
+    async def _put(self, item: tuple) -> None:
+        if self._closed.is_set():
+            raise ChannelClosed()
+        try:
+            await asyncio.wait_for(self._outgoing.put(item), timeout=self.send_timeout_seconds)
+        except asyncio.TimeoutError:
+            # El cliente no lee: se corta en lugar de acumular memoria y llamadas al modelo
+            _stats["slow_consumer_closes"] += 1
+            await self._close(CLOSE_TRY_AGAIN_LATER)
+            raise ChannelClosed()
+
+    async def _writer(self) -> None:
+        try:
+            while True:
+                text, data = await self._outgoing.get()
+                await self.websocket.send_text(text)
+                if data is not None:
+                    await self.websocket.send_bytes(data)
+                _stats["messages_out"] += 1
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            pass
+        finally:
+            self._closed.set()
+
+    async def _close(self, code: int) -> None:
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        try:
+            await self.websocket.close(code=code)
+        except (RuntimeError, OSError):
+            pass
+
+    async def _reader(self, handlers: dict) -> None:
+        while not self._closed.is_set():
+            frame = await self.websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000), frame.get("reason"))
+            _stats["messages_in"] += 1
+            text = frame.get("text")
+            if text is None:
+                # Los frames binarios solo van del servidor al cliente (PDF)
+                _stats["rejected_invalid"] += 1
+                await self.send({"type": "error", "id": None, "detail": "Mensaje no válido: se esperaba un frame de texto con JSON."})
+                continue
+            if len(text.encode("utf-8")) > self.max_message_bytes:
+                _stats["rejected_invalid"] += 1
+                await self.send({"type": "error", "id": None,
+                                 "detail": f"Mensaje demasiado grande (máximo {self.max_message_bytes} bytes)."})
+                continue
+            try:
+                message = json.loads(text)
+                message_type, request_id = message["type"], str(message["id"])
+            except (ValueError, KeyError, TypeError):
+                _stats["rejected_invalid"] += 1
+                await self.send({"type": "error", "id": None, "detail": "Mensaje no válido: se esperaba JSON con 'type' e 'id'."})
+                continue
+
+            if message_type == "cancel":
+                task = self._tasks.get(request_id)
+                if task is not None:
+                    task.cancel()
+                    _stats["requests_cancelled"] += 1
+                continue
+            handler = handlers.get(message_type)
+            if handler is None:
+                _stats["rejected_invalid"] += 1
+                await self.send({"type": "error", "id": request_id, "detail": f"Tipo de mensaje desconocido: '{message_type}'."})
+                continue
+            if request_id in self._tasks:
+                _stats["rejected_invalid"] += 1
+                await self.send({"type": "error", "id": request_id, "detail": "Ya hay una petición en curso con ese id."})
+                continue
+            if len(self._tasks) >= self.max_in_flight:
+                _stats["rejected_in_flight"] += 1
+                await self.send({"type": "error", "id": request_id, "retry_after": 1,
+                                 "detail": f"Hay {self.max_in_flight} peticiones en curso en esta conexión; espera a que termine alguna."})
+                continue
+
+            _stats["requests_started"] += 1
+            task = asyncio.create_task(self._run_handler(handler, request_id, message))
+            self._tasks[request_id] = task
+
+    async def _run_handler(self, handler, request_id: str, message: dict) -> None:
+        try:
+            await handler(self, request_id, message)
+        except ChannelClosed:
+            pass
+        except asyncio.CancelledError:
+            # Cancelada por el cliente (en una desconexión el canal ya está cerrado)
+            if not self._closed.is_set():
+                try:
+                    await self.send({"type": "cancelled", "id": request_id})
+                except ChannelClosed:
+                    pass
+        except Exception as e:
+            print(f"Error en la petición '{request_id}' del canal WebSocket: {e}")
+            try:
+                await self.send({"type": "error", "id": request_id, "detail": f"Error al procesar la solicitud: {e}"})
+            except ChannelClosed:
+                pass
+        finally:
+            self._tasks.pop(request_id, None)
+
+    async def run(self, handlers: dict) -> None:
+        """
+        Atiende la conexión hasta que se cierre. `handlers` asocia cada `type` a
+        una corrutina `handler(canal, id, mensaje)` que responde con canal.send().
+        """
+        _stats["connections_open"] += 1
+        _stats["connections_total"] += 1
+        writer = asyncio.create_task(self._writer())
+        reader = asyncio.create_task(self._reader(handlers))
+        closed = asyncio.create_task(self._closed.wait())
+        try:
+            await asyncio.wait({reader, closed}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            _stats["connections_open"] -= 1
+            self._closed.set()
+            # Desconexión: se cancelan las peticiones en vuelo y sus llamadas al modelo
+            for task in list(self._tasks.values()) + [reader, writer, closed]:
+                task.cancel()
+            if reader.done() and not reader.cancelled() and reader.exception() is not None \
+                    and not isinstance(reader.exception(), (WebSocketDisconnect, ChannelClosed)):
+                print(f"Error en el canal WebSocket: {reader.exception()}")
@@ -0,0 +1,286 @@
+"""
+Pre-clasificador local (sin llamadas al modelo) para decidir si una consulta
+está relacionada con Tolkien.
+
+Resuelve en microsegundos los casos obvios (nombres y lugares de Arda, saludos,
+agradecimientos, meta-preguntas sobre el asistente) y devuelve None para los
+casos ambiguos, que siguen pasando por el prompt de clasificación de Gemini.
+
+Ejecutar `python clasificador_local.py` lanza el benchmark con el conjunto
+etiquetado en español e inglés.
+"""
+import re
+import time
+import unicodedata
+from typing import Optional
+
+# --- Normalización de texto ---
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normaliza un texto: minúsculas, sin acentos, sin signos de puntuación
+    y con los espacios colapsados.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+# Palabras vacías y fórmulas de petición que no aportan al tema de la pregunta
+STOPWORDS = frozenset({
+    # Español
+    "a", "al", "algo", "como", "con", "cual", "cuales", "cuando", "cuanto", "cuantos",
+    "de", "del", "donde", "el", "ella", "en", "era", "es", "esta", "estaba", "fue",
+    "ha", "habia", "la", "las", "lo", "los", "me", "mi", "por", "porque", "que",
+    "quien", "quienes", "se", "ser", "sobre", "son", "su", "sus", "te", "un", "una",
+    "y", "o", "hablame", "cuentame", "dime", "explicame", "explica", "puedes", "podrias",
+    "sabes", "quiero", "saber", "informacion", "favor",
+    # Inglés
+    "about", "an", "and", "are", "is", "the", "of", "was", "were", "what", "who",
+    "whom", "where", "when", "which", "why", "how", "did", "do", "does", "in", "on",
+    "to", "tell", "me", "describe", "explain", "please", "can", "you", "could",
+})
+
+
+# --- Gazetteer de Arda (ya normalizado) ---
+# Términos de una sola palabra: personajes, lugares, pueblos, objetos, obras y lenguas.
+TOLKIEN_TERMS = frozenset({
+    # Autor y obras
+    "tolkien", "silmarillion", "hobbit", "hobbits", "legendarium", "unfinished",
+    # Personajes
+    "gandalf", "mithrandir", "olorin", "frodo", "bilbo", "samsagaz", "samwise", "sam",
+    "merry", "pippin", "aragorn", "trancos", "strider", "elessar", "legolas", "gimli",
+    "boromir", "faramir", "denethor", "theoden", "eowyn", "eomer", "saruman", "sauron",
+    "morgoth", "melkor", "gollum", "smeagol", "galadriel", "celeborn", "elrond", "arwen",
+    "glorfindel", "radagast", "bombadil", "baya", "goldberry", "treebeard", "barbol",
+    "fangorn", "thorin", "smaug", "beorn", "bardo", "bard", "feanor", "fingolfin",
+    "finrod", "turin", "turambar", "beren", "luthien", "tinuviel", "earendil", "elwing",
+    "hurin", "tuor", "idril", "thingol", "melian", "ungoliant", "shelob",
+    "glaurung", "ancalagon", "isildur", "elendil", "anarion", "numenor", "numenoreanos",
+    "manwe", "varda", "elbereth", "ulmo", "aule", "yavanna", "mandos", "namo", "iluvatar",
+    "eru", "valar", "maiar", "balrog", "balrogs", "nazgul", "angmar",
+    "celebrimbor", "maedhros", "fingon", "turgon", "ecthelion", "gothmog",
+    # Lugares
+    "mordor", "gondor", "rohan", "comarca", "shire", "rivendel", "rivendell", "imladris",
+    "lothlorien", "lorien", "moria", "isengard", "orthanc", "minas",
+    "tirith", "morgul", "erebor", "valinor", "aman", "beleriand", "doriath",
+    "gondolin", "nargothrond", "angband", "utumno", "thangorodrim", "osgiliath",
+    "edoras", "hobbiton", "bolson", "bree", "arnor", "eriador", "mirkwood", "dol",
+    "guldur", "anduin", "helm", "ithilien", "tirion", "alqualonde", "tol", "eressea",
+    "arda", "orodruin",
+    # Pueblos y criaturas
+    "elfos", "elves", "elfo", "elf", "enanos", "dwarves", "enano", "dwarf", "orcos",
+    "orcs", "orco", "orc", "uruk", "ents", "ent", "trolls", "huargos",
+    "wargs", "noldor", "sindar", "teleri", "vanyar", "eldar", "avari", "dunedain",
+    "rohirrim", "istari", "ainur", "ainulindale", "valaquenta", "akallabeth",
+    # Objetos
+    "silmaril", "silmarils", "silmarilli", "palantir", "palantiri", "mithril",
+    "anduril", "narsil", "dardo", "sting", "glamdring", "orcrist", "arkenstone",
+    "arkenpiedra", "nenya", "vilya", "narya", "lembas", "athelas",
+    # Lenguas
+    "quenya", "sindarin", "khuzdul", "tengwar", "cirth", "adunaico", "adunaic",
+    "entish", "westron", "oestron",
+})
+
+# Términos de varias palabras (normalizados) que se buscan como subcadena.
+# Los nombres con guion ("khazad-dum") quedan separados por espacios al normalizar.
+TOLKIEN_PHRASES = (
+    "tierra media", "middle earth", "senor de los anillos", "lord of the rings",
+    "anillo unico", "one ring", "anillos de poder", "rings of power",
+    "cuentos inconclusos", "unfinished tales", "hijos de hurin", "children of hurin",
+    "monte del destino", "mount doom", "cima de los vientos", "weathertop",
+    "bosque negro", "rey brujo", "witch king", "dol guldur", "minas tirith",
+    "minas morgul", "abismo de helm", "helm s deep", "ella larana", "uruk hai",
+    "khazad dum", "barad dur", "gil galad", "guerra del anillo", "war of the ring",
+    "primera edad", "segunda edad", "tercera edad",
+    "first age", "second age", "third age", "cuarta edad", "fourth age",
+)
+
+# Términos ambiguos fuera de contexto (p. ej. "sam", "dol", "helm", "minas", "tol", "bard"),
+# palabras corrientes en español ("mandos", "comarca", "arda", "bolson" y "moria", que es
+# "moría" sin acento), criaturas genéricas del folclore ("elfos", "enanos", "orcos") y
+# "shire" (una raza de caballos): solos no bastan para decidir, solo suman puntuación.
+WEAK_TERMS = frozenset({
+    "sam", "merry", "dol", "helm", "minas", "tol", "bard", "bardo", "aman", "eru",
+    "ent", "ents", "trolls", "lorien", "unfinished", "bree", "baya", "dardo", "sting",
+    "elfos", "elves", "elfo", "elf", "enanos", "dwarves", "enano", "dwarf",
+    "orcos", "orcs", "orco", "orc",
+    "mandos", "comarca", "arda", "moria", "bolson", "shire",
+})
+
+# Saludos, agradecimientos y despedidas (mensaje completo)
+_SMALLTALK_RE = re.compile(
+    r"^(?:(?:hola|buenas|buenos dias|buenas tardes|buenas noches|hey|hi|hello|good morning|"
+    r"good afternoon|good evening|saludos|gracias|muchas gracias|mil gracias|thanks|"
+    r"thank you|thanks a lot|thx|adios|hasta luego|hasta pronto|bye|goodbye|see you|"
+    r"ok|okay|vale|perfecto|genial|de acuerdo|entendido|great|cool|nice|perfect|"
+    r"si|no|yes|claro|muy bien|estupendo|excelente|elendur)\s*)+$"
+)
+
+# Meta-preguntas sobre el propio asistente o la conversación
+_META_RE = re.compile(
+    r"^(?:(?:hola|hey|hi|hello)\s+)?(?:quien eres|que eres|como te llamas|como estas|que tal|"
+    r"que puedes hacer|en que me puedes ayudar|who are you|what are you|what is your name|"
+    r"how are you|what can you do|tengo otra pregunta|tengo una pregunta|i have another question|"
+    r"i have a question|otra pregunta|another question|puedes contarme un chiste|"
+    r"cuentame un chiste|tell me a joke)(?:\s+elendur)?$"
+)
+
+# Mensajes que empiezan con un agradecimiento ("Gracias por tu respuesta")
+_THANKS_PREFIX_RE = re.compile(r"^(?:muchas |mil )?(?:gracias|thanks|thank you)\b")
+
+# Umbral de puntuación a partir del cual se responde YES sin consultar al modelo
+SCORE_THRESHOLD = 2
+
+# Contadores de aciertos locales y consultas que pasan al modelo
+CLASSIFIER_STATS = {
+    "local_yes": 0,
+    "local_no": 0,
+    "fallthrough": 0,
+}
+
+
+def _score(normalized: str) -> int:
+    """Puntuación simple: 2 por término fuerte o frase, 1 por término ambiguo."""
+    score = 0
+    for token in normalized.split():
+        if token in TOLKIEN_TERMS:
+            score += 1 if token in WEAK_TERMS else 2
+    for phrase in TOLKIEN_PHRASES:
+        if phrase in normalized:
+            score += 2
+    return score
+
+
+def pre_classify(query: str) -> Optional[bool]:
+    """
+    Clasifica la consulta localmente.
+    Retorna True/False si el caso es obvio, o None si debe decidirlo el modelo.
+    """
+    normalized = normalize_text(query)
+
+    if not normalized or _SMALLTALK_RE.match(normalized) or _META_RE.match(normalized):
+        CLASSIFIER_STATS["local_no"] += 1
+        return False
+
+    score = _score(normalized)
+    if score >= SCORE_THRESHOLD:
+        CLASSIFIER_STATS["local_yes"] += 1
+        return True
+    if score == 0 and _THANKS_PREFIX_RE.match(normalized):
+        CLASSIFIER_STATS["local_no"] += 1
+        return False
+
+    CLASSIFIER_STATS["fallthrough"] += 1
+    return None
+
+
+def get_classifier_stats() -> dict:
+    """Devuelve los contadores junto con la tasa de resolución local."""
+    local_hits = CLASSIFIER_STATS["local_yes"] + CLASSIFIER_STATS["local_no"]
+    total = local_hits + CLASSIFIER_STATS["fallthrough"]
+    return {
+        **CLASSIFIER_STATS,
+        "hits": local_hits,
+        "misses": CLASSIFIER_STATS["fallthrough"],
+        "hit_ratio": local_hits / total if total else 0.0,
+    }
+
+
+# --- Conjunto etiquetado para el benchmark ---
+# La etiqueta es el veredicto esperado del clasificador basado solo en el modelo.
+BENCHMARK_QUERIES = [
+    ("¿Quién es Gandalf?", True),
+    ("Háblame de los Elfos.", True),
+    ("¿Dónde está Mordor?", True),
+    ("¿Qué es un Silmaril?", True),
+    ("¿Quién forjó el Anillo Único?", True),
+    ("¿Cuántos años tenía Bilbo en su fiesta de cumpleaños?", True),
+    ("Explícame la diferencia entre Quenya y Sindarin.", True),
+    ("¿Qué ocurrió en la caída de Gondolin?", True),
+    ("¿Por qué Fëanor abandonó Valinor?", True),
+    ("¿Quién era Tom Bombadil?", True),
+    ("Who is Galadriel?", True),
+    ("Tell me about the Battle of Helm's Deep.", True),
+    ("What happened to the Entwives?", True),
+    ("What are the Rings of Power?", True),
+    ("Where is the Lonely Mountain and who is Smaug?", True),
+    ("Describe the history of Númenor.", True),
+    ("¿Cómo murió Boromir?", True),
+    ("¿Qué son los Nazgûl?", True),
+    ("¿Quién escribió El Señor de los Anillos?", True),
+    ("What is the Tierra Media timeline in the Third Age?", True),
+    ("Hola.", False),
+    ("Hola Elendur", False),
+    ("Gracias por tu respuesta.", False),
+    ("Muchas gracias", False),
+    ("Thanks!", False),
+    ("Hello", False),
+    ("Buenos días", False),
+    ("Tengo otra pregunta.", False),
+    ("¿Quién eres?", False),
+    ("Who are you?", False),
+    ("¿Puedes contarme un chiste?", False),
+    ("ok", False),
+    ("Adiós", False),
+    ("¿Cuál es la capital de Francia?", False),
+    ("What is the weather like today?", False),
+    ("¿Cuánto es 2 + 2?", False),
+    ("Recomiéndame una película de acción.", False),
+    ("How do I cook pasta?", False),
+    ("¿Qué opinas del fútbol?", False),
+    ("Explain quantum computing.", False),
+    # Palabras de Arda que también son español corriente
+    ("¿Dónde compro mandos para la consola?", False),
+    ("¿Cuál es la comarca más poblada de Aragón?", False),
+    ("Que arda Troya", False),
+    ("Blancanieves y los siete enanos", False),
+    ("Mi abuelo se moría de risa", False),
+    ("Se me rompió el bolsón", False),
+    ("¿Cuántos elfos tiene Papá Noel?", False),
+    ("¿Cuánto pesa un caballo shire?", False),
+]
+
+
+def run_benchmark(repetitions: int = 1000) -> dict:
+    """
+    Mide la precisión de las decisiones locales frente a las etiquetas
+    (que reflejan el comportamiento del clasificador solo-LLM) y la latencia
+    media por consulta. Las consultas que pasan al modelo no cuentan
+    para la precisión.
+    """
+    correct = decided = fallthrough = 0
+    for query, label in BENCHMARK_QUERIES:
+        verdict = pre_classify(query)
+        if verdict is None:
+            fallthrough += 1
+            continue
+        decided += 1
+        if verdict == label:
+            correct += 1
+
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        for query, _label in BENCHMARK_QUERIES:
+            pre_classify(query)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "queries": len(BENCHMARK_QUERIES),
+        "decided_locally": decided,
+        "fallthrough": fallthrough,
+        "accuracy_on_decided": correct / decided if decided else 0.0,
+        "mean_latency_us": elapsed / (repetitions * len(BENCHMARK_QUERIES)) * 1e6,
+    }
+
+
+if __name__ == "__main__":
+    results = run_benchmark()
+    print(f"Consultas: {results['queries']}")
+    print(f"Resueltas localmente: {results['decided_locally']} (pasan al modelo: {results['fallthrough']})")
+    print(f"Precisión en las resueltas: {results['accuracy_on_decided']:.1%}")
+    print(f"Latencia media por consulta: {results['mean_latency_us']:.1f} µs")
@@ -0,0 +1,89 @@
+"""
+Coalescencia de peticiones idénticas en vuelo (single-flight).
+
+Cuando llegan a la vez varias peticiones con la misma clave (pregunta
+normalizada + modelo + prompt), solo la primera lanza la llamada al modelo;
+las demás esperan a ese mismo resultado. Los errores se propagan a todas.
+
+La llamada se ejecuta en su propia tarea: si la petición que la inició se
+cancela (el cliente se desconecta), las demás siguen esperando sin
+problema. Solo cuando se cancelan todas las peticiones en espera se cancela
+también la llamada.
+
+Ejecutar `python coalescencia.py` lanza N peticiones idénticas concurrentes
+contra un modelo simulado y comprueba que se hace una única llamada.
+"""
+import asyncio
+import sys
+
+
+class SingleFlight:
+    """Comparte una única llamada en vuelo entre las peticiones con la misma clave."""
+
+    def __init__(self):
+        self._inflight = {}  # clave -> [tarea, nº de peticiones esperando]
+        self.stats = {"upstream_calls": 0, "coalesced": 0, "errors": 0}
+
+    async def do(self, key: str, fn):
+        """Ejecuta `fn()` (una corrutina) o se une a la ejecución en curso con la misma clave."""
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.create_task(fn())
+            entry = [task, 0]
+            self._inflight[key] = entry
+            self.stats["upstream_calls"] += 1
+            task.add_done_callback(lambda t, key=key: self._finished(key, t))
+        else:
+            self.stats["coalesced"] += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and entry[1] == 1:
+                # Era la última petición esperando: ya nadie necesita el resultado
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _finished(self, key: str, task: asyncio.Task) -> None:
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "in_flight": len(self._inflight)}
+
+
+async def run_load_test(concurrency: int = 100, upstream_seconds: float = 0.2) -> dict:
+    """Lanza `concurrency` peticiones idénticas contra un modelo simulado."""
+    flight = SingleFlight()
+    upstream_calls = 0
+
+    async def fake_model_call():
+        nonlocal upstream_calls
+        upstream_calls += 1
+        await asyncio.sleep(upstream_seconds)
+        return "Gandalf es uno de los Istari."
+
+    results = await asyncio.gather(*(
+        flight.do("quien es gandalf", fake_model_call) for _ in range(concurrency)
+    ))
+    return {
+        "requests": concurrency,
+        "upstream_calls": upstream_calls,
+        "saved_calls": flight.stats["coalesced"],
+        "all_same_result": len(set(results)) == 1,
+    }
+
+
+if __name__ == "__main__":
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    results = asyncio.run(run_load_test(concurrency))
+    print(f"Peticiones: {results['requests']}, llamadas al modelo: {results['upstream_calls']}, "
+          f"llamadas ahorradas: {results['saved_calls']}, mismo resultado: {results['all_same_result']}")
+    sys.exit(0 if results["upstream_calls"] == 1 else 1)
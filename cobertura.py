@@ -0,0 +1,197 @@
+"""
+Peticiones de cobertura (hedged requests) contra la latencia de cola.
+
+Si la llamada al modelo no ha respondido cuando se supera un umbral adaptativo
+(por defecto, el p90 de las latencias recientes), se lanza una copia y se usa
+la primera que termine bien; la otra se cancela. Como la mayoría de las
+llamadas lentas lo son por azar (cola, red, réplica cargada), la copia suele
+llegar antes que la original.
+
+El coste está acotado por un presupuesto: cada llamada suma `max_extra_ratio`
+fichas y cada copia gasta una, así que las llamadas extra no pasan de ese
+porcentaje del total (con una pequeña reserva para ráfagas). Además, el
+llamador puede impedir la copia cuando no hay capacidad libre.
+
+Ejecutar `python cobertura.py` compara, contra un modelo falso con latencia de
+cola pesada (Pareto), la latencia p50/p95/p99 sin cobertura y con distintos
+presupuestos, junto con el porcentaje de llamadas extra.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Optional
+
+
+class LatencyWindow:
+    """Últimas `size` latencias, con cuantiles (se reordena solo si cambió)."""
+
+    def __init__(self, size: int = 500):
+        self._samples = deque(maxlen=size)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._sorted = None
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        return self._sorted[min(int(q * len(self._sorted)), len(self._sorted) - 1)]
+
+
+class HedgeBudget:
+    """Presupuesto de copias: `ratio` fichas por llamada, una ficha por copia, como mucho `burst` acumuladas."""
+
+    def __init__(self, ratio: float, burst: float = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = min(1.0, burst)
+
+    def earn(self) -> None:
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Hedger:
+    """
+    Lanza una copia de la llamada si la original tarda más que el cuantil `quantile`
+    de las latencias recientes. Hasta tener `min_samples` latencias no hay copias.
+    """
+
+    def __init__(self, quantile: float = 0.9, max_extra_ratio: float = 0.05, window: int = 500,
+                 min_samples: int = 20, min_delay_seconds: float = 0.0):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay_seconds = min_delay_seconds
+        self.window = LatencyWindow(window)
+        self.budget = HedgeBudget(max_extra_ratio)
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "budget_denied": 0, "capacity_denied": 0}
+
+    def threshold(self) -> Optional[float]:
+        """Espera antes de lanzar la copia (None mientras no haya suficientes muestras)."""
+        if len(self.window) < self.min_samples:
+            return None
+        return max(self.window.quantile(self.quantile), self.min_delay_seconds)
+
+    async def call(self, fn, hedge_fn=None, can_hedge=None):
+        """
+        Llama a `fn()` y, si tarda más que el umbral, también a `hedge_fn()` (por
+        defecto `fn`). `can_hedge()` puede vetar la copia (p. ej. sin capacidad libre).
+        Si una de las dos falla se espera a la otra; si fallan las dos, se propaga
+        el error de la original.
+        """
+        self.stats["calls"] += 1
+        self.budget.earn()
+        delay = self.threshold()
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(fn())
+        hedge = None
+        try:
+            if delay is not None:
+                await asyncio.wait({primary}, timeout=delay)
+            if primary.done() or delay is None:
+                result = await primary
+                self.window.add(time.perf_counter() - start)
+                return result
+
+            if can_hedge is not None and not can_hedge():
+                self.stats["capacity_denied"] += 1
+            elif not self.budget.try_spend():
+                self.stats["budget_denied"] += 1
+            else:
+                self.stats["hedged"] += 1
+                hedge = asyncio.ensure_future((hedge_fn or fn)())
+            if hedge is None:
+                result = await primary
+                self.window.add(time.perf_counter() - start)
+                return result
+
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in (primary, hedge):
+                    if task in done and task.exception() is None:
+                        if task is hedge:
+                            self.stats["hedge_wins"] += 1
+                        # Si gana la copia, la latencia de la original es al menos la transcurrida:
+                        # se registra esa cota para que el umbral no se desplome
+                        self.window.add(time.perf_counter() - start)
+                        return task.result()
+            raise primary.exception()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def get_stats(self) -> dict:
+        threshold = self.threshold()
+        calls = self.stats["calls"]
+        return {
+            **self.stats,
+            "extra_call_ratio": round(self.stats["hedged"] / calls, 4) if calls else 0.0,
+            "threshold_seconds": round(threshold, 4) if threshold is not None else None,
+            "samples": len(self.window),
+        }
+
+
+# --- Benchmark ---
+
+def _percentiles(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+async def run_benchmark(requests: int = 3000, concurrency: int = 50, latency: str = "pareto:0.02:1.6",
+                        budget: Optional[float] = None, seed: int = 0) -> dict:
+    """
+    Latencias de `requests` llamadas a un modelo falso con cola pesada, sin cobertura
+    (budget=None) o con un presupuesto de llamadas extra `budget`.
+    """
+    from modelo_falso import FakeGenerativeModel
+
+    model = FakeGenerativeModel("cola-pesada", latency=latency, seed=seed)
+    hedger = Hedger(max_extra_ratio=budget) if budget is not None else None
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    async def one_call():
+        return await model.start_chat(history=[]).send_message_async("¿Quién es Gandalf?")
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            if hedger is None:
+                await one_call()
+            else:
+                await hedger.call(one_call)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {
+        **_percentiles(latencies),
+        "upstream_calls": model.stats["calls"],
+        "extra_calls_pct": (model.stats["calls"] - requests) / requests * 100,
+        "hedger": hedger.get_stats() if hedger is not None else None,
+    }
+
+
+if __name__ == "__main__":
+    for budget in (None, 0.02, 0.05, 0.10):
+        result = asyncio.run(run_benchmark(budget=budget))
+        label = "sin cobertura" if budget is None else f"presupuesto {budget:.0%}"
+        print(f"{label:>18}: p50 {result['p50_ms']:6.1f} ms  p95 {result['p95_ms']:6.1f} ms  "
+              f"p99 {result['p99_ms']:7.1f} ms  llamadas extra {result['extra_calls_pct']:.1f}%")
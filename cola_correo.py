@@ -0,0 +1,299 @@
+"""
+Cola de envío de correo asíncrona.
+
+La ruta /send-email ya no habla con el servidor SMTP: encola el mensaje y
+responde enseguida con un identificador de trabajo. Un grupo de workers
+consume la cola; cada worker mantiene abierta su propia conexión SMTP
+autenticada y la reutiliza entre envíos, de modo que el coste de TCP + TLS +
+login se paga una vez y no por correo. Las llamadas a smtplib (bloqueantes)
+se ejecutan en hilos para no bloquear el event loop. Los fallos temporales se
+reintentan con espera exponencial; los rechazos permanentes del servidor (5xx,
+p. ej. un destinatario inexistente) marcan el envío como fallido sin reintentar,
+para no enviar el mismo correo varias veces.
+
+Ejecutar `python cola_correo.py` lanza un benchmark contra un servidor SMTP
+local (requiere `aiosmtpd`) que mide el rendimiento y el retraso del event loop.
+"""
+import asyncio
+import random
+import smtplib
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from email.header import Header
+from email.mime.text import MIMEText
+from email.utils import formataddr
+from typing import Optional
+
+from metricas import stage
+
+# Estados de un trabajo de envío
+JOB_QUEUED = "queued"
+JOB_SENDING = "sending"
+JOB_SENT = "sent"
+JOB_FAILED = "failed"
+
+
+class MailQueueFull(Exception):
+    """La cola de envío está llena."""
+
+
+def build_message(sender_email: str, sender_name: str, to_email: str, subject: str, body: str) -> MIMEText:
+    """Construye el mensaje MIME en UTF-8."""
+    msg = MIMEText(body, 'plain', 'utf-8')
+    msg['Subject'] = Header(subject, 'utf-8').encode()
+    msg['From'] = formataddr((str(Header(sender_name, 'utf-8')), sender_email))
+    msg['To'] = to_email
+    return msg
+
+
+# Errores tras los que la conexión ya no sirve y se puede reenviar por otra nueva
+_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """True si el servidor rechazó el envío de forma definitiva (5xx): no se reintenta."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _message in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+    # El servidor no admite AUTH o STARTTLS: error de configuración
+    return isinstance(error, smtplib.SMTPNotSupportedError)
+
+
+class _SMTPConnection:
+    """Conexión SMTP reutilizable de un worker. Se reabre si el servidor la cierra."""
+
+    def __init__(self, host: str, port: int, username: Optional[str], password: Optional[str],
+                 use_starttls: bool, use_auth: bool = True, idle_check_seconds: float = 30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_starttls = use_starttls
+        self.use_auth = use_auth
+        self.idle_check_seconds = idle_check_seconds
+        self._server = None
+        self._last_used = 0.0
+
+    def _open(self) -> None:
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        server.ehlo()
+        if self.use_starttls:
+            server.starttls()
+            server.ehlo()
+        # Sin use_auth (SMTP_AUTH=false) para servidores locales que no anuncian AUTH
+        if self.use_auth and self.username and self.password:
+            server.login(self.username, self.password)
+        self._server = server
+
+    def _is_alive(self) -> bool:
+        try:
+            return self._server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def send(self, msg: MIMEText) -> None:
+        """Envía un mensaje (bloqueante). Reutiliza la conexión si sigue viva."""
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_check_seconds:
+            if not self._is_alive():
+                self.close()
+        if self._server is None:
+            self._open()
+        try:
+            self._server.send_message(msg)
+        except _CONNECTION_ERRORS:
+            # La conexión se cerró entre envíos: reabrir y reintentar una vez
+            self.close()
+            self._open()
+            self._server.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close(self) -> None:
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
+
+
+class MailQueue:
+    """Cola acotada de envíos con un grupo de workers y conexiones SMTP persistentes."""
+
+    def __init__(self, host: str, port: int, sender_email: str, sender_name: str,
+                 username: Optional[str] = None, password: Optional[str] = None,
+                 use_starttls: bool = True, use_auth: bool = True, workers: int = 2, max_queue: int = 100,
+                 max_attempts: int = 3, backoff_seconds: float = 1.0, max_jobs_tracked: int = 1000):
+        self.host = host
+        self.port = port
+        self.sender_email = sender_email
+        self.sender_name = sender_name
+        self.username = username
+        self.password = password
+        self.use_starttls = use_starttls
+        self.use_auth = use_auth
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_jobs_tracked = max_jobs_tracked
+        self.jobs = OrderedDict()  # id -> estado del trabajo (sin el cuerpo del correo)
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "retries": 0, "rejected": 0, "refused": 0}
+        self._queue = None
+        self._tasks = []
+
+    def start(self) -> None:
+        """Arranca los workers. Debe llamarse dentro del event loop."""
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 10) -> None:
+        """Espera a que se vacíe la cola (con tiempo máximo) y detiene los workers."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Cola de correo: quedaron {self._queue.qsize()} envíos sin procesar al apagar.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, to_email: str, subject: str, body: str) -> str:
+        """Encola un correo y devuelve el id del trabajo. Lanza MailQueueFull si no cabe."""
+        job_id = uuid.uuid4().hex
+        try:
+            self._queue.put_nowait((job_id, to_email, subject, body))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise MailQueueFull()
+        self.jobs[job_id] = {
+            "job_id": job_id,
+            "status": JOB_QUEUED,
+            "attempts": 0,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+        while len(self.jobs) > self.max_jobs_tracked:
+            self.jobs.popitem(last=False)
+        self.stats["queued"] += 1
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        return self.jobs.get(job_id)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "workers": self.workers,
+        }
+
+    def _update_job(self, job_id: str, **fields) -> None:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+    async def _worker(self) -> None:
+        connection = _SMTPConnection(self.host, self.port, self.username, self.password,
+                                     self.use_starttls, self.use_auth)
+        try:
+            while True:
+                job_id, to_email, subject, body = await self._queue.get()
+                try:
+                    await self._deliver(connection, job_id, to_email, subject, body)
+                finally:
+                    self._queue.task_done()
+        finally:
+            await asyncio.to_thread(connection.close)
+
+    async def _deliver(self, connection: _SMTPConnection, job_id: str, to_email: str, subject: str, body: str) -> None:
+        msg = build_message(self.sender_email, self.sender_name, to_email, subject, body)
+        for attempt in range(1, self.max_attempts + 1):
+            self._update_job(job_id, status=JOB_SENDING, attempts=attempt)
+            try:
+                with stage("email_send"):
+                    await asyncio.to_thread(connection.send, msg)
+                self._update_job(job_id, status=JOB_SENT, error=None, finished_at=time.time())
+                self.stats["sent"] += 1
+                return
+            except Exception as e:
+                print(f"Error al enviar correo (intento {attempt}/{self.max_attempts}): {e}")
+                if is_permanent_error(e):
+                    # Rechazo definitivo: la conexión sigue sirviendo y reintentar no cambia nada
+                    self._update_job(job_id, status=JOB_FAILED, error=str(e), finished_at=time.time())
+                    self.stats["failed"] += 1
+                    self.stats["refused"] += 1
+                    return
+                await asyncio.to_thread(connection.close)
+                if attempt == self.max_attempts:
+                    self._update_job(job_id, status=JOB_FAILED, error=str(e), finished_at=time.time())
+                    self.stats["failed"] += 1
+                    return
+                self.stats["retries"] += 1
+                # Espera exponencial con jitter
+                delay = self.backoff_seconds * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+
+async def _measure_loop_lag(stop: asyncio.Event, samples: list, interval: float = 0.01) -> None:
+    """Mide cuánto se retrasa el event loop respecto a un sleep de `interval`."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+async def run_benchmark(messages: int = 500, workers: int = 4, port: int = 8025) -> dict:
+    """Envía `messages` correos a un servidor SMTP local (aiosmtpd) y mide rendimiento y lag."""
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.handlers import Sink
+
+    controller = Controller(Sink(), hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        queue = MailQueue("127.0.0.1", port, "elendur@localhost", "Elendur (Asistente)",
+                          use_starttls=False, workers=workers, max_queue=messages)
+        queue.start()
+        stop = asyncio.Event()
+        lag_samples = []
+        lag_task = asyncio.create_task(_measure_loop_lag(stop, lag_samples))
+
+        start = time.perf_counter()
+        for i in range(messages):
+            queue.enqueue(f"lector{i}@localhost", "Información de Tolkien", "Gandalf es un Maia. " * 50)
+        await queue.stop(drain_timeout=300)
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        await lag_task
+    finally:
+        controller.stop()
+
+    lag_samples.sort()
+    return {
+        "messages": messages,
+        "workers": workers,
+        "sent": queue.stats["sent"],
+        "failed": queue.stats["failed"],
+        "throughput_per_s": messages / elapsed,
+        "loop_lag_p50_ms": lag_samples[len(lag_samples) // 2] * 1000 if lag_samples else 0.0,
+        "loop_lag_max_ms": lag_samples[-1] * 1000 if lag_samples else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    results = asyncio.run(run_benchmark())
+    print(f"Enviados: {results['sent']}/{results['messages']} con {results['workers']} workers "
+          f"(fallidos: {results['failed']})")
+    print(f"Rendimiento: {results['throughput_per_s']:.0f} correos/s")
+    print(f"Retraso del event loop: p50 {results['loop_lag_p50_ms']:.2f} ms, máx {results['loop_lag_max_ms']:.2f} ms")
@@ -0,0 +1,256 @@
+"""
+Control de admisión para las llamadas a Gemini.
+
+- Limitador de tasa global y por cliente (token bucket).
+- Semáforo que limita las llamadas al modelo en vuelo.
+- Cola de espera acotada: si está llena, o si la espera estimada supera el
+  plazo, la petición se rechaza enseguida (429/503 con Retry-After) en lugar de
+  acabar en un timeout.
+- Reintentos con espera exponencial y jitter cuando el modelo responde 429.
+
+Ejecutar `python control_admision.py` simula una sobrecarga contra un modelo
+falso con cuota limitada y compara el goodput y la latencia de cola con y sin
+control de admisión.
+"""
+import asyncio
+import math
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from metricas import stage
+
+
+class AdmissionRejected(Exception):
+    """La petición se rechaza sin llamar al modelo."""
+
+    def __init__(self, status_code: int, retry_after: float, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class TokenBucket:
+    """Token bucket: `rate` fichas por segundo con ráfagas de hasta `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """Consume una ficha. Retorna 0 si se concede o los segundos hasta la siguiente ficha."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Detecta un 429 del modelo (google.api_core.exceptions.ResourceExhausted y similares)."""
+    code = getattr(error, "code", None)
+    try:
+        if code is not None and int(code) == 429:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return type(error).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+
+class AdmissionController:
+    """Limita la tasa por cliente y global, y la concurrencia de llamadas al modelo."""
+
+    def __init__(self, global_rps: float = 0, global_burst: float = 0,
+                 client_rps: float = 0, client_burst: float = 0,
+                 max_concurrency: int = 16, max_queue: int = 64, queue_deadline_seconds: float = 10,
+                 max_retries: int = 2, retry_backoff_seconds: float = 0.5, max_clients: int = 10000):
+        self.global_bucket = TokenBucket(global_rps, global_burst or global_rps) if global_rps > 0 else None
+        self.client_rps = client_rps
+        self.client_burst = client_burst or client_rps
+        self.max_clients = max_clients
+        self._client_buckets = OrderedDict()
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_deadline_seconds = queue_deadline_seconds
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = 0
+        self._waiting = 0
+        self._avg_upstream_seconds = 1.0  # media móvil de la duración de las llamadas
+        self.stats = {
+            "admitted": 0, "rejected_rate": 0, "rejected_queue": 0,
+            "rejected_deadline": 0, "upstream_retries": 0,
+        }
+
+    def _client_bucket(self, client_id: str) -> TokenBucket:
+        bucket = self._client_buckets.get(client_id)
+        if bucket is None:
+            bucket = TokenBucket(self.client_rps, self.client_burst)
+            self._client_buckets[client_id] = bucket
+            while len(self._client_buckets) > self.max_clients:
+                self._client_buckets.popitem(last=False)
+        else:
+            self._client_buckets.move_to_end(client_id)
+        return bucket
+
+    def check_rate(self, client_id: str) -> None:
+        """Aplica los límites de tasa. Lanza AdmissionRejected (429) si se superan."""
+        if self.client_rps > 0:
+            wait = self._client_bucket(client_id).try_acquire()
+            if wait > 0:
+                self.stats["rejected_rate"] += 1
+                raise AdmissionRejected(429, wait, "Has enviado demasiadas preguntas seguidas. Espera unos segundos.")
+        if self.global_bucket is not None:
+            wait = self.global_bucket.try_acquire()
+            if wait > 0:
+                self.stats["rejected_rate"] += 1
+                raise AdmissionRejected(429, wait, "El asistente está recibiendo demasiadas preguntas. Inténtalo en unos segundos.")
+
+    def has_spare_capacity(self) -> bool:
+        """True si una llamada al modelo obtendría hueco sin esperar en la cola."""
+        return not self._semaphore.locked()
+
+    def _estimated_wait(self) -> float:
+        if self._in_flight < self.max_concurrency:
+            return 0.0
+        # Cada "ronda" de max_concurrency llamadas tarda de media _avg_upstream_seconds
+        return math.ceil((self._waiting + 1) / self.max_concurrency) * self._avg_upstream_seconds
+
+    @asynccontextmanager
+    async def upstream_slot(self):
+        """Reserva un hueco para llamar al modelo, esperando en la cola acotada si hace falta."""
+        if not self._semaphore.locked():
+            # Hay hueco libre: acquire() no cede el control, así que no hay carrera con _in_flight
+            await self._semaphore.acquire()
+        else:
+            if self._waiting >= self.max_queue:
+                self.stats["rejected_queue"] += 1
+                raise AdmissionRejected(503, self._avg_upstream_seconds, "El asistente está saturado. Inténtalo en unos segundos.")
+            estimated = self._estimated_wait()
+            if estimated > self.queue_deadline_seconds:
+                self.stats["rejected_deadline"] += 1
+                raise AdmissionRejected(503, estimated, "El asistente está saturado. Inténtalo en unos segundos.")
+
+            self._waiting += 1
+            try:
+                with stage("upstream_queue_wait"):
+                    await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_deadline_seconds)
+            except asyncio.TimeoutError:
+                self.stats["rejected_deadline"] += 1
+                raise AdmissionRejected(503, self._avg_upstream_seconds, "El asistente está saturado. Inténtalo en unos segundos.")
+            finally:
+                self._waiting -= 1
+
+        self._in_flight += 1
+        self.stats["admitted"] += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+            self._avg_upstream_seconds = 0.9 * self._avg_upstream_seconds + 0.1 * (time.monotonic() - start)
+
+    async def retry(self, fn):
+        """Llama a `fn()` reintentando los 429 del modelo con espera exponencial y jitter."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await fn()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self.stats["upstream_retries"] += 1
+                delay = self.retry_backoff_seconds * 2 ** attempt
+                await asyncio.sleep(random.uniform(0, delay))  # "full jitter"
+
+    async def call(self, fn):
+        """Llama a `fn()` dentro de un hueco, con reintentos ante un 429."""
+        async with self.upstream_slot():
+            return await self.retry(fn)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "max_concurrency": self.max_concurrency,
+            "avg_upstream_seconds": round(self._avg_upstream_seconds, 3),
+        }
+
+
+class _FakeRateLimitError(Exception):
+    code = 429
+
+
+class _FakeRateLimitedModel:
+    """Modelo simulado que acepta `quota` llamadas simultáneas; el resto recibe un 429."""
+
+    def __init__(self, quota: int, latency_seconds: float):
+        self.quota = quota
+        self.latency_seconds = latency_seconds
+        self.in_flight = 0
+
+    async def generate(self):
+        if self.in_flight >= self.quota:
+            await asyncio.sleep(0.01)
+            raise _FakeRateLimitError("429 Resource exhausted")
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency_seconds * random.uniform(0.8, 1.5))
+            return "respuesta"
+        finally:
+            self.in_flight -= 1
+
+
+async def run_simulation(with_admission: bool, offered_rps: float = 200, duration_seconds: float = 5,
+                         quota: int = 20, latency_seconds: float = 0.2, timeout_seconds: float = 5) -> dict:
+    """Carga abierta (llegadas de Poisson) contra el modelo falso durante `duration_seconds`."""
+    model = _FakeRateLimitedModel(quota, latency_seconds)
+    controller = AdmissionController(max_concurrency=quota, max_queue=quota * 4,
+                                     queue_deadline_seconds=1.0, max_retries=2,
+                                     retry_backoff_seconds=0.05)
+    latencies = []
+    outcomes = {"ok": 0, "shed": 0, "failed": 0}
+
+    async def one_request():
+        start = time.perf_counter()
+        try:
+            if with_admission:
+                await asyncio.wait_for(controller.call(model.generate), timeout=timeout_seconds)
+            else:
+                await asyncio.wait_for(model.generate(), timeout=timeout_seconds)
+            outcomes["ok"] += 1
+            latencies.append(time.perf_counter() - start)
+        except AdmissionRejected:
+            outcomes["shed"] += 1
+        except Exception:
+            outcomes["failed"] += 1
+
+    tasks = []
+    deadline = time.perf_counter() + duration_seconds
+    while time.perf_counter() < deadline:
+        tasks.append(asyncio.create_task(one_request()))
+        await asyncio.sleep(random.expovariate(offered_rps))
+    await asyncio.gather(*tasks)
+
+    latencies.sort()
+    return {
+        **outcomes,
+        "goodput_rps": outcomes["ok"] / duration_seconds,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p99_ms": latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000 if latencies else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    for label, enabled in (("Sin control de admisión", False), ("Con control de admisión", True)):
+        r = asyncio.run(run_simulation(enabled))
+        print(f"{label}: goodput {r['goodput_rps']:.0f} resp/s, p50 {r['p50_ms']:.0f} ms, p99 {r['p99_ms']:.0f} ms "
+              f"(correctas {r['ok']}, rechazadas rápido {r['shed']}, fallidas {r['failed']})")
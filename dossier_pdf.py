@@ -0,0 +1,481 @@
+"""
+Dossier de estudio: muchas preguntas y respuestas en un solo PDF, en streaming.
+
+`generador_pdf.render_pdf` usa platypus, que monta el documento entero en
+memoria antes de escribirlo (el canvas de ReportLab guarda todas las páginas
+hasta `save()`). Para miles de preguntas eso no escala, así que el dossier se
+escribe con un generador de PDF mínimo que emite cada página en cuanto está
+compuesta:
+
+1. Una primera pasada de maquetación calcula solo en qué página empieza cada
+   pregunta (un entero por pregunta), necesario para el índice.
+2. La segunda pasada escribe el índice (con enlaces) y las páginas, y va
+   entregando los bytes por bloques. Lo único que crece con el tamaño del
+   dossier son las posiciones de los objetos para la tabla xref final.
+
+Se usan las fuentes estándar de PDF (Helvetica, codificación WinAnsi) y las
+métricas de ReportLab para partir las líneas. `entries` se recorre dos veces,
+así que debe ser una secuencia, no un iterador.
+
+Uso:
+    python dossier_pdf.py                                  # benchmark (10, 1.000 y 10.000 preguntas)
+    python dossier_pdf.py preguntas.jsonl respuestas.ndjson dossier.pdf   # dossier de un trabajo de lotes.py
+"""
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+import zlib
+from array import array
+from datetime import datetime
+
+from metricas import record_stage
+from sesiones import is_summary_turn
+
+# Página carta, en puntos
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+MARGIN = 72
+TEXT_WIDTH = PAGE_WIDTH - 2 * MARGIN
+FOOTER_Y = 40
+
+# Nombre en el PDF -> fuente estándar
+_FONTS = {"F1": "Helvetica", "F2": "Helvetica-Bold", "F3": "Helvetica-Oblique"}
+
+# (fuente, tamaño, interlineado)
+_TITLE = ("F2", 20, 26)
+_TOC_HEADING = ("F2", 14, 20)
+_TOC_LINE = ("F1", 10, 15)
+_QUESTION = ("F2", 12, 16)
+_ANSWER = ("F1", 11, 14.5)
+_META = ("F3", 10, 14)
+_FOOTER = ("F3", 9, 11)
+
+_ENTRY_GAP = 18  # Espacio entre una respuesta y la siguiente pregunta
+
+# Objetos fijos: 1 catálogo, 2 árbol de páginas, 3-5 fuentes, 6 info. Luego, por página, (página, contenido)
+_CATALOG, _PAGES, _INFO = 1, 2, 6
+_FIRST_PAGE_OBJECT = 7
+
+_CHUNK_BYTES = 64 * 1024
+
+
+def _string_width():
+    # ReportLab se importa con el primer dossier, como en generador_pdf
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    return stringWidth
+
+
+def _escape(text: str) -> bytes:
+    """Texto -> cadena literal de PDF en WinAnsi (los caracteres que no existen salen como '?')."""
+    data = text.encode("cp1252", errors="replace")
+    return data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def _wrap(text: str, style: tuple, width: float, string_width) -> list:
+    """Parte el texto en líneas que caben en `width`; respeta los saltos de párrafo."""
+    font, size = _FONTS[style[0]], style[1]
+    space = string_width(" ", font, size)
+    lines = []
+    for paragraph in text.replace("\r", "").split("\n"):
+        words = paragraph.split()
+        if not words:
+            if lines and lines[-1]:
+                lines.append("")
+            continue
+        line, line_width = "", 0.0
+        for word in words:
+            word_width = string_width(word, font, size)
+            if word_width > width:
+                # Palabra más ancha que la línea (p. ej. una URL): se corta por caracteres
+                for piece in _split_word(word, font, size, width, string_width):
+                    if line:
+                        lines.append(line)
+                    line, line_width = piece, string_width(piece, font, size)
+                continue
+            if not line:
+                line, line_width = word, word_width
+            elif line_width + space + word_width <= width:
+                line += " " + word
+                line_width += space + word_width
+            else:
+                lines.append(line)
+                line, line_width = word, word_width
+        lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return lines or [""]
+
+
+def _split_word(word: str, font: str, size: float, width: float, string_width) -> list:
+    pieces, piece = [], ""
+    for char in word:
+        if piece and string_width(piece + char, font, size) > width:
+            pieces.append(piece)
+            piece = ""
+        piece += char
+    return pieces + [piece]
+
+
+def _fit(text: str, style: tuple, width: float, string_width) -> str:
+    """Recorta el texto a una línea de `width`, con puntos suspensivos si no cabe."""
+    font, size = _FONTS[style[0]], style[1]
+    text = " ".join(text.split())
+    if string_width(text, font, size) <= width:
+        return text
+    # Estimación proporcional y ajuste fino
+    cut = max(int(len(text) * width / string_width(text, font, size)), 1)
+    while cut > 1 and string_width(text[:cut] + "…", font, size) > width:
+        cut -= 1
+    return text[:cut].rstrip() + "…"
+
+
+def _toc_capacity() -> tuple:
+    """Líneas del índice en la primera página (bajo el título) y en las siguientes."""
+    usable = PAGE_HEIGHT - 2 * MARGIN
+    first = int((usable - _TITLE[2] - 2 * _META[2] - _TOC_HEADING[2] - 12) // _TOC_LINE[2])
+    other = int((usable - _TOC_HEADING[2]) // _TOC_LINE[2])
+    return first, other
+
+
+def _toc_page_count(entries_count: int) -> int:
+    first, other = _toc_capacity()
+    if entries_count <= first:
+        return 1
+    return 1 + math.ceil((entries_count - first) / other)
+
+
+def _layout_body(entries, string_width):
+    """
+    Maqueta las preguntas y respuestas. Genera (página, estilo, x, y, texto, índice)
+    por línea, con página relativa al cuerpo e índice != None en la primera línea
+    de cada pregunta.
+    """
+    page = 0
+    top = PAGE_HEIGHT - MARGIN
+    y = top
+    for index, (question, answer) in enumerate(entries):
+        question_lines = _wrap(f"{index + 1}. {question}", _QUESTION, TEXT_WIDTH, string_width)
+        answer_lines = _wrap(answer, _ANSWER, TEXT_WIDTH, string_width)
+        # La pregunta no se queda sola al pie de una página: con ella, al menos dos líneas de respuesta
+        needed = len(question_lines) * _QUESTION[2] + min(len(answer_lines), 2) * _ANSWER[2]
+        if y != top:
+            y -= _ENTRY_GAP
+            if y - needed < MARGIN:
+                page, y = page + 1, top
+        for i, line in enumerate(question_lines):
+            if y - _QUESTION[2] < MARGIN:
+                page, y = page + 1, top
+            y -= _QUESTION[2]
+            yield page, _QUESTION, MARGIN, y, line, index if i == 0 else None
+        y -= 4
+        for line in answer_lines:
+            if y - _ANSWER[2] < MARGIN:
+                page, y = page + 1, top
+            y -= _ANSWER[2]
+            yield page, _ANSWER, MARGIN, y, line, None
+
+
+def _text_ops(style: tuple, x: float, y: float, text: str) -> bytes:
+    return b"/%s %g Tf 1 0 0 1 %.2f %.2f Tm (%s) Tj\n" % (style[0].encode(), style[1], x, y, _escape(text))
+
+
+def _footer_ops(page_number: int, total_pages: int, assistant_name: str, string_width) -> bytes:
+    text = f"Dossier generado por {assistant_name} · Página {page_number} de {total_pages}"
+    width = string_width(text, _FONTS[_FOOTER[0]], _FOOTER[1])
+    return b"0.53 g\n" + _text_ops(_FOOTER, (PAGE_WIDTH - width) / 2, FOOTER_Y, text) + b"0 g\n"
+
+
+class _PdfWriter:
+    """Escribe objetos con numeración fijada de antemano y recuerda su posición para la xref."""
+
+    def __init__(self):
+        self.offsets = array("Q", [0])  # El objeto 0 es la cabeza de la lista de libres
+        self.position = 0
+        self.buffer = bytearray()
+
+    def reserve(self, object_count: int) -> None:
+        missing = object_count + 1 - len(self.offsets)
+        if missing > 0:
+            self.offsets.extend(array("Q", bytes(8 * missing)))
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        self.position += len(data)
+
+    def write_object(self, number: int, body: bytes) -> None:
+        self.offsets[number] = self.position
+        self.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    def write_stream(self, number: int, content: bytes) -> None:
+        compressed = zlib.compress(content, 6)
+        self.write_object(number, b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(compressed)
+                          + compressed + b"\nendstream")
+
+    def take(self, minimum: int = 0) -> bytes:
+        """Bytes acumulados si superan `minimum` (b'' si no)."""
+        if len(self.buffer) < max(minimum, 1):
+            return b""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def finish(self) -> None:
+        xref_position = self.position
+        count = len(self.offsets)
+        self.write(b"xref\n0 %d\n0000000000 65535 f \n" % count)
+        for number in range(1, count):
+            self.write(b"%010d 00000 n \n" % self.offsets[number])
+        self.write(b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                   % (count, _CATALOG, _INFO, xref_position))
+
+
+def _page_object(page_index: int) -> int:
+    return _FIRST_PAGE_OBJECT + 2 * page_index
+
+
+def _pdf_date(moment: datetime) -> bytes:
+    return moment.strftime("D:%Y%m%d%H%M%S").encode()
+
+
+def iter_dossier_pdf(entries, title: str, assistant_name: str, chunk_bytes: int = _CHUNK_BYTES):
+    """
+    Genera el PDF del dossier por bloques de unos `chunk_bytes` bytes.
+    `entries` es una secuencia de pares (pregunta, respuesta).
+    """
+    start = time.perf_counter()
+    failed = True
+    try:
+        string_width = _string_width()
+        now = datetime.now()
+
+        # La cabecera no depende de la maquetación: sale antes de la primera pasada
+        writer = _PdfWriter()
+        writer.reserve(_INFO)
+        writer.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        for number, name in enumerate(_FONTS.values(), 3):
+            writer.write_object(number, b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>"
+                                % name.encode())
+        writer.write_object(_INFO, b"<< /Title (%s) /Producer (%s) /CreationDate (%s) >>"
+                            % (_escape(title), _escape(assistant_name), _pdf_date(now)))
+        yield writer.take()
+
+        # Primera pasada: página (del cuerpo) en la que empieza cada pregunta
+        entry_pages = array("L")
+        body_pages = 0
+        for page, _style, _x, _y, _text, index in _layout_body(entries, string_width):
+            if index is not None:
+                entry_pages.append(page)
+            body_pages = page + 1
+        toc_pages = _toc_page_count(len(entries))
+        total_pages = toc_pages + body_pages
+
+        writer.reserve(_FIRST_PAGE_OBJECT - 1 + 2 * total_pages)
+        resources = b"/Resources << /Font << /F1 3 0 R /F2 4 0 R /F3 5 0 R >> >>"
+
+        def write_page(page_index: int, content: bytes, annotations: bytes = b"") -> None:
+            content += _footer_ops(page_index + 1, total_pages, assistant_name, string_width)
+            annots = b" /Annots [" + annotations + b"]" if annotations else b""
+            writer.write_object(_page_object(page_index),
+                                b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] %s /Contents %d 0 R%s >>"
+                                % (_PAGES, PAGE_WIDTH, PAGE_HEIGHT, resources, _page_object(page_index) + 1, annots))
+            writer.write_stream(_page_object(page_index) + 1, b"BT\n" + content + b"ET\n")
+
+        # Índice: una línea por pregunta, enlazada a su página
+        first_capacity, other_capacity = _toc_capacity()
+        index = 0
+        for toc_page in range(toc_pages):
+            y = PAGE_HEIGHT - MARGIN
+            content = bytearray()
+            annotations = bytearray()
+            if toc_page == 0:
+                y -= _TITLE[2]
+                content += _text_ops(_TITLE, MARGIN, y, _fit(title, _TITLE, TEXT_WIDTH, string_width))
+                y -= _META[2]
+                content += _text_ops(_META, MARGIN, y, f"{len(entries)} preguntas · {now.strftime('%Y-%m-%d %H:%M')}")
+                y -= _META[2] + 12
+            y -= _TOC_HEADING[2]
+            content += _text_ops(_TOC_HEADING, MARGIN, y, "Índice" if toc_page == 0 else "Índice (continuación)")
+            capacity = first_capacity if toc_page == 0 else other_capacity
+            for _ in range(capacity):
+                if index >= len(entries):
+                    break
+                y -= _TOC_LINE[2]
+                target_page = toc_pages + entry_pages[index]
+                number = str(target_page + 1)
+                number_width = string_width(number, _FONTS[_TOC_LINE[0]], _TOC_LINE[1])
+                label = _fit(f"{index + 1}. {entries[index][0]}", _TOC_LINE, TEXT_WIDTH - number_width - 12, string_width)
+                content += _text_ops(_TOC_LINE, MARGIN, y, label)
+                content += _text_ops(_TOC_LINE, PAGE_WIDTH - MARGIN - number_width, y, number)
+                annotations += (b"<< /Type /Annot /Subtype /Link /Border [0 0 0] /Rect [%d %.2f %d %.2f] "
+                                b"/Dest [%d 0 R /Fit] >> "
+                                % (MARGIN, y - 3, PAGE_WIDTH - MARGIN, y + _TOC_LINE[1], _page_object(target_page)))
+                index += 1
+            write_page(toc_page, bytes(content), bytes(annotations))
+            data = writer.take(chunk_bytes)
+            if data:
+                yield data
+
+        # Segunda pasada: el cuerpo, página a página
+        current_page = 0
+        content = bytearray()
+        for page, style, x, y, text, _index in _layout_body(entries, string_width):
+            if page != current_page:
+                write_page(toc_pages + current_page, bytes(content))
+                content.clear()
+                current_page = page
+                data = writer.take(chunk_bytes)
+                if data:
+                    yield data
+            content += _text_ops(style, x, y, text)
+        if body_pages:
+            write_page(toc_pages + current_page, bytes(content))
+
+        kids = b" ".join(b"%d 0 R" % _page_object(i) for i in range(total_pages))
+        writer.write_object(_PAGES, b"<< /Type /Pages /Count %d /Kids [%s] >>" % (total_pages, kids))
+        writer.write_object(_CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % _PAGES)
+        writer.finish()
+        yield writer.take()
+        failed = False
+    finally:
+        record_stage("pdf_dossier", start, time.perf_counter(), failed)
+
+
+def entries_from_history(history: list) -> list:
+    """
+    Pares (pregunta, respuesta) de un historial de sesión ({"role", "parts"} por turno).
+    El resumen de una compactación y su "Entendido." no son una pregunta del usuario y se omiten.
+    """
+    pairs = []
+    question = None
+    for turn in history:
+        text = turn["parts"][0]
+        if is_summary_turn(turn):
+            question = None
+        elif turn["role"] == "user":
+            question = text
+        elif question is not None:
+            pairs.append((question, text))
+            question = None
+    return pairs
+
+
+def entries_from_batch(input_path: str, output_path: str) -> list:
+    """Pares (pregunta, respuesta) de un trabajo de lotes.py, en el orden del fichero de entrada."""
+    from lotes import read_items
+
+    answers = {}
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not record.get("error"):
+                answers[record["id"]] = record["response"]
+    return [(item["message"], answers[item["id"]]) for item in read_items(input_path) if item["id"] in answers]
+
+
+# --- Benchmark ---
+
+class _SyntheticEntries:
+    """Secuencia de preguntas generadas al vuelo, para que la entrada no cuente en la memoria medida."""
+
+    _ANSWER = ("Según las crónicas de la Tierra Media, {topic} ocupa un lugar destacado en la historia de Arda. "
+               "Las fuentes principales son El Hobbit, El Señor de los Anillos y El Silmarillion. "
+               "Los Eldar conservaron memoria de estos hechos en sus cantares y anales.\n"
+               "Tolkien revisó esta parte de su legendarium en varias ocasiones a lo largo de su vida. ") * 2
+
+    def __init__(self, count: int):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        topic = f"el personaje número {index + 1}"
+        return f"¿Qué papel tiene {topic} en la Guerra del Anillo?", self._ANSWER.format(topic=topic)
+
+
+def _buffered_dossier(entries, title: str, assistant_name: str) -> bytes:
+    """Referencia: el mismo contenido con platypus en un BytesIO, como /generate-pdf."""
+    import io
+    from xml.sax.saxutils import escape
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from generador_pdf import get_styles
+
+    styles = get_styles()
+    buffer = io.BytesIO()
+    story = [Paragraph(escape(title), styles['TitleStyle'])]
+    for index, (question, answer) in enumerate(entries):
+        story.append(Paragraph(f"{index + 1}. {escape(question)}", styles['CustomHeading2']))
+        story.append(Paragraph(escape(answer).replace("\n", "<br/>"), styles['CustomBodyText']))
+        story.append(Spacer(1, 12))
+    SimpleDocTemplate(buffer, pagesize=letter).build(story)
+    return buffer.getvalue()
+
+
+def _measure_one(count: int, mode: str) -> dict:
+    """Se ejecuta en un proceso nuevo: el pico de RSS (ru_maxrss) es por proceso."""
+    _string_width()
+    import generador_pdf
+    generador_pdf.get_styles()
+    entries = _SyntheticEntries(count)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    # El primer bloque es solo la cabecera del PDF, escrita antes de la maquetación:
+    # se mide hasta que sale el primer objeto de página
+    first_page = None
+    size = 0
+    if mode == "streaming":
+        for chunk in iter_dossier_pdf(entries, "Dossier de prueba", "Elendur"):
+            size += len(chunk)
+            if first_page is None and b"/Type /Page " in chunk:
+                first_page = time.perf_counter() - start
+    else:
+        size = len(_buffered_dossier(entries, "Dossier de prueba", "Elendur"))
+        first_page = time.perf_counter() - start
+    total = time.perf_counter() - start
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "entries": count,
+        "mode": mode,
+        "first_page_seconds": first_page,
+        "total_seconds": total,
+        "bytes": size,
+        "peak_rss_mb": rss_peak / 1024,
+        "peak_rss_growth_mb": (rss_peak - rss_before) / 1024,
+    }
+
+
+def run_benchmark(sizes=(10, 1000, 10000), modes=("streaming", "buffered")) -> list:
+    results = []
+    for count in sizes:
+        for mode in modes:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "_measure", str(count), mode],
+                                    capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "_measure":
+        print(json.dumps(_measure_one(int(sys.argv[2]), sys.argv[3])))
+    elif len(sys.argv) == 4:
+        pairs = entries_from_batch(sys.argv[1], sys.argv[2])
+        with open(sys.argv[3], "wb") as f:
+            for chunk in iter_dossier_pdf(pairs, "Dossier de estudio", "Elendur"):
+                f.write(chunk)
+        print(f"{len(pairs)} preguntas escritas en {sys.argv[3]}.")
+    else:
+        for r in run_benchmark():
+            label = "streaming" if r["mode"] == "streaming" else "en memoria (platypus)"
+            print(f"{r['entries']:>6} preguntas, {label}: primera página {r['first_page_seconds'] * 1000:.0f} ms, "
+                  f"total {r['total_seconds']:.2f} s, {r['bytes'] / 2**20:.1f} MiB, "
+                  f"pico RSS {r['peak_rss_mb']:.0f} MB (+{r['peak_rss_growth_mb']:.0f} MB)")
@@ -0,0 +1,307 @@
+"""
+Enrutado entre varios modelos con nivel rápido/barato y nivel grande.
+
+- La clasificación (YES/NO) y las preguntas sencillas van al nivel rápido; las
+  largas o de corte académico (comparaciones, manuscritos, etimologías...) van
+  al grande. La decisión usa una estimación local de complejidad, sin llamadas.
+- Cada modelo lleva su salud: latencia media exponencial (EWMA), tasa de
+  errores (EWMA) y un tiempo de enfriamiento tras un 429 o una racha de
+  errores. Dentro de cada nivel se sigue el orden configurado, pero los modelos
+  degradados (muchos errores o latencia alta) pasan detrás; pasado el tiempo de
+  enfriamiento se vuelven a probar, para que se recuperen.
+- Si un modelo falla, agota su tiempo o responde 429, la llamada pasa al
+  siguiente candidato (primero los del mismo nivel, después los del otro).
+
+Con un solo modelo configurado el comportamiento es el de siempre.
+
+Ejecutar `python enrutador_modelos.py` simula tráfico contra modelos falsos
+(modelo_falso.py): un nivel rápido y otro grande, con el grande saturado a
+mitad de la prueba, y muestra el reparto de llamadas, la salud y los fallos.
+"""
+import asyncio
+import re
+import time
+
+from clasificador_local import normalize_text
+from control_admision import is_rate_limit_error
+
+TIER_FAST = "fast"
+TIER_LARGE = "large"
+
+# Indicios (ya normalizados) de una pregunta académica que merece el modelo grande
+_SCHOLARLY_RE = re.compile(
+    r"\b(compar\w*|diferenci\w*|analiz\w*|analisis|evoluci\w*|origen\w*|etimolog\w*|manuscrit\w*|"
+    r"borrador\w*|version\w*|cronolog\w*|influenci\w*|contradic\w*|revis\w*|simbolism\w*|"
+    r"tematic\w*|fuentes|canon\w*|linguistic\w*|quenya|sindarin|gramatic\w*|"
+    r"por que|relacion\w*|implicacion\w*|interpret\w*|"
+    r"compare|difference\w*|analy\w*|evolution|etymolog\w*|manuscript\w*|draft\w*|"
+    r"chronolog\w*|influence\w*|why)\b"
+)
+
+
+def estimate_complexity(message: str) -> float:
+    """
+    Complejidad estimada de una pregunta, entre 0 y 1, a partir de su longitud,
+    los indicios académicos y el número de preguntas encadenadas. Es local y
+    cuesta unos microsegundos por pregunta.
+    """
+    normalized = normalize_text(message)
+    words = normalized.count(" ") + 1 if normalized else 0
+    markers = len(_SCHOLARLY_RE.findall(normalized))
+    questions = max(message.count("?"), 1)
+    return min(1.0, words / 60 + 0.3 * markers + 0.2 * (questions - 1))
+
+
+class ModelHealth:
+    """Salud de un modelo: latencia y tasa de errores como medias exponenciales."""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latency_ewma = None
+        self.error_ewma = 0.0
+        self.cooldown_until = 0.0
+        self.updated_at = 0.0  # Última observación (time.monotonic)
+        self.stats = {"calls": 0, "errors": 0, "rate_limited": 0, "timeouts": 0}
+
+    def record_success(self, latency_seconds: float) -> None:
+        self.stats["calls"] += 1
+        self.updated_at = time.monotonic()
+        if self.latency_ewma is None:
+            self.latency_ewma = latency_seconds
+        else:
+            self.latency_ewma += self.alpha * (latency_seconds - self.latency_ewma)
+        self.error_ewma *= 1 - self.alpha
+
+    def record_failure(self, kind: str, latency_seconds: float = None) -> None:
+        """`kind`: "errors", "rate_limited" o "timeouts"."""
+        self.stats["calls"] += 1
+        self.stats[kind] += 1
+        self.updated_at = time.monotonic()
+        self.error_ewma += self.alpha * (1 - self.error_ewma)
+        if latency_seconds is not None and kind == "timeouts":
+            # Un timeout es al menos tan lento como el tiempo agotado
+            if self.latency_ewma is None:
+                self.latency_ewma = latency_seconds
+            else:
+                self.latency_ewma += self.alpha * (latency_seconds - self.latency_ewma)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "latency_ewma_seconds": round(self.latency_ewma, 4) if self.latency_ewma is not None else None,
+            "error_rate_ewma": round(self.error_ewma, 4),
+            "cooling_down_seconds": round(max(self.cooldown_until - time.monotonic(), 0), 1),
+        }
+
+
+class RoutedModel:
+    """Un modelo con nombre, nivel y salud."""
+
+    def __init__(self, name: str, tier: str, backend, alpha: float = 0.2):
+        self.name = name
+        self.tier = tier
+        self.backend = backend
+        self.health = ModelHealth(alpha)
+
+
+class ModelRouter:
+    """
+    Elige el orden de los modelos para cada llamada y pasa al siguiente si uno falla.
+    `fast` y `large` son listas de RoutedModel; cualquiera de las dos puede estar vacía.
+    """
+
+    def __init__(self, fast: list, large: list, complexity_threshold: float = 0.3,
+                 attempt_timeout_seconds: float = 20, slow_seconds: float = 10,
+                 error_threshold: float = 0.5, cooldown_seconds: float = 30):
+        if not fast and not large:
+            raise ValueError("El enrutador necesita al menos un modelo.")
+        self.fast = fast
+        self.large = large
+        self.complexity_threshold = complexity_threshold
+        self.attempt_timeout_seconds = attempt_timeout_seconds
+        self.slow_seconds = slow_seconds
+        self.error_threshold = error_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.stats = {"routed_fast": 0, "routed_large": 0, "failovers": 0, "exhausted": 0}
+
+    @property
+    def models(self) -> list:
+        return self.fast + self.large
+
+    def preferred_tier(self, purpose: str, message: str = "") -> str:
+        """Nivel preferido: clasificación y preguntas sencillas al rápido, el resto al grande."""
+        if purpose == "classification":
+            return TIER_FAST
+        return TIER_LARGE if estimate_complexity(message) >= self.complexity_threshold else TIER_FAST
+
+    def _rank(self, candidate: RoutedModel, position: int, now: float) -> tuple:
+        """
+        Orden dentro de un nivel: el configurado, salvo que un modelo esté degradado
+        (tasa de errores o latencia por encima del umbral); los degradados van detrás,
+        del más sano al menos sano. Un modelo degradado sin observaciones recientes
+        vuelve a su puesto para que una llamada compruebe si se ha recuperado.
+        """
+        health = candidate.health
+        degraded = (health.error_ewma >= self.error_threshold or (
+            health.latency_ewma is not None and health.latency_ewma >= self.slow_seconds)
+        ) and now - health.updated_at < self.cooldown_seconds
+        if not degraded:
+            return (False, position, 0.0, 0.0)
+        return (True, 0, health.error_ewma, health.latency_ewma or 0.0)
+
+    def _sorted_tier(self, tier_models: list, now: float) -> list:
+        ranked = sorted(enumerate(tier_models), key=lambda item: self._rank(item[1], item[0], now))
+        return [candidate for _position, candidate in ranked]
+
+    def candidates(self, purpose: str, message: str = "") -> list:
+        """Modelos en el orden en que se probarán."""
+        now = time.monotonic()
+        tier = self.preferred_tier(purpose, message)
+        first, second = (self.fast, self.large) if tier == TIER_FAST else (self.large, self.fast)
+        ordered = self._sorted_tier(first, now) + self._sorted_tier(second, now)
+        # Un modelo del nivel preferido que se está enfriando va detrás de los sanos del otro nivel
+        healthy = [c for c in ordered if c.health.cooldown_until <= now]
+        cooling = sorted((c for c in ordered if c.health.cooldown_until > now), key=lambda c: c.health.cooldown_until)
+        return healthy + cooling
+
+    def _on_failure(self, candidate: RoutedModel, error: Exception, elapsed: float) -> None:
+        health = candidate.health
+        if isinstance(error, asyncio.TimeoutError):
+            health.record_failure("timeouts", elapsed)
+        elif is_rate_limit_error(error):
+            health.record_failure("rate_limited")
+            health.cooldown_until = time.monotonic() + self.cooldown_seconds
+        else:
+            health.record_failure("errors")
+        if health.error_ewma >= self.error_threshold and health.stats["calls"] >= 5:
+            health.cooldown_until = max(health.cooldown_until, time.monotonic() + self.cooldown_seconds)
+
+    async def call(self, purpose: str, message: str, fn):
+        """
+        Llama a `fn(backend)` con el mejor candidato y, si falla, con los siguientes.
+        Si fallan todos, propaga el último error (un 429 sigue siendo un 429).
+        """
+        candidates = self.candidates(purpose, message)
+        self.stats["routed_fast" if candidates[0].tier == TIER_FAST else "routed_large"] += 1
+        last_error = None
+        for attempt, candidate in enumerate(candidates):
+            if attempt:
+                self.stats["failovers"] += 1
+            is_last = attempt == len(candidates) - 1
+            start = time.perf_counter()
+            try:
+                if is_last:
+                    # El último candidato no tiene a quién pasar: que lo limite el tiempo de la petición
+                    result = await fn(candidate.backend)
+                else:
+                    result = await asyncio.wait_for(fn(candidate.backend), timeout=self.attempt_timeout_seconds)
+            except Exception as e:
+                self._on_failure(candidate, e, time.perf_counter() - start)
+                print(f"Modelo '{candidate.name}' falló ({type(e).__name__}: {e}); "
+                      f"{'sin más candidatos' if is_last else 'se pasa al siguiente'}.")
+                last_error = e
+                continue
+            candidate.health.record_success(time.perf_counter() - start)
+            return result
+        self.stats["exhausted"] += 1
+        raise last_error
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "models": {c.name: {"tier": c.tier, **c.health.snapshot()} for c in self.models},
+        }
+
+
+def render_router_metrics(prefix: str, router: ModelRouter) -> str:
+    """Estado del enrutador en formato de Prometheus, con una etiqueta `model` por modelo."""
+    from metricas import render_stats
+
+    lines = [render_stats(prefix, router.stats).rstrip("\n")]
+    per_model = {
+        "latency_ewma_seconds": ("gauge", "Latencia media exponencial de las llamadas correctas."),
+        "error_rate_ewma": ("gauge", "Tasa de errores (media exponencial)."),
+        "cooling_down_seconds": ("gauge", "Segundos que faltan para volver a usar el modelo tras un 429 o una racha de errores."),
+        "calls": ("counter", "Llamadas al modelo."),
+        "rate_limited": ("counter", "Llamadas rechazadas con 429."),
+        "timeouts": ("counter", "Llamadas que agotaron su tiempo."),
+        "errors": ("counter", "Llamadas con otros errores."),
+    }
+    snapshots = [(c.name, c.tier, c.health.snapshot()) for c in router.models]
+    for key, (metric_type, help_text) in per_model.items():
+        name = f"{prefix}_model_{key}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for model_name, tier, snapshot in snapshots:
+            if snapshot[key] is not None:
+                lines.append(f'{name}{{model="{model_name}",tier="{tier}"}} {snapshot[key]}')
+    return "\n".join(lines) + "\n"
+
+
+async def run_simulation(requests: int = 400, concurrency: int = 20) -> dict:
+    """Tráfico mixto contra modelos falsos; el modelo grande principal se satura a mitad."""
+    from modelo_falso import FakeGenerativeModel
+
+    fast = FakeGenerativeModel("rapido", latency="lognormal:0.05:0.3", classification_latency="fixed:0.01")
+    large = FakeGenerativeModel("grande", latency="lognormal:0.3:0.3", seed=1)
+    backup = FakeGenerativeModel("grande-respaldo", latency="lognormal:0.4:0.3", seed=2)
+    router = ModelRouter(
+        fast=[RoutedModel("rapido", TIER_FAST, fast)],
+        large=[RoutedModel("grande", TIER_LARGE, large), RoutedModel("grande-respaldo", TIER_LARGE, backup)],
+        attempt_timeout_seconds=2, cooldown_seconds=1,
+    )
+    questions = [
+        "¿Quién es Gandalf?",
+        "Hola",
+        "Compara la evolución de Sauron en los manuscritos y borradores con su papel en El Silmarillion",
+        "¿Cuál es el origen y la etimología del nombre Mithrandir en quenya y sindarin?",
+        "¿Dónde está Rivendel?",
+    ]
+    answered = failed = 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal answered, failed
+        while not queue.empty():
+            i = queue.get_nowait()
+            if i == requests // 2:
+                # A mitad de la prueba, el modelo grande principal empieza a devolver 429
+                large.options["rate_limit_rate"] = 0.9
+            question = questions[i % len(questions)]
+            purpose = "classification" if i % 3 == 0 else "answer"
+            prompt = f"{question} (YES/NO)" if purpose == "classification" else question
+            try:
+                await router.call(purpose, question,
+                                  lambda backend: backend.start_chat(history=[]).send_message_async(prompt))
+                answered += 1
+            except Exception:
+                failed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {
+        "answered": answered,
+        "failed": failed,
+        "seconds": time.perf_counter() - start,
+        "router": router.get_stats(),
+        "backend_calls": {m.model_name: m.stats["calls"] for m in (fast, large, backup)},
+    }
+
+
+if __name__ == "__main__":
+    for question in ("¿Quién es Gandalf?",
+                     "Compara la evolución de Sauron en los manuscritos con El Silmarillion"):
+        start = time.perf_counter()
+        for _ in range(10000):
+            estimate_complexity(question)
+        print(f"Complejidad {estimate_complexity(question):.2f} ({(time.perf_counter() - start) / 10000 * 1e6:.1f} µs): {question}")
+    results = asyncio.run(run_simulation())
+    print(f"Respondidas {results['answered']}, fallidas {results['failed']} en {results['seconds']:.2f}s")
+    print(f"Llamadas por modelo: {results['backend_calls']}")
+    router_stats = results["router"]
+    print(f"Enrutado: rápido {router_stats['routed_fast']}, grande {router_stats['routed_large']}, "
+          f"cambios de modelo {router_stats['failovers']}, sin candidatos {router_stats['exhausted']}")
+    for name, health in router_stats["models"].items():
+        print(f"  {name}: {health}")
@@ -0,0 +1,265 @@
+"""
+Generación de PDF fuera del event loop.
+
+ReportLab es síncrono y costoso con respuestas largas, así que `doc.build` se
+ejecuta en un pool de procesos (o en un hilo si PDF_WORKERS=0). ReportLab se
+importa con el primer PDF, no al arrancar. La hoja de estilos se construye una
+sola vez por proceso y los PDF ya generados se
+guardan en una caché direccionada por contenido, con clave (pregunta, respuesta).
+La caché guarda el PDF con una marca en lugar de la fecha y la fecha actual se
+escribe sobre la marca al servirlo, así que un acierto nunca devuelve una fecha
+pasada. Si un worker muere, el pool roto se reemplaza por uno nuevo.
+
+Ejecutar `python generador_pdf.py` compara la latencia p50/p99 de peticiones
+simuladas de /chat mientras se generan PDF en el event loop (antes) y en el
+pool de procesos (después).
+"""
+import asyncio
+import hashlib
+import io
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from metricas import stage
+
+# Formato de la fecha impresa en el PDF
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Marca que ocupa el lugar de la fecha en los PDF de la caché. Tiene la misma
+# longitud que la fecha, así que sustituirla no mueve los offsets de la tabla xref.
+TIMESTAMP_PLACEHOLDER = "XXXX-XX-XX XX:XX:XX"
+
+# Hoja de estilos del proceso actual (se construye una sola vez)
+_styles = None
+
+
+def get_styles():
+    """Devuelve la hoja de estilos con los estilos personalizados, creándola la primera vez."""
+    global _styles
+    if _styles is not None:
+        return _styles
+
+    # ReportLab se importa al generar el primer PDF, no al arrancar la app
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.enums import TA_CENTER, TA_LEFT
+
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name='TitleStyle',
+                              parent=styles['h1'],
+                              fontSize=20,
+                              leading=24,
+                              alignment=TA_CENTER,
+                              spaceAfter=20))
+    # 'CustomHeading2' y 'CustomBodyText' evitan colisiones con los estilos existentes
+    styles.add(ParagraphStyle(name='CustomHeading2',
+                              parent=styles['h2'],
+                              fontSize=14,
+                              leading=18,
+                              spaceAfter=10,
+                              spaceBefore=20,
+                              alignment=TA_LEFT))
+    styles.add(ParagraphStyle(name='CustomBodyText',
+                              parent=styles['Normal'],
+                              fontSize=12,
+                              leading=14,
+                              spaceAfter=10,
+                              alignment=TA_LEFT))
+    styles.add(ParagraphStyle(name='Footer',
+                              parent=styles['Normal'],
+                              fontSize=10,
+                              leading=12,
+                              alignment=TA_CENTER,
+                              textColor='#888888'))
+    _styles = styles
+    return styles
+
+
+def render_pdf(question: str, answer: str, assistant_name: str, generated_at: str = None) -> bytes:
+    """
+    Genera el PDF de una consulta (bloqueante) y devuelve sus bytes.
+    `generated_at` es la fecha impresa; por defecto, la hora actual. Las páginas
+    no se comprimen para que la fecha se pueda reescribir en los bytes (stamp_pdf).
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from reportlab.lib.units import inch
+
+    styles = get_styles()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter, pageCompression=0)
+
+    story = []
+
+    # Título
+    story.append(Paragraph(f"Informe de Consulta con {assistant_name}", styles['TitleStyle']))
+    story.append(Spacer(1, 0.2 * inch))
+
+    # Información de la consulta
+    if generated_at is None:
+        generated_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+    story.append(Paragraph("<b>Fecha y Hora:</b> " + generated_at, styles['CustomBodyText']))
+    story.append(Spacer(1, 0.1 * inch))
+
+    # Pregunta del Usuario
+    story.append(Paragraph("<b>Pregunta del Usuario:</b>", styles['CustomHeading2']))
+    story.append(Paragraph(question, styles['CustomBodyText']))
+    story.append(Spacer(1, 0.3 * inch))
+
+    # Respuesta del asistente
+    story.append(Paragraph(f"<b>Respuesta de {assistant_name}:</b>", styles['CustomHeading2']))
+    story.append(Paragraph(answer, styles['CustomBodyText']))
+    story.append(Spacer(1, 0.5 * inch))
+
+    # Pie de página
+    story.append(Paragraph(f"Generado por {assistant_name}, tu especialista en la obra de J.R.R. Tolkien.", styles['Footer']))
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+def stamp_pdf(template: bytes, generated_at: str) -> bytes:
+    """Escribe la fecha sobre la marca de un PDF generado con TIMESTAMP_PLACEHOLDER."""
+    # La fecha va antes que la pregunta y la respuesta: basta con la primera aparición
+    return template.replace(TIMESTAMP_PLACEHOLDER.encode("ascii"), generated_at.encode("ascii"), 1)
+
+
+class PdfRenderer:
+    """
+    Genera PDF en un pool de procesos (workers > 0) o en un hilo (workers = 0),
+    con una caché LRU de PDF ya generados limitada en bytes.
+    """
+
+    def __init__(self, assistant_name: str, workers: int = 2, cache_max_bytes: int = 32 * 2**20):
+        self.assistant_name = assistant_name
+        self.workers = workers
+        self.cache_max_bytes = cache_max_bytes
+        self._executor = None
+        self._cache = OrderedDict()  # hash del contenido -> bytes del PDF con la marca de fecha
+        self._cache_bytes = 0
+        self.stats = {"rendered": 0, "cache_hits": 0, "evictions": 0, "pool_restarts": 0}
+
+    def start(self) -> None:
+        if self.workers > 0:
+            # Cada proceso construye su hoja de estilos al arrancar
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=get_styles)
+
+    def _restart_pool(self, broken) -> None:
+        """Sustituye un pool roto (un worker murió) por uno nuevo."""
+        # Otra petición puede haberlo reemplazado ya mientras esta esperaba
+        if self._executor is not broken:
+            return
+        print("Pool de PDF roto (un worker terminó de forma inesperada). Recreándolo.")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.stats["pool_restarts"] += 1
+        self.start()
+
+    def stop(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @staticmethod
+    def content_key(question: str, answer: str) -> str:
+        return hashlib.sha256(f"{question}\x1f{answer}".encode("utf-8")).hexdigest()
+
+    async def render(self, question: str, answer: str) -> bytes:
+        key = self.content_key(question, answer)
+        template = self._cache.get(key)
+        if template is not None:
+            self._cache.move_to_end(key)
+            self.stats["cache_hits"] += 1
+        else:
+            args = (question, answer, self.assistant_name, TIMESTAMP_PLACEHOLDER)
+            with stage("pdf_build"):
+                if self._executor is not None:
+                    template = await self._render_in_pool(args)
+                else:
+                    template = await asyncio.to_thread(render_pdf, *args)
+            self.stats["rendered"] += 1
+            self._store(key, template)
+        return stamp_pdf(template, datetime.now().strftime(TIMESTAMP_FORMAT))
+
+    async def _render_in_pool(self, args: tuple) -> bytes:
+        """Genera el PDF en el pool; si está roto, lo recrea y reintenta una vez."""
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, render_pdf, *args)
+        except BrokenProcessPool:
+            self._restart_pool(executor)
+        return await loop.run_in_executor(self._executor, render_pdf, *args)
+
+    def _store(self, key: str, pdf: bytes) -> None:
+        if len(pdf) > self.cache_max_bytes:
+            return
+        self._cache[key] = pdf
+        self._cache_bytes += len(pdf)
+        while self._cache_bytes > self.cache_max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "cache_entries": len(self._cache),
+            "cache_bytes": self._cache_bytes,
+        }
+
+
+async def _simulated_chat_latencies(requests: int, upstream_seconds: float = 0.05) -> list:
+    """Latencias de peticiones /chat simuladas (una espera de red por petición)."""
+    latencies = []
+
+    async def one():
+        start = time.perf_counter()
+        await asyncio.sleep(upstream_seconds)
+        latencies.append(time.perf_counter() - start)
+
+    for _ in range(requests // 10):
+        await asyncio.gather(*(one() for _ in range(10)))
+    return latencies
+
+
+async def run_benchmark(pdf_requests: int = 20, chat_requests: int = 200, workers: int = 2) -> dict:
+    """Latencia de /chat simulado mientras se generan PDF en el event loop o en el pool."""
+    answer = "Gandalf, llamado Mithrandir por los elfos, es uno de los Istari. " * 400
+
+    def percentiles(latencies):
+        latencies = sorted(latencies)
+        return {
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        }
+
+    # Antes: doc.build en el event loop, como hacía la ruta original
+    async def inline_pdfs():
+        for i in range(pdf_requests):
+            render_pdf(f"Pregunta {i}", answer, "Elendur")
+            await asyncio.sleep(0)
+
+    pdf_task = asyncio.create_task(inline_pdfs())
+    before = await _simulated_chat_latencies(chat_requests)
+    await pdf_task
+
+    # Después: pool de procesos (preguntas distintas para no usar la caché)
+    renderer = PdfRenderer("Elendur", workers=workers)
+    renderer.start()
+    try:
+        await renderer.render("calentamiento", "calentamiento")
+        pdf_task = asyncio.gather(*(renderer.render(f"Pregunta {i}", answer) for i in range(pdf_requests)))
+        after = await _simulated_chat_latencies(chat_requests)
+        await pdf_task
+    finally:
+        renderer.stop()
+
+    return {"before": percentiles(before), "after": percentiles(after)}
+
+
+if __name__ == "__main__":
+    results = asyncio.run(run_benchmark())
+    for label, name in (("before", "PDF en el event loop"), ("after", "PDF en pool de procesos")):
+        print(f"{name}: /chat p50 {results[label]['p50_ms']:.1f} ms, p99 {results[label]['p99_ms']:.1f} ms")
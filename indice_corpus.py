@@ -0,0 +1,282 @@
+"""
+Recuperación local sobre un corpus de referencia de Tolkien (BM25).
+
+El comando `ingest` trocea un directorio de textos (.txt y .md) en pasajes y
+construye un índice invertido en disco:
+
+- vocab.json: término -> [desplazamiento, longitud] en los arrays de postings.
+- postings.npy / tfs.npy: ids de pasaje y frecuencias, que se cargan con mmap.
+- doc_lengths.npy: longitud (en términos) de cada pasaje.
+- passages.jsonl: texto de cada pasaje y, para glosarios, el término definido.
+- meta.json: número de pasajes, longitud media y parámetros de BM25.
+
+Los ficheros cuyo nombre contiene "glosario" o "glossary" se leen línea a línea
+con el formato `Término: definición`; cada entrada es un pasaje y puede
+responder directamente una pregunta del tipo "¿Qué es un Silmaril?" sin
+llamar al modelo (modo solo recuperación).
+
+Uso:
+    python indice_corpus.py ingest <directorio_textos> <directorio_indice>
+    python indice_corpus.py query <directorio_indice> "¿Quién fue Fëanor?"
+    python indice_corpus.py bench
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Optional
+
+import numpy as np
+
+from clasificador_local import normalize_text, STOPWORDS, TOLKIEN_TERMS
+
+# Tamaño de los pasajes (en palabras) y solapamiento entre pasajes consecutivos
+PASSAGE_WORDS = 120
+PASSAGE_OVERLAP = 20
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_GLOSSARY_LINE_RE = re.compile(r"^\s*[-*]?\s*([^:]{1,80}?)\s*[:—–]\s+(.+)$")
+
+
+def tokenize(text: str) -> list:
+    return [token for token in normalize_text(text).split() if token not in STOPWORDS]
+
+
+def _is_glossary(path: str) -> bool:
+    name = os.path.basename(path).lower()
+    return "glosario" in name or "glossary" in name
+
+
+def _chunk_text(text: str, source: str):
+    """Trocea un texto en pasajes de PASSAGE_WORDS palabras con solapamiento."""
+    words = text.split()
+    step = PASSAGE_WORDS - PASSAGE_OVERLAP
+    for start in range(0, max(len(words) - PASSAGE_OVERLAP, 1), step):
+        chunk = " ".join(words[start:start + PASSAGE_WORDS])
+        if chunk:
+            yield {"text": chunk, "source": source}
+
+
+def _read_glossary(text: str, source: str):
+    for line in text.splitlines():
+        match = _GLOSSARY_LINE_RE.match(line)
+        if match:
+            term, definition = match.groups()
+            yield {"text": f"{term}: {definition}", "source": source, "term": term}
+
+
+def iter_passages(corpus_dir: str):
+    for root, _dirs, files in os.walk(corpus_dir):
+        for name in sorted(files):
+            if not name.lower().endswith((".txt", ".md")):
+                continue
+            path = os.path.join(root, name)
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            source = os.path.relpath(path, corpus_dir)
+            if _is_glossary(path):
+                yield from _read_glossary(text, source)
+            else:
+                yield from _chunk_text(text, source)
+
+
+def build_index(passages, index_dir: str) -> dict:
+    """Construye el índice invertido en `index_dir` a partir de un iterable de pasajes."""
+    os.makedirs(index_dir, exist_ok=True)
+    postings = defaultdict(list)  # término -> [(id, tf), ...]
+    doc_lengths = []
+
+    with open(os.path.join(index_dir, "passages.jsonl"), "w", encoding="utf-8") as f:
+        for doc_id, passage in enumerate(passages):
+            tokens = tokenize(passage["text"])
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term].append((doc_id, tf))
+            f.write(json.dumps(passage, ensure_ascii=False) + "\n")
+
+    total = sum(len(entries) for entries in postings.values())
+    doc_ids = np.empty(total, dtype=np.int32)
+    tfs = np.empty(total, dtype=np.float32)
+    vocab = {}
+    offset = 0
+    for term in sorted(postings):
+        entries = np.asarray(postings[term], dtype=np.int64)
+        df = len(entries)
+        vocab[term] = [offset, df]
+        doc_ids[offset:offset + df] = entries[:, 0]
+        tfs[offset:offset + df] = entries[:, 1]
+        offset += df
+
+    np.save(os.path.join(index_dir, "postings.npy"), doc_ids)
+    np.save(os.path.join(index_dir, "tfs.npy"), tfs)
+    np.save(os.path.join(index_dir, "doc_lengths.npy"), np.asarray(doc_lengths, dtype=np.float32))
+    with open(os.path.join(index_dir, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f, ensure_ascii=False)
+    meta = {
+        "passages": len(doc_lengths),
+        "terms": len(vocab),
+        "avg_length": float(np.mean(doc_lengths)) if doc_lengths else 0.0,
+        "k1": BM25_K1,
+        "b": BM25_B,
+    }
+    with open(os.path.join(index_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return meta
+
+
+class CorpusIndex:
+    """Índice BM25 cargado desde disco; los postings se leen con mmap."""
+
+    def __init__(self, index_dir: str):
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "vocab.json"), encoding="utf-8") as f:
+            self.vocab = json.load(f)
+        self.postings = np.load(os.path.join(index_dir, "postings.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(index_dir, "tfs.npy"), mmap_mode="r")
+        self.doc_lengths = np.load(os.path.join(index_dir, "doc_lengths.npy"), mmap_mode="r")
+        with open(os.path.join(index_dir, "passages.jsonl"), encoding="utf-8") as f:
+            self.passages = [json.loads(line) for line in f]
+        self._length_norm = None
+
+    def _norm(self) -> np.ndarray:
+        # k1 * (1 - b + b * dl / avgdl), calculado una vez
+        if self._length_norm is None:
+            k1, b = self.meta["k1"], self.meta["b"]
+            avg = self.meta["avg_length"] or 1.0
+            self._length_norm = k1 * (1 - b + b * np.asarray(self.doc_lengths) / avg)
+        return self._length_norm
+
+    def search(self, query: str, top_k: int = 3) -> list:
+        """Devuelve [(puntuación, pasaje), ...] con los `top_k` pasajes más relevantes."""
+        n = self.meta["passages"]
+        terms = [term for term in set(tokenize(query)) if term in self.vocab]
+        if not terms or n == 0:
+            return []
+        norm = self._norm()
+        k1 = self.meta["k1"]
+        scores = np.zeros(n, dtype=np.float32)
+        for term in terms:
+            offset, df = self.vocab[term]
+            ids = self.postings[offset:offset + df]
+            tf = self.tfs[offset:offset + df]
+            idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+            scores[ids] += idf * tf * (k1 + 1) / (tf + norm[ids])
+
+        top_k = min(top_k, n)
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(float(scores[i]), self.passages[i]) for i in candidates if scores[i] > 0]
+
+    def glossary_answer(self, query: str, min_margin: float = 1.5) -> Optional[dict]:
+        """
+        Respuesta directa desde el glosario si la pregunta solo nombra un término
+        definido ("¿Qué es un Silmaril?") y el mejor pasaje destaca claramente.
+        """
+        query_terms = tokenize(query)
+        if not query_terms or len(query_terms) > 4:
+            return None
+        results = self.search(query, top_k=2)
+        if not results:
+            return None
+        best_score, best = results[0]
+        if "term" not in best:
+            return None
+        term_tokens = tokenize(best["term"])
+        # El término debe cubrir la pregunta (admite plural simple: silmarils -> silmaril)
+        stems = {t.rstrip("s") for t in term_tokens}
+        if not all(t.rstrip("s") in stems for t in query_terms):
+            return None
+        if len(results) > 1 and results[1][0] * min_margin > best_score:
+            return None
+        return best
+
+
+def format_context(results: list, max_chars: int = 3000) -> str:
+    """Bloque de contexto para inyectar en el prompt."""
+    lines = []
+    used = 0
+    for _score, passage in results:
+        line = f"[{passage['source']}] {passage['text']}"
+        if used + len(line) > max_chars:
+            break
+        lines.append(line)
+        used += len(line)
+    return "\n".join(lines)
+
+
+def _directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def run_benchmark(sizes=(1_000, 10_000, 100_000), queries: int = 200) -> list:
+    """Tiempo de construcción, tamaño del índice y latencia de consulta según crece el corpus."""
+    rng = np.random.default_rng(0)
+    vocabulary = sorted(TOLKIEN_TERMS) + [f"palabra{i}" for i in range(20_000)]
+    weights = 1.0 / np.arange(1, len(vocabulary) + 1)  # distribución tipo Zipf
+    weights /= weights.sum()
+    results = []
+    for size in sizes:
+        word_ids = rng.choice(len(vocabulary), size=(size, PASSAGE_WORDS), p=weights)
+        passages = [{"text": " ".join(vocabulary[i] for i in row), "source": "sintetico"} for row in word_ids]
+        del word_ids
+
+        index_dir = tempfile.mkdtemp(prefix="indice_bench_")
+        try:
+            start = time.perf_counter()
+            build_index(passages, index_dir)
+            build_seconds = time.perf_counter() - start
+            index = CorpusIndex(index_dir)
+            query_words = [" ".join(rng.choice(vocabulary[:400], size=3)) for _ in range(queries)]
+            start = time.perf_counter()
+            for query in query_words:
+                index.search(query, top_k=5)
+            query_ms = (time.perf_counter() - start) / queries * 1000
+            results.append({
+                "passages": size,
+                "build_seconds": build_seconds,
+                "index_mb": _directory_size(index_dir) / 2**20,
+                "mean_query_ms": query_ms,
+            })
+        finally:
+            shutil.rmtree(index_dir, ignore_errors=True)
+    return results
+
+
+def main(argv: list) -> int:
+    if len(argv) >= 3 and argv[0] == "ingest":
+        start = time.perf_counter()
+        meta = build_index(iter_passages(argv[1]), argv[2])
+        print(f"Índice creado en '{argv[2]}': {meta['passages']} pasajes, {meta['terms']} términos "
+              f"({time.perf_counter() - start:.1f}s).")
+        return 0
+    if len(argv) >= 3 and argv[0] == "query":
+        index = CorpusIndex(argv[1])
+        start = time.perf_counter()
+        results = index.search(argv[2], top_k=5)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        for score, passage in results:
+            print(f"{score:6.2f}  [{passage['source']}] {passage['text'][:150]}")
+        direct = index.glossary_answer(argv[2])
+        if direct is not None:
+            print(f"Respuesta directa del glosario: {direct['text']}")
+        print(f"({elapsed_ms:.2f} ms)")
+        return 0
+    if argv and argv[0] == "bench":
+        sizes = [int(arg) for arg in argv[1:]] or [1_000, 10_000, 100_000]
+        for result in run_benchmark(sizes):
+            print(f"{result['passages']:>7} pasajes: construcción {result['build_seconds']:.1f}s, "
+                  f"índice {result['index_mb']:.1f} MB, consulta {result['mean_query_ms']:.2f} ms")
+        return 0
+    print(__doc__)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
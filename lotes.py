@@ -0,0 +1,181 @@
+"""
+Preguntas en lote: POST /chat/batch y su cliente de línea de comandos.
+
+El endpoint recibe muchas preguntas a la vez y devuelve NDJSON (una línea por
+pregunta) en orden de finalización:
+
+- Las preguntas idénticas (misma clave de caché) se responden una sola vez.
+- Las que están en la caché o en el glosario se devuelven primero, sin modelo.
+- La clasificación (is_tolkien_related) de las demás se hace en grupos: una
+  única llamada al modelo clasifica hasta BATCH_CLASSIFY_SIZE preguntas, en
+  paralelo con la generación de las respuestas.
+- La generación tiene una concurrencia acotada por petición, además del
+  control de admisión global.
+
+El cliente lee un JSONL (`{"id": ..., "message": ...}` por línea; también vale
+"question"), envía las preguntas por tandas y añade cada resultado al fichero
+de salida según llega. Ese fichero es a la vez el punto de control: al
+relanzar el trabajo se saltan los ids que ya tienen respuesta sin error (si un
+id aparece varias veces, vale la última línea).
+
+Uso:
+    python lotes.py preguntas.jsonl respuestas.ndjson [--url http://127.0.0.1:8000] [--chunk 200]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import urllib.request
+
+
+_CLASSIFICATION_LINE_RE = re.compile(r"^\s*(\d+)\s*[:.)\-]\s*(YES|NO)\b", re.IGNORECASE | re.MULTILINE)
+
+
+def build_classification_prompt(queries: list) -> str:
+    """Prompt que clasifica varias consultas a la vez; cada una va numerada en su línea."""
+    numbered = "\n".join(f"{i}. {' '.join(query.split())}" for i, query in enumerate(queries, 1))
+    return f"""
+    Para cada una de las siguientes consultas de usuario, determina si está directamente relacionada
+    con la historia, personajes, lugares, eventos o mitología de las obras de J.R.R. Tolkien
+    (por ejemplo, El Hobbit, El Señor de los Anillos, El Silmarillion).
+
+    'YES' si la consulta es directamente relevante a Tolkien; 'NO' si es un saludo, agradecimiento,
+    una meta-pregunta sobre el asistente, una pregunta personal o algo no relacionado con Tolkien.
+
+    Responde con una línea por consulta, en el formato "número: YES" o "número: NO", sin nada más.
+
+    Consultas:
+{numbered}
+
+    Clasificación (YES/NO) de cada consulta:
+    """
+
+
+def parse_classification(text: str, count: int) -> list:
+    """Veredictos por posición (True, False o None si el modelo no respondió esa línea)."""
+    verdicts = [None] * count
+    for number, answer in _CLASSIFICATION_LINE_RE.findall(text or ""):
+        index = int(number) - 1
+        if 0 <= index < count:
+            verdicts[index] = answer.upper() == "YES"
+    return verdicts
+
+
+async def classify_batch(queries: list, send, default: bool, timeout_seconds: float) -> list:
+    """
+    Clasifica `queries` con una sola llamada: `send(prompt, max_output_tokens)` debe
+    devolver el texto del modelo. Las consultas sin veredicto reciben `default`.
+    """
+    try:
+        text = await asyncio.wait_for(
+            send(build_classification_prompt(queries), 8 * len(queries) + 10),
+            timeout=timeout_seconds
+        )
+    except Exception as e:
+        print(f"Error durante la clasificación en lote ({len(queries)} consultas): {e}")
+        return [default] * len(queries)
+    verdicts = parse_classification(text, len(queries))
+    missing = verdicts.count(None)
+    if missing:
+        print(f"Clasificación en lote: {missing}/{len(queries)} consultas sin veredicto; se usa el valor por defecto.")
+    return [default if verdict is None else verdict for verdict in verdicts]
+
+
+# --- Cliente de línea de comandos ---
+
+def read_items(path: str) -> list:
+    """Lee el JSONL de entrada. Los elementos sin id reciben su número de línea."""
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            message = record.get("message") or record.get("question")
+            if not message:
+                print(f"Línea {line_number} sin 'message' ni 'question'; se omite.")
+                continue
+            items.append({"id": str(record.get("id", line_number)), "message": message})
+    return items
+
+
+def load_done_ids(output_path: str) -> set:
+    """Ids ya respondidos sin error en el fichero de salida (el punto de control)."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Última línea a medias si el proceso murió escribiéndola
+            if record.get("error"):
+                done.discard(record["id"])
+            else:
+                done.add(record["id"])
+    return done
+
+
+def _post_batch(url: str, items: list, timeout: float):
+    body = json.dumps({"items": items}, ensure_ascii=False).encode("utf-8")
+    request = urllib.request.Request(f"{url.rstrip('/')}/chat/batch", data=body,
+                                     headers={"Content-Type": "application/json"})
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def run_cli(input_path: str, output_path: str, url: str, chunk_size: int, timeout: float) -> int:
+    items = read_items(input_path)
+    done = load_done_ids(output_path)
+    pending = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} preguntas; {len(items) - len(pending)} ya respondidas, {len(pending)} pendientes.")
+
+    # Si el proceso anterior murió a mitad de una línea, se empieza en una línea nueva
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+        if needs_newline:
+            with open(output_path, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+    start = time.perf_counter()
+    answered = errors = 0
+    with open(output_path, "a", encoding="utf-8") as output:
+        for offset in range(0, len(pending), chunk_size):
+            chunk = pending[offset:offset + chunk_size]
+            with _post_batch(url, chunk, timeout) as response:
+                for raw_line in response:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line:
+                        continue
+                    output.write(line + "\n")
+                    output.flush()
+                    if json.loads(line).get("error"):
+                        errors += 1
+                    else:
+                        answered += 1
+            os.fsync(output.fileno())
+            elapsed = time.perf_counter() - start
+            print(f"{offset + len(chunk)}/{len(pending)} procesadas ({answered / elapsed:.1f} respuestas/s, "
+                  f"{errors} errores)")
+    return 1 if errors else 0
+
+
+def main(argv: list) -> int:
+    parser = argparse.ArgumentParser(description="Envía un JSONL de preguntas a POST /chat/batch.")
+    parser.add_argument("input", help="JSONL con {\"id\": ..., \"message\": ...} por línea")
+    parser.add_argument("output", help="NDJSON de resultados (también sirve de punto de control)")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--chunk", type=int, default=200, help="Preguntas por petición")
+    parser.add_argument("--timeout", type=float, default=600, help="Tiempo máximo por petición (segundos)")
+    args = parser.parse_args(argv)
+    return run_cli(args.input, args.output, args.url, args.chunk, args.timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,108 +1,148 @@
 import os
-from dotenv import load_dotenv
-import google.generativeai as genai
 from datetime import datetime
-import sys
 import io # Importado para la generación de PDF
+import asyncio # Para ejecutar generación y clasificación en paralelo
+import json # Para serializar los eventos SSE
+import re
+import uuid
+import math
+from functools import partial
+from contextlib import asynccontextmanager, aclosing
 
 # Importaciones para FastAPI
-from fastapi import FastAPI, HTTPException, status, Request
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse # StreamingResponse para PDF
+from fastapi import FastAPI, HTTPException, status, Request, Response, WebSocket
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse, PlainTextResponse # StreamingResponse para PDF y SSE
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, EmailStr
-from typing import Optional
-
-# Importaciones para enviar correo
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
-from email.utils import formataddr
-
-# Importaciones para generar PDF
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
-
-# --- 1. Cargar variables del archivo .env ---
-load_dotenv()
-
-# --- Configuración global del asistente y correo ---
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-IA_GENERATIVE_MODEL_NAME = os.getenv("IA_GENERATIVE_MODEL")
-
-# Credenciales de correo
-SENDER_EMAIL = os.getenv("EMAIL_ADDRESS")
-SENDER_PASSWORD = os.getenv("EMAIL_PASSWORD")
-SMTP_SERVER = os.getenv("SMTP_SERVER")
-SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
-
-# Verificar que las claves y credenciales necesarias están presentes
-if not GEMINI_API_KEY:
-    print("Error: La clave de API de Gemini (GEMINI_API_KEY) no se encontró en el archivo .env")
-    sys.exit(1)
-if not IA_GENERATIVE_MODEL_NAME:
-     print("Error: El nombre del modelo generativo (IA_GENERATIVE_MODEL) no se encontró en el archivo .env. Debes especificar qué modelo usar (ej. gemini-pro).")
-     sys.exit(1)
-
-EMAIL_SENDING_AVAILABLE = False
-if all([SENDER_EMAIL, SENDER_PASSWORD, SMTP_SERVER]):
-    EMAIL_SENDING_AVAILABLE = True
-    print("Funcionalidad de envío de correo disponible.")
-else:
-    print("Advertencia: Las credenciales de correo (EMAIL_ADDRESS, EMAIL_PASSWORD, SMTP_SERVER) no se encontraron en el archivo .env.")
-    print("La funcionalidad de envío de correo NO estará disponible.")
-
-# --- 2. Definir la personalidad o instrucciones del sistema (TU PROMPT DE COMPORTAMIENTO) ---
-PERSONA_PROMPT = """
-Eres un asistente de IA llamado Elendur.
-Tu rol es el de un **académico y especialista riguroso** en la obra completa de J.R.R. Tolkien y toda la mitología de Arda (incluyendo libros, manuscritos, lenguajes y estudios relevantes).
-Tu objetivo es **proporcionar información precisa y concreta** sobre estos temas, basada estrictamente en el **canon primario y secundario** de Tolkien.
-El tono de tus respuestas debe ser **formal, objetivo y académico**. Evita cualquier expresión de familiaridad, entusiasmo o uso de emojis.
-Responde a las preguntas **directamente y con concisión**, enfocándote en los hechos y detalles relevantes.
-Si la información solicitada es especulativa, no confirmada en las obras de Tolkien, o si no tienes datos disponibles, **indícalo de manera clara y formal**, mencionando la limitación o la fuente (o falta de ella).
-Siempre busca ofrecer la información más **relevante y verificable** dentro del ámbito académico de los estudios de Tolkien.
-Mantén siempre tu identidad como Elendur, el especialista académico en Tolkien.
-"""
-
-# Extraer el nombre del asistente del prompt
-try:
-    name_line = next((line for line in PERSONA_PROMPT.splitlines() if "llamado " in line), "")
-    if "llamado " in name_line:
-         ASSISTANT_NAME = name_line.split('llamado ')[-1].split('.')[0].strip()
-    else:
-         ASSISTANT_NAME = "Elendur (Asistente Académico)"
-except Exception as e:
-     print(f"Error al extraer nombre del prompt: {e}")
-     ASSISTANT_NAME = "Elendur (Asistente Académico)"
+from pydantic import BaseModel, EmailStr, ValidationError
+from starlette.requests import HTTPConnection
+from typing import Optional, List
+
+# Núcleo compartido con el asistente de línea de comandos: configuración, modelos,
+# cachés, sesiones, correo, PDF y generación de respuestas. El estado que se
+# reasigna al arrancar (nucleo.model_router) se lee siempre a través del módulo.
+import nucleo
+from nucleo import (
+    _env_bool, ModelUnavailable,
+    ASSISTANT_NAME, PERSONA_PROMPT, IA_GENERATIVE_MODEL_NAME, EMAIL_SENDING_AVAILABLE,
+    CHAT_TIMEOUT_SECONDS, CLASSIFICATION_DEFAULT, SESSION_RETENTION_SECONDS, RATE_LIMIT_TRUSTED_PROXIES,
+    answer_cache, semantic_cache, precomputed_answers, mail_queue, pdf_renderer, session_store,
+    admission, single_flight, hedger,
+    get_cached_answer, store_answer, retrieve_context, save_turn,
+    generate_answer, generate_and_store_answer, send_classification_prompt, answer_events,
+)
+
+# Cola asíncrona para enviar correo
+from cola_correo import MailQueueFull, JOB_QUEUED, JOB_SENT, JOB_FAILED
+
+# Dossier PDF generado por páginas
+from dossier_pdf import iter_dossier_pdf, entries_from_history
+
+# Control de admisión (límites de tasa y de concurrencia hacia Gemini)
+from control_admision import AdmissionRejected, is_rate_limit_error
+
+# Métricas por etapa y trazas por petición
+from metricas import stage, render_stats, registry as metrics_registry, MetricsMiddleware, monitor_loop_lag
+
+# Enrutado entre varios modelos (nivel rápido y nivel grande, con conmutación por error)
+from enrutador_modelos import render_router_metrics
+
+# Preguntas en lote (clasificación agrupada en una sola llamada)
+from lotes import classify_batch
+
+# Canal WebSocket con varias preguntas simultáneas por conexión
+from canal_websocket import WebSocketChannel, get_channel_stats
 
+# Pre-clasificador local (sin llamadas al modelo)
+from clasificador_local import pre_classify, get_classifier_stats
 
-# --- 3. Configurar la API de Gemini e inicializar el MODELO CON la personalidad ---
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(IA_GENERATIVE_MODEL_NAME, system_instruction=PERSONA_PROMPT)
-    print(f"Modelo '{IA_GENERATIVE_MODEL_NAME}' configurado correctamente.")
-except Exception as e:
-    print(f"Error al configurar la API de Gemini o cargar el modelo '{IA_GENERATIVE_MODEL_NAME}': {e}")
-    print("Verifica tu clave de API de Gemini o la disponibilidad del modelo especificado en .env para chat.")
-    sys.exit(1)
+# Caché de respuestas
+from cache_respuestas import make_cache_key
+
+# --- Configuración propia de la API web ---
+SESSION_COOKIE = "elendur_session"
+SESSION_HEADER = "X-Session-Id"
+DOSSIER_MAX_ENTRIES = int(os.getenv("DOSSIER_MAX_ENTRIES", 20000)) # Preguntas por dossier
+
+# Métricas (GET /metrics) y trazas por petición
+METRICS_ENABLED = _env_bool("METRICS_ENABLED", True)
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH") # Si se define, una línea JSON con los spans de cada petición
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", 0.5))
+
+# Preguntas en lote (POST /chat/batch)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000)) # Preguntas por petición
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 8)) # Generaciones simultáneas por petición
+BATCH_CLASSIFY_SIZE = int(os.getenv("BATCH_CLASSIFY_SIZE", 25)) # Preguntas clasificadas en cada llamada
+BATCH_CLASSIFICATION_TIMEOUT_SECONDS = float(os.getenv("BATCH_CLASSIFICATION_TIMEOUT_SECONDS", 30))
+
+# Canal WebSocket (/ws)
+WS_ENABLED = _env_bool("WS_ENABLED", True)
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", 4)) # Peticiones simultáneas por conexión
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 256)) # Mensajes pendientes de enviar por conexión
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", 10)) # Cliente que no lee: se cierra
+WS_MAX_MESSAGE_BYTES = int(os.getenv("WS_MAX_MESSAGE_BYTES", 65536))
+MAIL_STATUS_POLL_SECONDS = 0.5
+
+PRELOAD = _env_bool("PRELOAD", False) # Importar todo al cargar el módulo (gunicorn --preload)
+
+
+def _model_unavailable_error(e: ModelUnavailable) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=str(e),
+        headers={"Retry-After": "5"}
+    )
+
+
+async def wait_for_model() -> None:
+    """Espera al modelo del núcleo; si no está listo a tiempo, responde 503."""
+    try:
+        await nucleo.wait_for_model()
+    except ModelUnavailable as e:
+        raise _model_unavailable_error(e)
 
 
 # --- 4. Inicialización de FastAPI ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Arranque y parada de la app. El modelo se construye en segundo plano: la app
+    acepta conexiones enseguida (/health/live) y /health/ready indica cuándo está lista.
+    """
+    await nucleo.start()
+    background_tasks = []
+    if METRICS_ENABLED:
+        background_tasks.append(asyncio.create_task(monitor_loop_lag(LOOP_LAG_INTERVAL_SECONDS)))
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    await nucleo.stop()
+
+
 app = FastAPI(
     title=f"{ASSISTANT_NAME}: Asistente Académico de Tolkien",
     description="API para interactuar con un asistente especializado en la obra de J.R.R. Tolkien.",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware, trace_log_path=TRACE_LOG_PATH)
+
 # Configurar Jinja2Templates
 templates = Jinja2Templates(directory="templates")
 
 # Montar StaticFiles para servir CSS, JS y otros activos estáticos
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+if PRELOAD:
+    # Con gunicorn --preload, el proceso maestro importa todo antes de crear los
+    # workers y estos comparten esas páginas de memoria (copy-on-write)
+    from arranque import preload_heavy_modules
+    preload_heavy_modules()
+
 
 # --- Esquemas Pydantic para validación de datos ---
 class ChatRequest(BaseModel):
@@ -114,6 +154,7 @@ class ChatResponse(BaseModel):
     assistant_name: str
     ask_for_download: bool = False # Campo unificado para pedir opción de email/pdf
     email_available: bool = False # Nuevo campo para indicar si el correo está configurado
+    session_id: Optional[str] = None # Sesión de conversación (si están activadas)
 
 class EmailRequest(BaseModel):
     recipient_email: EmailStr
@@ -123,77 +164,76 @@ class EmailRequest(BaseModel):
 class EmailResponse(BaseModel):
     message: str
     success: bool
+    job_id: Optional[str] = None # Identificador del envío en la cola de correo
+    status: Optional[str] = None # queued, sending, sent o failed
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None # Por defecto, la posición en la lista
+    message: str
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
 
 class PdfRequest(BaseModel): # Reintroducido
     question: str
     answer: str
 
+class DossierRequest(BaseModel):
+    title: Optional[str] = None
+    entries: List[PdfRequest] = [] # Vacío: se usa el historial de la sesión
+
 
-# --- Función auxiliar para enviar correo electrónico ---
-def _send_email_internal(to_email: str, subject: str, body: str) -> bool:
-    """Función interna para enviar un correo electrónico.
-    Retorna True si el envío fue exitoso, False en caso contrario.
+_SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+def _get_session_id(raw_request: HTTPConnection) -> str:
+    """
+    Obtiene el id de sesión de la cabecera X-Session-Id o de la cookie.
+    Si no hay ninguno válido, crea uno nuevo.
     """
-    if not EMAIL_SENDING_AVAILABLE:
-        print("Error: La funcionalidad de envío de correo no está disponible.")
-        return False
+    session_id = raw_request.headers.get(SESSION_HEADER) or raw_request.cookies.get(SESSION_COOKIE)
+    if session_id and _SESSION_ID_RE.match(session_id):
+        return session_id
+    return uuid.uuid4().hex
 
-    try:
-        msg = MIMEText(body, 'plain', 'utf-8')
-        msg['Subject'] = Header(subject, 'utf-8').encode()
-        msg['From'] = formataddr((str(Header(f"{ASSISTANT_NAME} (Asistente)", 'utf-8')), SENDER_EMAIL))
-        msg['To'] = to_email
-
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.send_message(msg)
-        return True
-    except Exception as e:
-        print(f"Error al enviar correo: {e}")
-        return False
 
+def _set_session_cookie(response: Response, session_id: str) -> None:
+    response.set_cookie(
+        SESSION_COOKIE, session_id,
+        max_age=int(SESSION_RETENTION_SECONDS),
+        httponly=True,
+        samesite="lax"
+    )
 
-# --- NUEVA FUNCIÓN: Clasificación de la pregunta por la IA ---
-async def is_tolkien_related(query: str) -> bool:
+
+def _client_id(raw_request: HTTPConnection) -> str:
     """
-    Usa el modelo de IA para determinar si una consulta está directamente relacionada
-    con la obra de J.R.R. Tolkien.
+    Identificador del cliente para el límite de tasa (su dirección IP).
+    Con RATE_LIMIT_TRUSTED_PROXIES = N se toma de X-Forwarded-For la dirección
+    que añadió el proxy de confianza más externo (la N-ésima empezando por el final);
+    las anteriores las escribe el propio cliente y no son fiables.
     """
-    classification_prompt = f"""
-    Dada la siguiente consulta de usuario, determina si está directamente relacionada
-    con la historia, personajes, lugares, eventos o mitología de las obras de J.R.R. Tolkien
-    (por ejemplo, El Hobbit, El Señor de los Anillos, El Silmarillion).
+    if RATE_LIMIT_TRUSTED_PROXIES > 0:
+        forwarded = [
+            address.strip()
+            for address in raw_request.headers.get("x-forwarded-for", "").split(",")
+            if address.strip()
+        ]
+        if len(forwarded) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return forwarded[-RATE_LIMIT_TRUSTED_PROXIES]
+    return raw_request.client.host if raw_request.client else "desconocido"
 
-    Responde con 'YES' si la consulta es directamente relevante a Tolkien.
-    Responde con 'NO' si es un saludo general, agradecimiento, una meta-pregunta sobre el asistente,
-    una pregunta personal, o cualquier cosa no relacionada directamente con Tolkien.
 
-    Ejemplos:
-    - Consulta: ¿Quién es Gandalf? -> YES
-    - Consulta: Háblame de los Elfos. -> YES
-    - Consulta: ¿Dónde está Mordor? -> YES
-    - Consulta: Gracias por tu respuesta. -> NO
-    - Consulta: Hola. -> NO
-    - Consulta: Tengo otra pregunta. -> NO
-    - Consulta: ¿Cuál es la capital de Francia? -> NO
-    - Consulta: ¿Puedes contarme un chiste? -> NO
+def _admission_http_error(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=e.status_code,
+        detail=e.detail,
+        headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+    )
 
-    Consulta: {query}
-    ¿Es esta consulta directamente relacionada con Tolkien? (YES/NO):
-    """
-    try:
-        temp_chat_session = model.start_chat(history=[])
-        response = await temp_chat_session.send_message_async(
-            classification_prompt,
-            generation_config={"temperature": 0.0, "max_output_tokens": 10}
-        )
-        classification_result = response.text.strip().upper()
-        print(f"Clasificación para '{query}': {classification_result}")
-        return classification_result == 'YES'
-    except Exception as e:
-        print(f"Error durante la clasificación de la pregunta: {e}")
-        return False
+
+def _sse_event(event: str, data: dict) -> str:
+    """Formatea un evento Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # --- RUTAS DE LA API ---
 
@@ -208,43 +248,600 @@ async def read_root(request: Request):
 
 # Ruta para manejar las solicitudes de chat
 @app.post("/chat", response_model=ChatResponse, summary="Envía un mensaje al asistente y recibe una respuesta")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, raw_request: Request, http_response: Response):
     """
     Procesa el mensaje del usuario con el modelo generativo de IA y devuelve la respuesta.
     Si la funcionalidad de correo está disponible y la pregunta es relevante a Tolkien,
     la respuesta incluirá una bandera para indicar al frontend que pregunte al usuario
     si desea recibir la respuesta por correo o descargar un PDF.
+    Si las sesiones están activadas, el historial de la conversación se envía al modelo.
     """
-    try:
-        chat_session = model.start_chat(history=[])
-        response = await chat_session.send_message_async(request.message)
-        ai_response_text = response.text
+    session_id = None
+    history = []
+    if session_store is not None:
+        session_id = _get_session_id(raw_request)
+        with stage("session_load"):
+            history = await session_store.load(session_id)
+        _set_session_cookie(http_response, session_id)
+
+    # Con historial, la respuesta depende del contexto y no se usa la caché
+    cached = await get_cached_answer(request.message) if not history else None
+    if cached is not None:
+        # La caché guarda también el veredicto de is_tolkien_related
+        await save_turn(session_id, request.message, cached["response"])
+        return ChatResponse(
+            response=cached["response"],
+            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            assistant_name=ASSISTANT_NAME,
+            ask_for_download=cached["is_tolkien_related"],
+            email_available=EMAIL_SENDING_AVAILABLE,
+            session_id=session_id
+        )
 
-        is_query_tolkien_related = await is_tolkien_related(request.message)
+    model_message, direct_answer = retrieve_context(request.message)
+    if direct_answer is not None:
+        # Entrada del glosario: respuesta sin llamar al modelo
+        await store_answer(request.message, direct_answer, True)
+        await save_turn(session_id, request.message, direct_answer)
+        return ChatResponse(
+            response=direct_answer,
+            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            assistant_name=ASSISTANT_NAME,
+            ask_for_download=True,
+            email_available=EMAIL_SENDING_AVAILABLE,
+            session_id=session_id
+        )
+
+    await wait_for_model()
+    try:
+        admission.check_rate(_client_id(raw_request))
+        if history:
+            ai_response_text, is_query_tolkien_related = await generate_answer(request.message, model_message, history)
+        else:
+            # Las peticiones idénticas simultáneas comparten una sola llamada al modelo
+            flight_key = make_cache_key(request.message, IA_GENERATIVE_MODEL_NAME, PERSONA_PROMPT)
+            ai_response_text, is_query_tolkien_related = await single_flight.do(
+                flight_key,
+                lambda: generate_and_store_answer(request.message, model_message)
+            )
 
         # ask_for_download se activa si la pregunta es relevante a Tolkien.
         # Esto le dice al frontend que muestre la burbuja de opciones (email/pdf).
         should_ask_for_download_or_email = is_query_tolkien_related
 
+        await save_turn(session_id, request.message, ai_response_text)
+
         return ChatResponse(
             response=ai_response_text,
             timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             assistant_name=ASSISTANT_NAME,
             ask_for_download=should_ask_for_download_or_email,
-            email_available=EMAIL_SENDING_AVAILABLE # Envía el estado de disponibilidad del correo
+            email_available=EMAIL_SENDING_AVAILABLE, # Envía el estado de disponibilidad del correo
+            session_id=session_id
+        )
+    except AdmissionRejected as e:
+        raise _admission_http_error(e)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"El modelo no respondió en {CHAT_TIMEOUT_SECONDS} segundos."
         )
     except Exception as e:
+        if is_rate_limit_error(e):
+            # El modelo sigue respondiendo 429 tras los reintentos
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="El modelo ha alcanzado su cuota. Inténtalo en unos segundos.",
+                headers={"Retry-After": "5"}
+            )
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error al procesar la solicitud: {e}"
         )
 
+def _batch_record(item_id: str, response_text: Optional[str], is_query_tolkien_related: bool,
+                  source: str, error: Optional[str] = None) -> str:
+    return json.dumps({
+        "id": item_id,
+        "response": response_text,
+        "is_tolkien_related": is_query_tolkien_related,
+        "source": source, # cache, glossary, model o error
+        "error": error,
+    }, ensure_ascii=False) + "\n"
+
+
+# Ruta para procesar muchas preguntas en una sola petición
+@app.post("/chat/batch", summary="Responde un lote de preguntas y devuelve los resultados como NDJSON")
+async def chat_batch(request: BatchRequest, raw_request: Request):
+    """
+    Responde hasta BATCH_MAX_ITEMS preguntas (sin historial de sesión). Devuelve una línea
+    JSON por pregunta, en orden de finalización:
+    `{"id", "response", "is_tolkien_related", "source", "error"}`.
+
+    Las preguntas repetidas se responden una vez; las de la caché o del glosario salen
+    primero; las demás se clasifican en grupos de BATCH_CLASSIFY_SIZE por llamada al
+    modelo y se generan con una concurrencia máxima de BATCH_MAX_CONCURRENCY.
+    """
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"El lote tiene {len(request.items)} preguntas; el máximo es {BATCH_MAX_ITEMS}."
+        )
+    try:
+        admission.check_rate(_client_id(raw_request))
+    except AdmissionRejected as e:
+        raise _admission_http_error(e)
+
+    # Preguntas idénticas (misma clave de caché) -> ids que las comparten
+    groups = {}
+    for position, item in enumerate(request.items):
+        key = make_cache_key(item.message, IA_GENERATIVE_MODEL_NAME, PERSONA_PROMPT)
+        groups.setdefault(key, (item.message, []))[1].append(item.id if item.id is not None else str(position))
+
+    async def answer_group(key: str, message: str, model_message: str, classify, semaphore) -> tuple:
+        async with semaphore:
+            try:
+                text, verdict = await single_flight.do(
+                    key, lambda: generate_and_store_answer(message, model_message, classify)
+                )
+                return key, text, verdict, None
+            except AdmissionRejected as e:
+                return key, None, False, e.detail
+            except asyncio.TimeoutError:
+                return key, None, False, f"El modelo no respondió en {CHAT_TIMEOUT_SECONDS} segundos."
+            except Exception as e:
+                return key, None, False, f"Error al procesar la pregunta: {e}"
+
+    async def batch_stream():
+        tasks = []
+        try:
+            # 1. Caché y glosario: sin modelo, se devuelven enseguida
+            misses = []
+            for key, (message, ids) in groups.items():
+                cached = await get_cached_answer(message)
+                if cached is not None:
+                    for item_id in ids:
+                        yield _batch_record(item_id, cached["response"], cached["is_tolkien_related"], "cache")
+                    continue
+                model_message, direct_answer = retrieve_context(message)
+                if direct_answer is not None:
+                    await store_answer(message, direct_answer, True)
+                    for item_id in ids:
+                        yield _batch_record(item_id, direct_answer, True, "glossary")
+                    continue
+                misses.append((key, message, model_message))
+            if not misses:
+                return
+
+            try:
+                await wait_for_model()
+            except HTTPException as e:
+                for key, _message, _model_message in misses:
+                    for item_id in groups[key][1]:
+                        yield _batch_record(item_id, None, False, "error", e.detail)
+                return
+
+            # 2. Clasificación: primero el pre-clasificador local; el resto, en grupos
+            classifiers = {}
+            unresolved = []
+            for key, message, _model_message in misses:
+                local_verdict = pre_classify(message)
+                if local_verdict is not None:
+                    async def classify(_message, verdict=local_verdict):
+                        return verdict
+                    classifiers[key] = classify
+                else:
+                    unresolved.append((key, message))
+            for offset in range(0, len(unresolved), BATCH_CLASSIFY_SIZE):
+                chunk = unresolved[offset:offset + BATCH_CLASSIFY_SIZE]
+                chunk_task = asyncio.create_task(classify_batch(
+                    [message for _key, message in chunk], send_classification_prompt,
+                    CLASSIFICATION_DEFAULT, BATCH_CLASSIFICATION_TIMEOUT_SECONDS
+                ))
+                tasks.append(chunk_task)
+                for index, (key, _message) in enumerate(chunk):
+                    async def classify(_message, chunk_task=chunk_task, index=index):
+                        # shield: si una generación falla, el grupo sigue para las demás
+                        return (await asyncio.shield(chunk_task))[index]
+                    classifiers[key] = classify
+
+            # 3. Generación con concurrencia acotada, en orden de finalización
+            semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+            generation_tasks = [
+                asyncio.create_task(answer_group(key, message, model_message, classifiers[key], semaphore))
+                for key, message, model_message in misses
+            ]
+            tasks.extend(generation_tasks)
+            for finished in asyncio.as_completed(generation_tasks):
+                key, text, verdict, error = await finished
+                for item_id in groups[key][1]:
+                    if error is None:
+                        yield _batch_record(item_id, text, verdict, "model")
+                    else:
+                        yield _batch_record(item_id, None, False, "error", error)
+        finally:
+            # El cliente se desconectó o hubo un error: no dejar llamadas huérfanas
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    return StreamingResponse(batch_stream(), media_type="application/x-ndjson")
+
+# Ruta para recibir la respuesta en streaming (Server-Sent Events)
+@app.post("/chat/stream", summary="Envía un mensaje al asistente y recibe la respuesta en streaming (SSE)")
+async def chat_stream(request: ChatRequest, raw_request: Request):
+    """
+    Igual que /chat, pero la respuesta se envía por fragmentos a medida que el modelo la genera.
+
+    Eventos emitidos:
+    - `chunk`: `{"text": "..."}` con cada fragmento de la respuesta.
+    - `done`: `{"ask_for_download", "email_available", "timestamp", "assistant_name", "session_id"}` al terminar.
+    - `error`: `{"detail": "..."}` si falla la generación.
+    """
+    session_id = _get_session_id(raw_request) if session_store is not None else None
+    events = answer_events(request.message, session_id=session_id, client_id=_client_id(raw_request))
+    # Las comprobaciones previas (modelo listo, límite de tasa) se resuelven antes de
+    # empezar la respuesta, para poder contestar 503 o 429 con su código HTTP
+    try:
+        await anext(events)
+    except ModelUnavailable as e:
+        raise _model_unavailable_error(e)
+    except AdmissionRejected as e:
+        raise _admission_http_error(e)
+
+    async def event_stream():
+        # aclosing: si el cliente se desconecta, se libera enseguida el hueco de llamada al modelo
+        async with aclosing(events):
+            try:
+                async for kind, value in events:
+                    if kind == "chunk":
+                        yield _sse_event("chunk", {"text": value})
+                    elif kind == "done":
+                        yield _sse_event("done", {
+                            "ask_for_download": value,
+                            "email_available": EMAIL_SENDING_AVAILABLE,
+                            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            "assistant_name": ASSISTANT_NAME,
+                            "session_id": session_id,
+                        })
+            except AdmissionRejected as e:
+                yield _sse_event("error", {"detail": e.detail, "retry_after": math.ceil(e.retry_after)})
+            except asyncio.TimeoutError:
+                yield _sse_event("error", {"detail": f"El modelo no respondió en {CHAT_TIMEOUT_SECONDS} segundos."})
+            except Exception as e:
+                yield _sse_event("error", {"detail": f"Error al procesar la solicitud: {e}"})
+
+    streaming_response = StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    if session_id is not None:
+        _set_session_cookie(streaming_response, session_id)
+    return streaming_response
+
+# Canal WebSocket: muchas preguntas simultáneas por una sola conexión
+async def _ws_ask(channel: WebSocketChannel, request_id: str, message: dict, session_id: Optional[str], client_id: str):
+    """Pregunta por el canal: `chunk` con cada fragmento y `done` con el veredicto (o `error`)."""
+    question = message.get("message")
+    if not isinstance(question, str) or not question.strip():
+        await channel.send({"type": "error", "id": request_id, "detail": "La pregunta está vacía."})
+        return
+
+    def done(answer_source: str, is_query_tolkien_related: bool) -> dict:
+        return {
+            "type": "done",
+            "id": request_id,
+            "source": answer_source, # cache, glossary o model
+            "ask_for_download": is_query_tolkien_related,
+            "email_available": EMAIL_SENDING_AVAILABLE,
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    answer_source = None
+    try:
+        async with aclosing(answer_events(question, session_id=session_id, client_id=client_id)) as events:
+            async for kind, value in events:
+                if kind == "start":
+                    answer_source = value
+                elif kind == "chunk":
+                    # Si el cliente lee despacio, channel.send() espera y se deja de leer del modelo
+                    await channel.send({"type": "chunk", "id": request_id, "text": value})
+                else:
+                    await channel.send(done(answer_source, value))
+    except ModelUnavailable as e:
+        await channel.send({"type": "error", "id": request_id, "detail": str(e), "retry_after": 5})
+    except AdmissionRejected as e:
+        await channel.send({"type": "error", "id": request_id, "detail": e.detail, "retry_after": math.ceil(e.retry_after)})
+    except asyncio.TimeoutError:
+        await channel.send({"type": "error", "id": request_id, "detail": f"El modelo no respondió en {CHAT_TIMEOUT_SECONDS} segundos."})
+    except Exception as e:
+        if not is_rate_limit_error(e):
+            raise
+        # El modelo sigue respondiendo 429 tras los reintentos
+        await channel.send({"type": "error", "id": request_id, "retry_after": 5,
+                            "detail": "El modelo ha alcanzado su cuota. Inténtalo en unos segundos."})
+
+
+async def _ws_email(channel: WebSocketChannel, request_id: str, message: dict):
+    """Encola un correo y avisa por el canal al encolarlo y al terminar, sin que el cliente consulte el estado."""
+    if mail_queue is None:
+        await channel.send({"type": "error", "id": request_id,
+                            "detail": "La funcionalidad de envío de correo no está configurada o disponible."})
+        return
+    try:
+        email = EmailRequest(**{key: message.get(key) for key in ("recipient_email", "subject", "body")})
+    except ValidationError:
+        await channel.send({"type": "error", "id": request_id, "detail": "La dirección de correo, el asunto o el cuerpo no son válidos."})
+        return
+    try:
+        job_id = mail_queue.enqueue(email.recipient_email, email.subject, email.body)
+    except MailQueueFull:
+        await channel.send({"type": "error", "id": request_id, "retry_after": 5,
+                            "detail": "Hay demasiados correos pendientes de envío. Inténtalo de nuevo en unos segundos."})
+        return
+    await channel.send({"type": "email", "id": request_id, "job_id": job_id, "status": JOB_QUEUED})
+    while True:
+        job = mail_queue.get_job(job_id)
+        if job is None or job["status"] in (JOB_SENT, JOB_FAILED):
+            break
+        await asyncio.sleep(MAIL_STATUS_POLL_SECONDS)
+    sent = job is not None and job["status"] == JOB_SENT
+    await channel.send({
+        "type": "email",
+        "id": request_id,
+        "job_id": job_id,
+        "status": JOB_SENT if sent else JOB_FAILED,
+        "message": "La información ha sido enviada con éxito." if sent else
+                   "Lo siento, hubo un problema al enviar el correo. Verifica las credenciales o intenta de nuevo.",
+    })
+
+
+async def _ws_pdf(channel: WebSocketChannel, request_id: str, message: dict):
+    """Genera el PDF y lo envía como un mensaje `pdf` seguido de un frame binario."""
+    try:
+        pdf_request = PdfRequest(question=message.get("question"), answer=message.get("answer"))
+    except ValidationError:
+        await channel.send({"type": "error", "id": request_id, "detail": "Faltan la pregunta o la respuesta del PDF."})
+        return
+    pdf = await pdf_renderer.render(pdf_request.question, pdf_request.answer)
+    await channel.send({"type": "pdf", "id": request_id, "filename": "consulta_Elendur.pdf", "size": len(pdf)}, pdf)
+
+
+@app.websocket("/ws")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Canal WebSocket multiplexado. El cliente envía objetos JSON con `type` e `id`:
+
+    - `{"type": "ask", "id", "message"}`: respuesta en `chunk` (`{"id", "text"}`) y `done`
+      (`{"id", "ask_for_download", "email_available", "timestamp", "source"}`).
+    - `{"type": "email", "id", "recipient_email", "subject", "body"}`: `email` con
+      `status` queued y después sent o failed.
+    - `{"type": "pdf", "id", "question", "answer"}`: `pdf` (`{"id", "filename", "size"}`)
+      seguido de un frame binario con el documento.
+    - `{"type": "cancel", "id"}`: cancela la petición; se responde `cancelled`.
+
+    Los errores llegan como `error` (`{"id", "detail", "retry_after"?}`). Como mucho
+    WS_MAX_IN_FLIGHT peticiones en vuelo por conexión.
+    """
+    if not WS_ENABLED:
+        await websocket.close(code=1008)
+        return
+    session_id = None
+    accept_headers = []
+    if session_store is not None:
+        session_id = websocket.query_params.get("session_id") or _get_session_id(websocket)
+        if not _SESSION_ID_RE.match(session_id):
+            session_id = uuid.uuid4().hex
+        cookie_response = Response()
+        _set_session_cookie(cookie_response, session_id)
+        accept_headers = [header for header in cookie_response.raw_headers if header[0] == b"set-cookie"]
+    await websocket.accept(headers=accept_headers)
+
+    channel = WebSocketChannel(
+        websocket,
+        max_in_flight=WS_MAX_IN_FLIGHT,
+        send_queue_size=WS_SEND_QUEUE_SIZE,
+        send_timeout_seconds=WS_SEND_TIMEOUT_SECONDS,
+        max_message_bytes=WS_MAX_MESSAGE_BYTES,
+    )
+    await channel.send({
+        "type": "hello",
+        "id": None,
+        "assistant_name": ASSISTANT_NAME,
+        "email_available": EMAIL_SENDING_AVAILABLE,
+        "session_id": session_id,
+        "max_in_flight": WS_MAX_IN_FLIGHT,
+    })
+    await channel.run({
+        "ask": partial(_ws_ask, session_id=session_id, client_id=_client_id(websocket)),
+        "email": _ws_email,
+        "pdf": _ws_pdf,
+    })
+
+# Rutas de salud para el orquestador (liveness y readiness)
+@app.get("/health/live", summary="Indica si el proceso está vivo")
+async def health_live():
+    """Responde siempre que el event loop atienda peticiones."""
+    return {"status": "ok"}
+
+@app.get("/health/ready", summary="Indica si el asistente está listo para responder preguntas")
+async def health_ready():
+    """
+    200 cuando el modelo está construido; 503 mientras arranca o si falló su configuración.
+    """
+    if nucleo.model_router is None:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"ready": False, "detail": "Iniciando el modelo." if nucleo.model_starting() else nucleo.model_error},
+        )
+    return {"ready": True, "model": IA_GENERATIVE_MODEL_NAME, "models": [m.name for m in nucleo.model_router.models]}
+
+# Ruta para olvidar la conversación actual
+@app.delete("/session", summary="Elimina el historial de la conversación actual")
+async def delete_session(raw_request: Request, http_response: Response):
+    """
+    Borra del servidor el historial de la sesión indicada por la cabecera X-Session-Id o la cookie.
+    """
+    if session_store is None:
+        return {"deleted": False}
+    session_id = raw_request.headers.get(SESSION_HEADER) or raw_request.cookies.get(SESSION_COOKIE)
+    if session_id:
+        await session_store.delete(session_id)
+    http_response.delete_cookie(SESSION_COOKIE)
+    return {"deleted": bool(session_id)}
+
+# Ruta de métricas en formato de texto de Prometheus
+@app.get("/metrics", response_class=PlainTextResponse, summary="Métricas del servicio en formato Prometheus")
+async def metrics():
+    """
+    Histogramas de latencia por etapa (`elendur_stage_seconds`) y por ruta HTTP,
+    tokens consumidos en Gemini, retraso del event loop y el estado de cachés,
+    colas y control de admisión.
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Las métricas no están activadas."
+        )
+    parts = [
+        metrics_registry.render(),
+        render_stats("elendur_admission", admission.get_stats(),
+                     gauges={"in_flight", "waiting", "max_concurrency", "avg_upstream_seconds"}),
+        render_stats("elendur_coalescing", single_flight.get_stats(), gauges={"in_flight"}),
+        render_stats("elendur_classifier", get_classifier_stats(), gauges={"hit_ratio"}),
+        render_stats("elendur_pdf", pdf_renderer.get_stats(),
+                     gauges={"workers", "cache_entries", "cache_bytes"}),
+        render_stats("elendur_websocket", get_channel_stats(), gauges={"connections_open"}),
+    ]
+    if answer_cache is not None:
+        parts.append(render_stats("elendur_cache", answer_cache.memory.get_stats(),
+                                  gauges={"size", "max_entries"}))
+    if semantic_cache is not None:
+        parts.append(render_stats("elendur_semantic_cache", semantic_cache.get_stats(),
+                                  gauges={"size", "capacity", "threshold", "memory_bytes"}))
+    if precomputed_answers is not None:
+        parts.append(render_stats("elendur_precomputed", precomputed_answers.get_stats(),
+                                  gauges={"entries", "age_seconds"}))
+    if mail_queue is not None:
+        parts.append(render_stats("elendur_mail_queue", mail_queue.get_stats(),
+                                  gauges={"pending", "max_queue", "workers"}))
+    if session_store is not None:
+        parts.append(render_stats("elendur_sessions", await session_store.get_stats(), gauges={"sessions"}))
+    if nucleo.model_router is not None:
+        parts.append(render_router_metrics("elendur_router", nucleo.model_router))
+    if hedger is not None:
+        parts.append(render_stats("elendur_hedging", hedger.get_stats(),
+                                  gauges={"extra_call_ratio", "threshold_seconds", "samples"}))
+    return PlainTextResponse("".join(parts), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Ruta para consultar el enrutado entre modelos
+@app.get("/models/stats", summary="Devuelve el enrutado y la salud de cada modelo")
+async def models_stats():
+    """
+    Llamadas enviadas a cada nivel, cambios de modelo por error y, por modelo,
+    latencia media (EWMA), tasa de errores (EWMA), 429 y tiempo de enfriamiento.
+    """
+    if nucleo.model_router is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="El asistente se está iniciando o el modelo no está disponible. Inténtalo en unos segundos.",
+            headers={"Retry-After": "5"}
+        )
+    return nucleo.model_router.get_stats()
+
+# Ruta para consultar las peticiones de cobertura
+@app.get("/hedging/stats", summary="Devuelve las copias lanzadas contra respuestas lentas del modelo")
+async def hedging_stats():
+    """
+    Llamadas, copias lanzadas, copias que ganaron, copias denegadas (por presupuesto
+    o por falta de capacidad), fracción de llamadas extra y umbral actual.
+    """
+    if hedger is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Las peticiones de cobertura no están activadas (HEDGE_ENABLED)."
+        )
+    return hedger.get_stats()
+
+# Ruta para consultar el canal WebSocket
+@app.get("/ws/stats", summary="Devuelve el estado del canal WebSocket")
+async def websocket_stats():
+    """
+    Conexiones abiertas y totales, mensajes recibidos y enviados, peticiones
+    iniciadas y canceladas, rechazos (por límite en vuelo o mensaje no válido)
+    y conexiones cerradas por no leer a tiempo.
+    """
+    return get_channel_stats()
+
+# Ruta para consultar el estado del control de admisión
+@app.get("/admission/stats", summary="Devuelve el estado del control de admisión hacia el modelo")
+async def admission_stats():
+    """
+    Peticiones admitidas y rechazadas (por tasa, cola llena o plazo), llamadas en vuelo y en espera.
+    """
+    return admission.get_stats()
+
+# Ruta para consultar cuántas llamadas al modelo se han ahorrado por coalescencia
+@app.get("/coalescing/stats", summary="Devuelve las llamadas al modelo ahorradas al agrupar peticiones idénticas")
+async def coalescing_stats():
+    """
+    `upstream_calls`: llamadas realmente hechas al modelo; `coalesced`: peticiones
+    que reutilizaron una llamada en curso (llamadas ahorradas).
+    """
+    return single_flight.get_stats()
+
+# Ruta para consultar los contadores del pre-clasificador local
+@app.get("/classifier/stats", summary="Devuelve los contadores de aciertos del pre-clasificador local")
+async def classifier_stats():
+    """
+    Devuelve cuántas consultas resolvió el pre-clasificador local (hits)
+    y cuántas tuvieron que pasar al modelo (misses).
+    """
+    return get_classifier_stats()
+
+# Rutas para consultar y vaciar la caché de respuestas
+@app.get("/cache/stats", summary="Devuelve las estadísticas de la caché de respuestas")
+async def cache_stats():
+    """
+    Devuelve aciertos, fallos, desalojos y caducidades de cada nivel de la caché.
+    """
+    stats = {"enabled": answer_cache is not None or semantic_cache is not None or precomputed_answers is not None}
+    if answer_cache is not None:
+        stats.update(await answer_cache.get_stats())
+    if semantic_cache is not None:
+        stats["semantic"] = semantic_cache.get_stats()
+    if precomputed_answers is not None:
+        stats["precomputed"] = precomputed_answers.get_stats()
+    return stats
+
+@app.delete("/cache", summary="Vacía la caché de respuestas")
+async def purge_cache():
+    """
+    Elimina todas las entradas de la caché de este worker y de la caché SQLite compartida.
+    Las cachés en memoria de otros workers caducan por su TTL.
+    """
+    if answer_cache is None and semantic_cache is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="La caché de respuestas no está activada."
+        )
+    purged = {}
+    if answer_cache is not None:
+        purged.update(await answer_cache.purge())
+    if semantic_cache is not None:
+        purged["semantic"] = semantic_cache.purge()
+    return {"purged": purged}
+
 # Ruta para enviar correo electrónico
-@app.post("/send-email", response_model=EmailResponse, summary="Envía información de la conversación por correo")
+@app.post("/send-email", response_model=EmailResponse, status_code=status.HTTP_202_ACCEPTED,
+          summary="Encola el envío de información de la conversación por correo")
 async def send_email_route(request: EmailRequest):
     """
     Endpoint para enviar un correo electrónico con la información de la conversación.
     Solo disponible si las credenciales de correo están configuradas en .env.
+    El correo se encola y se envía en segundo plano: la respuesta (202) incluye
+    un `job_id` cuyo estado se consulta en GET /send-email/{job_id}.
 
     Ejemplo de cuerpo de solicitud:
     ```json
@@ -255,95 +852,97 @@ async def send_email_route(request: EmailRequest):
     }
     ```
     """
-    if not EMAIL_SENDING_AVAILABLE:
+    if mail_queue is None:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="La funcionalidad de envío de correo no está configurada o disponible."
         )
 
-    success = _send_email_internal(request.recipient_email, request.subject, request.body)
-
-    if success:
-        return EmailResponse(
-            message=f"La información ha sido enviada con éxito a {request.recipient_email}.",
-            success=True
+    try:
+        job_id = mail_queue.enqueue(request.recipient_email, request.subject, request.body)
+    except MailQueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Hay demasiados correos pendientes de envío. Inténtalo de nuevo en unos segundos.",
+            headers={"Retry-After": "5"}
         )
-    else:
+
+    return EmailResponse(
+        message=f"El envío a {request.recipient_email} se ha puesto en cola.",
+        success=True,
+        job_id=job_id,
+        status=JOB_QUEUED
+    )
+
+# Ruta para consultar el estado de un envío de correo
+@app.get("/send-email/{job_id}", response_model=EmailResponse, summary="Consulta el estado de un envío de correo")
+async def send_email_status(job_id: str):
+    """
+    Devuelve el estado de un envío encolado: queued, sending, sent o failed.
+    """
+    job = mail_queue.get_job(job_id) if mail_queue is not None else None
+    if job is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Lo siento, hubo un problema al enviar el correo. Verifica las credenciales o intenta de nuevo."
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No existe ningún envío con ese identificador."
         )
 
+    if job["status"] == JOB_FAILED:
+        message = "Lo siento, hubo un problema al enviar el correo. Verifica las credenciales o intenta de nuevo."
+    elif job["status"] == JOB_SENT:
+        message = "La información ha sido enviada con éxito."
+    else:
+        message = "El envío está en curso."
+    return EmailResponse(
+        message=message,
+        success=job["status"] != JOB_FAILED,
+        job_id=job_id,
+        status=job["status"]
+    )
+
 # NUEVA RUTA PARA GENERAR PDF
 @app.post("/generate-pdf", summary="Genera un PDF con la pregunta y respuesta de la conversación")
 async def generate_pdf(request: PdfRequest):
     """
     Endpoint para generar un PDF que contenga la pregunta del usuario y la respuesta del asistente.
+    El PDF se genera en un pool de procesos para no bloquear el event loop,
+    y se reutiliza si ya se generó antes para la misma pregunta y respuesta.
     """
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
-
-    # Estilos personalizados
-    styles.add(ParagraphStyle(name='TitleStyle',
-                              parent=styles['h1'],
-                              fontSize=20,
-                              leading=24,
-                              alignment=TA_CENTER,
-                              spaceAfter=20))
-    # Se cambió el nombre de 'Heading2' a 'CustomHeading2' para evitar colisión con estilos existentes
-    styles.add(ParagraphStyle(name='CustomHeading2',
-                              parent=styles['h2'],
-                              fontSize=14,
-                              leading=18,
-                              spaceAfter=10,
-                              spaceBefore=20,
-                              alignment=TA_LEFT))
-    # Se cambió el nombre de 'BodyText' a 'CustomBodyText' para evitar colisión con estilos existentes
-    styles.add(ParagraphStyle(name='CustomBodyText',
-                              parent=styles['Normal'],
-                              fontSize=12,
-                              leading=14,
-                              spaceAfter=10,
-                              alignment=TA_LEFT))
-    styles.add(ParagraphStyle(name='Footer',
-                              parent=styles['Normal'],
-                              fontSize=10,
-                              leading=12,
-                              alignment=TA_CENTER,
-                              textColor='#888888'))
-
-    story = []
-
-    # Título
-    story.append(Paragraph(f"Informe de Consulta con {ASSISTANT_NAME}", styles['TitleStyle']))
-    story.append(Spacer(1, 0.2 * inch))
-
-    # Información de la consulta
-    story.append(Paragraph("<b>Fecha y Hora:</b> " + datetime.now().strftime("%Y-%m-%d %H:%M:%S"), styles['CustomBodyText'])) # Usar el nuevo nombre del estilo aquí
-    story.append(Spacer(1, 0.1 * inch))
-
-    # Pregunta del Usuario
-    story.append(Paragraph("<b>Pregunta del Usuario:</b>", styles['CustomHeading2']))
-    story.append(Paragraph(request.question, styles['CustomBodyText'])) # Usar el nuevo nombre del estilo aquí
-    story.append(Spacer(1, 0.3 * inch))
-
-    # Respuesta de Elendur
-    story.append(Paragraph("<b>Respuesta de Elendur:</b>", styles['CustomHeading2']))
-    story.append(Paragraph(request.answer, styles['CustomBodyText'])) # Usar el nuevo nombre del estilo aquí
-    story.append(Spacer(1, 0.5 * inch))
-
-    # Pie de página
-    story.append(Paragraph(f"Generado por {ASSISTANT_NAME}, tu especialista en la obra de J.R.R. Tolkien.", styles['Footer']))
-
     try:
-        doc.build(story)
-        buffer.seek(0)
-        return StreamingResponse(buffer,
+        pdf = await pdf_renderer.render(request.question, request.answer)
+        return StreamingResponse(io.BytesIO(pdf),
                                  media_type="application/pdf",
                                  headers={"Content-Disposition": "attachment; filename=consulta_Elendur.pdf"})
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error al generar el PDF: {e}"
-        )
\ No newline at end of file
+        )
+
+
+@app.post("/generate-dossier", summary="Genera un dossier PDF con muchas preguntas y respuestas")
+async def generate_dossier(request: DossierRequest, raw_request: Request):
+    """
+    Genera un único PDF con índice a partir de una lista de preguntas y respuestas
+    (p. ej. la salida de un trabajo de /chat/batch) o, si la lista está vacía, del
+    historial de la sesión actual. El PDF se escribe página a página y se envía
+    según se genera, sin guardarlo entero en memoria.
+    """
+    entries = [(entry.question, entry.answer) for entry in request.entries]
+    if not entries and session_store is not None:
+        entries = entries_from_history(await session_store.load(_get_session_id(raw_request)))
+    if not entries:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El dossier no tiene preguntas: envía 'entries' o usa una sesión con conversación."
+        )
+    if len(entries) > DOSSIER_MAX_ENTRIES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"El dossier tiene {len(entries)} preguntas; el máximo es {DOSSIER_MAX_ENTRIES}."
+        )
+    title = request.title or f"Dossier de estudio con {ASSISTANT_NAME}"
+    # Generador síncrono: Starlette lo recorre en el pool de hilos, fuera del event loop
+    return StreamingResponse(iter_dossier_pdf(entries, title, ASSISTANT_NAME),
+                             media_type="application/pdf",
+                             headers={"Content-Disposition": "attachment; filename=dossier_Elendur.pdf"})
@@ -0,0 +1,430 @@
+"""
+Métricas en formato de texto de Prometheus y trazas por petición.
+
+- Contadores e histogramas propios (sin dependencias): la observación es una
+  búsqueda binaria en los límites de los buckets y un par de sumas, de modo que
+  se puede llamar en el camino caliente de /chat.
+- `stage("generation")` mide una etapa del pipeline (generación, clasificación,
+  caché, recuperación, correo, PDF...) en el histograma
+  `elendur_stage_seconds{stage=...}` y, si hay una traza activa, añade el span.
+- `MetricsMiddleware` (ASGI puro) mide cada petición HTTP por ruta y, si
+  TRACE_LOG_PATH está definido, escribe una línea JSON por petición con los
+  spans y el instante en que empezó la respuesta. La petición solo encola la
+  traza: un hilo (`TraceWriter`) la serializa y la escribe en el fichero.
+- `monitor_loop_lag` mide cuánto se retrasa el event loop.
+
+Ejecutar `python metricas.py` mide el coste por observación y por petición
+instrumentada.
+"""
+import asyncio
+import bisect
+import contextvars
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional
+
+# Límites de los buckets (en segundos) para latencias
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_trace = contextvars.ContextVar("elendur_trace", default=None)
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """Contador monótono con etiquetas opcionales (los valores se pasan en orden)."""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histograma acumulativo con buckets fijos, por combinación de etiquetas."""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}  # etiquetas -> [conteos por bucket (+Inf al final), suma]
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        # Conteos no acumulados: se acumulan al exportar
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                label_text = _format_labels(self.labelnames + ("le",), labels + (le,))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            base = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{base} {total}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def render_stats(prefix: str, stats: dict, help_text: str = "", gauges: frozenset = frozenset()) -> str:
+    """
+    Exporta los valores numéricos de un diccionario de estadísticas (los `get_stats()`
+    de la caché, la cola de correo, etc.) como métricas `prefix_clave`.
+    Las claves de `gauges` (tamaños, ocupación, tasas) se exportan como gauge y el
+    resto como counter: son los contadores monótonos de `stats` sobre los que se
+    calcula `rate()`.
+    """
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = f"{prefix}_{key}"
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {'gauge' if key in gauges else 'counter'}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+# --- Métricas del pipeline ---
+registry = MetricsRegistry()
+STAGE_SECONDS = registry.histogram(
+    "elendur_stage_seconds", "Duración de cada etapa del pipeline.", ("stage",))
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "elendur_http_request_seconds", "Duración total de las peticiones HTTP.", ("route", "method", "status"))
+HTTP_RESPONSE_START_SECONDS = registry.histogram(
+    "elendur_http_response_start_seconds", "Tiempo hasta el inicio de la respuesta HTTP.", ("route", "method"))
+UPSTREAM_TOKENS = registry.counter(
+    "elendur_upstream_tokens_total", "Tokens consumidos en las llamadas a Gemini.", ("purpose", "kind"))
+TRACE_RECORDS_DROPPED = registry.counter(
+    "elendur_trace_records_dropped_total", "Trazas descartadas porque la cola de escritura estaba llena.")
+LOOP_LAG_SECONDS = registry.histogram(
+    "elendur_event_loop_lag_seconds", "Retraso del event loop respecto a un sleep periódico.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+class _Trace:
+    __slots__ = ("trace_id", "start", "spans")
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.spans = []
+
+
+def record_stage(name: str, start: float, end: float, failed: bool = False) -> None:
+    """Registra una etapa medida a mano con `time.perf_counter()` (p. ej. dentro de un generador)."""
+    STAGE_SECONDS.observe(end - start, name)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((name, start - trace.start, end - start, failed))
+
+
+class stage:
+    """
+    Mide una etapa: `with stage("classification"): ...`.
+    Sirve en código síncrono y asíncrono (el bloque puede contener awaits).
+    """
+    __slots__ = ("name", "_start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_stage(self.name, self._start, time.perf_counter(), exc_type is not None)
+        return False
+
+
+def record_usage(response, purpose: str) -> None:
+    """Suma los tokens del `usage_metadata` de una respuesta de Gemini (si lo trae)."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, field in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        value = getattr(usage, field, None)
+        if value:
+            UPSTREAM_TOKENS.inc(value, purpose, kind)
+
+
+def _trace_record(trace: _Trace, route_path: str, method: str, status: int,
+                  response_start: Optional[float], end: float, ts: float) -> dict:
+    return {
+        "trace_id": trace.trace_id,
+        "ts": ts,
+        "route": route_path,
+        "method": method,
+        "status": status,
+        "duration_ms": round((end - trace.start) * 1000, 3),
+        "response_start_ms": (round((response_start - trace.start) * 1000, 3)
+                              if response_start is not None else None),
+        "spans": [
+            {"stage": name, "start_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3),
+             "error": failed}
+            for name, offset, duration, failed in trace.spans
+        ],
+    }
+
+
+class TraceWriter:
+    """
+    Escribe las trazas desde un hilo propio: la petición solo encola los datos y el
+    hilo monta el JSON y escribe la línea. Si la cola está llena, la traza se descarta.
+    """
+
+    def __init__(self, path: str, max_pending: int = 10000):
+        self.path = path
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, *args) -> None:
+        """Encola los argumentos de `_trace_record` (no bloquea)."""
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(args)
+        except queue.Full:
+            TRACE_RECORDS_DROPPED.inc()
+
+    def _start(self) -> None:
+        # El hilo se crea con la primera traza, no al importar (los workers se crean con fork)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trazas", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        trace_file = None
+        while True:
+            args = self._queue.get()
+            if args is None:
+                break
+            try:
+                if trace_file is None:
+                    trace_file = open(self.path, "a", encoding="utf-8")
+                trace_file.write(json.dumps(_trace_record(*args), ensure_ascii=False) + "\n")
+                # Se vuelca al fichero cuando no quedan trazas pendientes
+                if self._queue.empty():
+                    trace_file.flush()
+            except OSError as e:
+                print(f"Error al escribir la traza en '{self.path}': {e}")
+        if trace_file is not None:
+            trace_file.close()
+
+    def close(self, timeout: float = 5) -> None:
+        """Escribe las trazas pendientes y detiene el hilo."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            print("No se pudieron escribir todas las trazas pendientes.")
+            return
+        thread.join(timeout)
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: mide duración y tiempo hasta el inicio de la respuesta por ruta
+    y, con `trace_log_path`, escribe una traza JSON por petición (en un hilo).
+    """
+
+    def __init__(self, app, trace_log_path: Optional[str] = None, excluded_paths: tuple = ("/metrics",)):
+        self.app = app
+        self.trace_log_path = trace_log_path
+        self.excluded_paths = excluded_paths
+        self.trace_writer = TraceWriter(trace_log_path) if trace_log_path else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan" and self.trace_writer is not None:
+            await self.app(scope, receive, self._closing_send(send))
+            return
+        if scope["type"] != "http" or scope["path"] in self.excluded_paths:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        state = {"status": 500, "response_start": None}
+        trace = None
+        token = None
+        if self.trace_writer is not None:
+            trace = _Trace()
+            token = _current_trace.set(trace)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                state["response_start"] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            end = time.perf_counter()
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "desconocida"
+            method = scope["method"]
+            HTTP_REQUEST_SECONDS.observe(end - start, route_path, method, state["status"])
+            if state["response_start"] is not None:
+                HTTP_RESPONSE_START_SECONDS.observe(state["response_start"] - start, route_path, method)
+            if trace is not None:
+                _current_trace.reset(token)
+                self.trace_writer.submit(trace, route_path, method, state["status"],
+                                         state["response_start"], end, time.time())
+
+    def _closing_send(self, send):
+        """Al terminar el apagado de la app se escriben las trazas pendientes."""
+        async def lifespan_send(message):
+            if message["type"] == "lifespan.shutdown.complete":
+                await asyncio.to_thread(self.trace_writer.close)
+            await send(message)
+        return lifespan_send
+
+
+async def monitor_loop_lag(interval_seconds: float = 0.5) -> None:
+    """Tarea de fondo: registra cuánto tarda de más un sleep de `interval_seconds`."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval_seconds)
+        LOOP_LAG_SECONDS.observe(max(loop.time() - start - interval_seconds, 0.0))
+
+
+def run_overhead_benchmark(iterations: int = 200_000) -> dict:
+    """Coste medio de una observación de histograma y de un `stage()` con y sin traza."""
+    histogram = Histogram("bench_seconds", "bench", ("stage",))
+    start = time.perf_counter()
+    for i in range(iterations):
+        histogram.observe(0.0123, "generation")
+    observe_ns = (time.perf_counter() - start) / iterations * 1e9
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        with stage("bench"):
+            pass
+    stage_ns = (time.perf_counter() - start) / iterations * 1e9
+
+    token = _current_trace.set(_Trace())
+    start = time.perf_counter()
+    for i in range(iterations):
+        with stage("bench"):
+            pass
+    traced_stage_ns = (time.perf_counter() - start) / iterations * 1e9
+    _current_trace.reset(token)
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        pass
+    empty_ns = (time.perf_counter() - start) / iterations * 1e9
+    return {
+        "observe_ns": observe_ns - empty_ns,
+        "stage_ns": stage_ns - empty_ns,
+        "traced_stage_ns": traced_stage_ns - empty_ns,
+    }
+
+
+async def run_middleware_benchmark(requests: int = 5000) -> dict:
+    """Latencia por petición de una app ASGI mínima con y sin MetricsMiddleware."""
+    async def app(scope, receive, send):
+        with stage("handler"):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "path": "/chat", "method": "POST"}
+
+    async def measure(handler) -> float:
+        start = time.perf_counter()
+        for _ in range(requests):
+            await handler(dict(scope), receive, send)
+        return (time.perf_counter() - start) / requests * 1e6
+
+    plain_us = await measure(app)
+    instrumented_us = await measure(MetricsMiddleware(app))
+    with tempfile.TemporaryDirectory() as tmp:
+        traced = MetricsMiddleware(app, trace_log_path=os.path.join(tmp, "trazas.jsonl"))
+        traced_us = await measure(traced)
+        traced.trace_writer.close()
+    return {"plain_us": plain_us, "instrumented_us": instrumented_us, "traced_us": traced_us}
+
+
+if __name__ == "__main__":
+    overhead = run_overhead_benchmark()
+    print(f"Observación de histograma: {overhead['observe_ns']:.0f} ns; "
+          f"stage(): {overhead['stage_ns']:.0f} ns; stage() con traza: {overhead['traced_stage_ns']:.0f} ns")
+    middleware = asyncio.run(run_middleware_benchmark())
+    print(f"Petición ASGI mínima: {middleware['plain_us']:.1f} µs sin middleware, "
+          f"{middleware['instrumented_us']:.1f} µs con MetricsMiddleware "
+          f"(+{middleware['instrumented_us'] - middleware['plain_us']:.1f} µs)")
+    print(f"Con TRACE_LOG_PATH: {middleware['traced_us']:.1f} µs por petición")
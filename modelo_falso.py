@@ -0,0 +1,214 @@
+"""
+Sustituto local y determinista de `genai.GenerativeModel` para pruebas de carga.
+
+Imita la parte de la API que usa el proyecto: `start_chat(history=...)` y
+`send_message_async(mensaje, generation_config=..., stream=...)`, con respuestas
+que tienen `.text`, `usage_metadata` y, en streaming, iteración asíncrona por
+fragmentos. La latencia sigue una distribución configurable y una fracción de
+las llamadas puede fallar con un 429 o con un error genérico. Con la misma
+semilla, la secuencia de latencias y errores es la misma.
+
+Uso:
+    import modelo_falso
+    modelo_falso.install(latency="lognormal:0.4:0.5", error_rate=0.01)
+    import main  # los modelos de nucleo.model_router son ahora FakeGenerativeModel
+
+Con varios modelos (IA_FAST_MODELS, IA_FALLBACK_MODELS), `per_model` cambia las
+opciones de cada uno por nombre, p. ej. para probar la conmutación por error:
+    modelo_falso.install(per_model={"gemini-pro": {"rate_limit_rate": 0.5}})
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import re
+
+# Variable de entorno con las opciones en JSON (para servidores lanzados en otro proceso)
+OPTIONS_ENV = "FAKE_GEMINI_OPTIONS"
+
+_NUMBERED_QUERY_RE = re.compile(r"^(\d+)\. ", re.MULTILINE)
+
+_ANSWER_SENTENCES = (
+    "Según las crónicas de la Tierra Media, {topic} ocupa un lugar destacado en la historia de Arda.",
+    "Las fuentes principales son El Hobbit, El Señor de los Anillos y El Silmarillion.",
+    "Los Eldar conservaron memoria de estos hechos en sus cantares y anales.",
+    "Tolkien revisó esta parte de su legendarium en varias ocasiones a lo largo de su vida.",
+)
+
+
+# Opciones por defecto del modelo falso. Latencias: "fixed:S", "uniform:MIN:MAX",
+# "lognormal:MEDIANA:SIGMA", "exponential:MEDIA" o "pareto:MÍNIMO:ALFA" (cola pesada;
+# cuanto menor es ALFA, más llamadas muy lentas), en segundos
+DEFAULT_OPTIONS = {
+    "latency": "lognormal:0.4:0.5",
+    "classification_latency": "fixed:0.05",  # llamadas de clasificación (YES/NO)
+    "stream_chunks": 8,  # fragmentos por respuesta en streaming
+    "answer_sentences": 6,
+    "error_rate": 0.0,  # fracción de llamadas que fallan con un error genérico
+    "rate_limit_rate": 0.0,  # fracción de llamadas que fallan con un 429
+    "seed": 0,
+}
+
+
+class FakeRateLimitError(Exception):
+    """Equivalente a google.api_core.exceptions.ResourceExhausted (HTTP 429)."""
+    code = 429
+
+
+class FakeModelError(Exception):
+    code = 500
+
+
+class _UsageMetadata:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeResponse:
+    def __init__(self, text: str, prompt: str):
+        self.text = text
+        self.usage_metadata = _UsageMetadata(len(prompt) // 4 + 1, len(text) // 4 + 1)
+
+
+class FakeStreamResponse:
+    """Respuesta en streaming: los fragmentos llegan repartidos a lo largo de `duration`."""
+
+    def __init__(self, text: str, prompt: str, chunks: int, first_chunk_delay: float, duration: float):
+        self._text = text
+        self._prompt = prompt
+        self._chunks = max(chunks, 1)
+        self._first_chunk_delay = first_chunk_delay
+        self._duration = duration
+        self.usage_metadata = None  # Como en Gemini, disponible al terminar el streaming
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        size = math.ceil(len(self._text) / self._chunks)
+        pieces = [self._text[i:i + size] for i in range(0, len(self._text), size)]
+        interval = max(self._duration - self._first_chunk_delay, 0) / max(len(pieces) - 1, 1)
+        await asyncio.sleep(self._first_chunk_delay)
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(interval)
+            yield _Chunk(piece)
+        self.usage_metadata = _UsageMetadata(len(self._prompt) // 4 + 1, len(self._text) // 4 + 1)
+
+
+def _parse_distribution(spec: str):
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda rng: rng.lognormvariate(math.log(median), sigma)
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == "pareto":
+        minimum, alpha = values
+        return lambda rng: minimum * rng.paretovariate(alpha)
+    raise ValueError(f"Distribución de latencia desconocida: '{spec}'")
+
+
+class FakeGenerativeModel:
+    """Modelo falso compartido por todas las sesiones (como cada modelo de nucleo.model_router)."""
+
+    def __init__(self, model_name: str = "fake", system_instruction: str = None, **options):
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f"Opciones desconocidas del modelo falso: {sorted(unknown)}")
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self._rng = random.Random(self.options["seed"])
+        self._latency = _parse_distribution(self.options["latency"])
+        self._classification_latency = _parse_distribution(self.options["classification_latency"])
+        self.stats = {"calls": 0, "classification_calls": 0, "stream_calls": 0, "errors": 0, "rate_limited": 0}
+
+    def start_chat(self, history: list = None):
+        return FakeChatSession(self, history or [])
+
+    def _draw(self, classification: bool) -> tuple:
+        """Latencia y error de la siguiente llamada (en orden de llegada, reproducible)."""
+        latency = (self._classification_latency if classification else self._latency)(self._rng)
+        roll = self._rng.random()
+        if roll < self.options["rate_limit_rate"]:
+            return latency, FakeRateLimitError("429 Resource has been exhausted (fake)")
+        if roll < self.options["rate_limit_rate"] + self.options["error_rate"]:
+            return latency, FakeModelError("500 Internal error (fake)")
+        return latency, None
+
+    def _answer(self, message: str) -> str:
+        topic = message.strip().rstrip("?").lstrip("¿")[:60] or "esta cuestión"
+        sentences = [_ANSWER_SENTENCES[i % len(_ANSWER_SENTENCES)] for i in range(self.options["answer_sentences"])]
+        return " ".join(sentences).format(topic=topic)
+
+
+class FakeChatSession:
+    def __init__(self, model: FakeGenerativeModel, history: list):
+        self.model = model
+        self.history = history
+
+    async def send_message_async(self, message: str, generation_config: dict = None, stream: bool = False):
+        model = self.model
+        classification = "(YES/NO)" in message
+        model.stats["calls"] += 1
+        if classification:
+            model.stats["classification_calls"] += 1
+        latency, error = model._draw(classification)
+        if error is not None:
+            # Los errores llegan antes que una respuesta completa
+            await asyncio.sleep(latency * 0.2)
+            model.stats["rate_limited" if isinstance(error, FakeRateLimitError) else "errors"] += 1
+            raise error
+        if classification:
+            await asyncio.sleep(latency)
+            # Clasificación en lote (lotes.py): un veredicto por consulta numerada
+            numbers = _NUMBERED_QUERY_RE.findall(message)
+            text = "\n".join(f"{number}: YES" for number in numbers) if numbers else "YES"
+            return FakeResponse(text, message)
+
+        prompt = message + "".join(part for turn in self.history for part in turn["parts"])
+        text = model._answer(message)
+        if stream:
+            model.stats["stream_calls"] += 1
+            # El primer fragmento llega en torno a una cuarta parte de la latencia total
+            return FakeStreamResponse(text, prompt, model.options["stream_chunks"], latency * 0.25, latency)
+        await asyncio.sleep(latency)
+        return FakeResponse(text, prompt)
+
+
+def install(per_model: dict = None, **options) -> None:
+    """
+    Sustituye `genai.GenerativeModel` y `genai.configure` antes de importar main.py o nucleo.py,
+    y define las variables de entorno mínimas para que arranque sin clave real.
+    `per_model` ({nombre: opciones}) sobrescribe las opciones de modelos concretos.
+    """
+    import google.generativeai as genai
+
+    per_model = per_model or {}
+    os.environ.setdefault("GEMINI_API_KEY", "fake-key")
+    os.environ.setdefault("IA_GENERATIVE_MODEL", "fake")
+    os.environ[OPTIONS_ENV] = json.dumps({**options, "per_model": per_model} if per_model else options)
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = lambda model_name, system_instruction=None, **kwargs: FakeGenerativeModel(
+        model_name, system_instruction, **{**options, **per_model.get(model_name, {})})
+
+
+def install_from_env() -> dict:
+    """Instala el modelo falso con las opciones de FAKE_GEMINI_OPTIONS (o las de por defecto)."""
+    options = json.loads(os.getenv(OPTIONS_ENV) or "{}")
+    install(**options)
+    return options
@@ -0,0 +1,855 @@
+"""
+Núcleo del asistente, compartido por la API web (main.py) y el asistente de
+línea de comandos (asistente_conversacion.py).
+
+Reúne la configuración (.env), la personalidad, el enrutador de modelos, las
+cachés, las sesiones, la cola de correo, el generador de PDF, el control de
+admisión y la generación de respuestas (completas o en streaming). Así, cada
+mejora de rendimiento sirve a los dos puntos de entrada.
+
+Uso desde un punto de entrada:
+
+    import nucleo
+    await nucleo.start()         # modelos en segundo plano, correo, PDF, purga de sesiones
+    async with aclosing(nucleo.answer_events(pregunta, historial)) as events:
+        async for kind, value in events:
+            ...
+    await nucleo.stop()
+
+El estado que se reasigna al arrancar (`model_router`, `model_error`) debe
+leerse como `nucleo.model_router`, no importarse con `from nucleo import`.
+"""
+import os
+import asyncio
+import hashlib
+import time
+import weakref
+from contextlib import aclosing
+from dotenv import load_dotenv
+from typing import Optional
+
+# Cola asíncrona para enviar correo
+from cola_correo import MailQueue
+
+# Generación de PDF en un pool de procesos
+from generador_pdf import PdfRenderer
+
+# Control de admisión (límites de tasa y de concurrencia hacia Gemini)
+from control_admision import AdmissionController
+
+# Métricas por etapa
+from metricas import stage, record_stage, record_usage
+
+# Enrutado entre varios modelos (nivel rápido y nivel grande, con conmutación por error)
+from enrutador_modelos import ModelRouter, RoutedModel, TIER_FAST, TIER_LARGE
+
+# Peticiones de cobertura (copia de la llamada si tarda más que el p90 reciente)
+from cobertura import Hedger
+
+# Coalescencia de peticiones idénticas en vuelo
+from coalescencia import SingleFlight
+
+# Sesiones de conversación
+from sesiones import MemorySessionStore, SQLiteSessionStore, append_turn, purge_expired_periodically
+
+# Pre-clasificador local (sin llamadas al modelo)
+from clasificador_local import pre_classify
+
+# Caché de respuestas
+from cache_respuestas import AnswerCache, MemoryCache, SQLiteCache, make_cache_key
+from cache_respuestas import purge_expired_periodically as purge_expired_answers_periodically
+
+# Respuestas precalculadas de preguntas frecuentes y populares
+from precalculo import PrecomputedAnswers, PopularityLog, read_seed_questions, select_questions, precompute, write_store, refresh_periodically
+
+# --- 1. Cargar variables del archivo .env ---
+load_dotenv()
+
+def _env_bool(name: str, default: bool) -> bool:
+    """Lee una variable de entorno booleana ('true', '1', 'yes', 'si')."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "si", "sí")
+
+# --- Configuración global del asistente y correo ---
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+IA_GENERATIVE_MODEL_NAME = os.getenv("IA_GENERATIVE_MODEL")
+# Modelos adicionales, separados por comas: el nivel rápido (clasificación y preguntas
+# sencillas) y los de respaldo del nivel grande, que se usan si IA_GENERATIVE_MODEL falla
+IA_FAST_MODELS = [name.strip() for name in os.getenv("IA_FAST_MODELS", "").split(",") if name.strip()]
+IA_FALLBACK_MODELS = [name.strip() for name in os.getenv("IA_FALLBACK_MODELS", "").split(",") if name.strip()]
+
+# Credenciales de correo
+SENDER_EMAIL = os.getenv("EMAIL_ADDRESS")
+SENDER_PASSWORD = os.getenv("EMAIL_PASSWORD")
+SMTP_SERVER = os.getenv("SMTP_SERVER")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = _env_bool("SMTP_STARTTLS", True)
+SMTP_AUTH = _env_bool("SMTP_AUTH", True) # false solo para servidores locales sin AUTH
+
+# Cola de envío de correo
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", 2)) # Conexiones SMTP persistentes
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 100))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 3))
+
+# Generación de PDF (0 workers = se genera en un hilo en lugar de un pool de procesos)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", 2))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", 32 * 2**20))
+
+# Sesiones de conversación (desactivadas por defecto: sin ellas no se guarda nada)
+SESSIONS_ENABLED = _env_bool("SESSIONS_ENABLED", False)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory") # memory o sqlite
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sesiones.sqlite3")
+SESSION_RETENTION_SECONDS = float(os.getenv("SESSION_RETENTION_SECONDS", 1800)) # Inactividad máxima
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", 4000)) # Tokens de historial antes de compactar
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", 20))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", 10000)) # Solo backend en memoria
+
+# Control de admisión (0 = sin límite de tasa)
+RATE_LIMIT_GLOBAL_RPS = float(os.getenv("RATE_LIMIT_GLOBAL_RPS", 0))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", 0))
+# El límite por cliente va por IP: detrás de un proxy inverso todos comparten la
+# del proxy, así que está desactivado salvo que se configure RATE_LIMIT_TRUSTED_PROXIES
+RATE_LIMIT_CLIENT_RPS = float(os.getenv("RATE_LIMIT_CLIENT_RPS", 0))
+RATE_LIMIT_CLIENT_BURST = float(os.getenv("RATE_LIMIT_CLIENT_BURST", 10))
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", 0)) # Proxies de confianza delante de la app (X-Forwarded-For)
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", 16)) # Llamadas a Gemini en vuelo
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", 64)) # Peticiones esperando un hueco
+UPSTREAM_QUEUE_DEADLINE_SECONDS = float(os.getenv("UPSTREAM_QUEUE_DEADLINE_SECONDS", 10))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 2)) # Reintentos ante un 429 del modelo
+UPSTREAM_RETRY_BACKOFF_SECONDS = float(os.getenv("UPSTREAM_RETRY_BACKOFF_SECONDS", 0.5))
+
+# Arranque: el modelo se construye en el lifespan y las peticiones esperan a que esté listo
+MODEL_WARMUP = _env_bool("MODEL_WARMUP", True) # Abrir la conexión con Gemini al arrancar (count_tokens)
+MODEL_WARMUP_TIMEOUT_SECONDS = float(os.getenv("MODEL_WARMUP_TIMEOUT_SECONDS", 5))
+MODEL_INIT_WAIT_SECONDS = float(os.getenv("MODEL_INIT_WAIT_SECONDS", 10))
+
+# Enrutado entre modelos (solo tiene efecto con IA_FAST_MODELS o IA_FALLBACK_MODELS)
+ROUTER_COMPLEXITY_THRESHOLD = float(os.getenv("ROUTER_COMPLEXITY_THRESHOLD", 0.3)) # Desde aquí, modelo grande
+ROUTER_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("ROUTER_ATTEMPT_TIMEOUT_SECONDS", 20)) # Antes de pasar al siguiente
+ROUTER_SLOW_SECONDS = float(os.getenv("ROUTER_SLOW_SECONDS", 10)) # Latencia media que degrada un modelo
+ROUTER_ERROR_THRESHOLD = float(os.getenv("ROUTER_ERROR_THRESHOLD", 0.5)) # Tasa de errores que degrada un modelo
+ROUTER_COOLDOWN_SECONDS = float(os.getenv("ROUTER_COOLDOWN_SECONDS", 30)) # Pausa de un modelo tras un 429
+
+# Peticiones de cobertura en la generación de /chat
+HEDGE_ENABLED = _env_bool("HEDGE_ENABLED", False)
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", 0.9)) # Cuantil de latencia tras el que se lanza la copia
+HEDGE_MAX_EXTRA_RATIO = float(os.getenv("HEDGE_MAX_EXTRA_RATIO", 0.05)) # Llamadas extra como fracción del total
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", 0.5)) # Espera mínima antes de la copia
+
+# Recuperación local sobre un corpus de referencia (índice creado con `python indice_corpus.py ingest`)
+RAG_INDEX_PATH = os.getenv("RAG_INDEX_PATH")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", 3))
+RAG_CONTEXT_MAX_CHARS = int(os.getenv("RAG_CONTEXT_MAX_CHARS", 3000))
+RAG_RETRIEVAL_ONLY = _env_bool("RAG_RETRIEVAL_ONLY", False) # Responder entradas claras del glosario sin llamar al modelo
+
+# Tiempos máximos (en segundos) para las llamadas al modelo
+CHAT_TIMEOUT_SECONDS = float(os.getenv("CHAT_TIMEOUT_SECONDS", 60))
+CLASSIFICATION_TIMEOUT_SECONDS = float(os.getenv("CLASSIFICATION_TIMEOUT_SECONDS", 5))
+# Veredicto usado si la clasificación tarda demasiado o falla
+CLASSIFICATION_DEFAULT = _env_bool("CLASSIFICATION_DEFAULT", False)
+
+# Caché de respuestas (memoria y, opcionalmente, SQLite compartido entre workers)
+CACHE_ENABLED = _env_bool("CACHE_ENABLED", True)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 3600))
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH")
+CACHE_SQLITE_MAX_ROWS = int(os.getenv("CACHE_SQLITE_MAX_ROWS", 100000)) # Entradas máximas del fichero
+CACHE_SQLITE_PURGE_SECONDS = float(os.getenv("CACHE_SQLITE_PURGE_SECONDS", 300)) # Limpieza periódica
+
+# Caché semántica (preguntas casi iguales), requiere numpy
+SEMANTIC_CACHE_ENABLED = _env_bool("SEMANTIC_CACHE_ENABLED", False)
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.75))
+SEMANTIC_CACHE_CAPACITY = int(os.getenv("SEMANTIC_CACHE_CAPACITY", 10000))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", 512))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH")
+
+# Respuestas precalculadas (fichero creado con `python precalculo.py build` o regenerado en segundo plano)
+PRECOMPUTED_PATH = os.getenv("PRECOMPUTED_PATH")
+PRECOMPUTED_SEED_PATH = os.getenv("PRECOMPUTED_SEED_PATH", "preguntas_frecuentes.txt")
+PRECOMPUTED_TOP_N = int(os.getenv("PRECOMPUTED_TOP_N", 500)) # Preguntas máximas en el fichero
+PRECOMPUTED_CONCURRENCY = int(os.getenv("PRECOMPUTED_CONCURRENCY", 2)) # Llamadas simultáneas al regenerar
+PRECOMPUTED_REFRESH = _env_bool("PRECOMPUTED_REFRESH", True) # Regenerar si cambia el modelo o el prompt
+PRECOMPUTED_MAX_AGE_SECONDS = float(os.getenv("PRECOMPUTED_MAX_AGE_SECONDS", 86400)) # 0 = solo al cambiar
+PRECOMPUTED_CHECK_SECONDS = float(os.getenv("PRECOMPUTED_CHECK_SECONDS", 300))
+# Registro de popularidad (opcional, desactivado por defecto): solo el texto normalizado de las preguntas sobre Tolkien
+POPULARITY_LOG_PATH = os.getenv("POPULARITY_LOG_PATH")
+POPULARITY_MIN_COUNT = int(os.getenv("POPULARITY_MIN_COUNT", 3)) # Repeticiones mínimas para precalcular una pregunta
+POPULARITY_FLUSH_SECONDS = float(os.getenv("POPULARITY_FLUSH_SECONDS", 30))
+
+
+class ConfigurationError(Exception):
+    """Falta configuración imprescindible en el .env."""
+
+
+def check_config() -> None:
+    """
+    Verifica que las claves y credenciales necesarias están presentes.
+    Se comprueba al arrancar (start), no al importar: así el módulo se puede
+    importar sin .env (pruebas, `precalculo.py show`, herramientas).
+    """
+    if not GEMINI_API_KEY:
+        raise ConfigurationError("La clave de API de Gemini (GEMINI_API_KEY) no se encontró en el archivo .env")
+    if not IA_GENERATIVE_MODEL_NAME:
+        raise ConfigurationError("El nombre del modelo generativo (IA_GENERATIVE_MODEL) no se encontró en el archivo .env. Debes especificar qué modelo usar (ej. gemini-pro).")
+
+
+EMAIL_SENDING_AVAILABLE = False
+if all([SENDER_EMAIL, SENDER_PASSWORD, SMTP_SERVER]):
+    EMAIL_SENDING_AVAILABLE = True
+    print("Funcionalidad de envío de correo disponible.")
+else:
+    print("Advertencia: Las credenciales de correo (EMAIL_ADDRESS, EMAIL_PASSWORD, SMTP_SERVER) no se encontraron en el archivo .env.")
+    print("La funcionalidad de envío de correo NO estará disponible.")
+
+# --- 2. Definir la personalidad o instrucciones del sistema (TU PROMPT DE COMPORTAMIENTO) ---
+PERSONA_PROMPT = """
+Eres un asistente de IA llamado Elendur.
+Tu rol es el de un **académico y especialista riguroso** en la obra completa de J.R.R. Tolkien y toda la mitología de Arda (incluyendo libros, manuscritos, lenguajes y estudios relevantes).
+Tu objetivo es **proporcionar información precisa y concreta** sobre estos temas, basada estrictamente en el **canon primario y secundario** de Tolkien.
+El tono de tus respuestas debe ser **formal, objetivo y académico**. Evita cualquier expresión de familiaridad, entusiasmo o uso de emojis.
+Responde a las preguntas **directamente y con concisión**, enfocándote en los hechos y detalles relevantes.
+Si la información solicitada es especulativa, no confirmada en las obras de Tolkien, o si no tienes datos disponibles, **indícalo de manera clara y formal**, mencionando la limitación o la fuente (o falta de ella).
+Siempre busca ofrecer la información más **relevante y verificable** dentro del ámbito académico de los estudios de Tolkien.
+Mantén siempre tu identidad como Elendur, el especialista académico en Tolkien.
+"""
+
+# Extraer el nombre del asistente del prompt
+try:
+    name_line = next((line for line in PERSONA_PROMPT.splitlines() if "llamado " in line), "")
+    if "llamado " in name_line:
+         ASSISTANT_NAME = name_line.split('llamado ')[-1].split('.')[0].strip()
+    else:
+         ASSISTANT_NAME = "Elendur (Asistente Académico)"
+except Exception as e:
+     print(f"Error al extraer nombre del prompt: {e}")
+     ASSISTANT_NAME = "Elendur (Asistente Académico)"
+
+
+# --- 3. Modelos de Gemini CON la personalidad ---
+# google.generativeai tarda más de un segundo en importarse: los modelos se construyen
+# en el arranque de la app (lifespan), en un hilo, y no al importar este módulo.
+model_router = None
+model_error = None # Motivo por el que el modelo no está disponible (se muestra en /health/ready)
+
+
+def build_router(make_model) -> ModelRouter:
+    """Construye el enrutador; `make_model(nombre)` crea cada modelo."""
+    large_names = [IA_GENERATIVE_MODEL_NAME] + [name for name in IA_FALLBACK_MODELS if name != IA_GENERATIVE_MODEL_NAME]
+    return ModelRouter(
+        fast=[RoutedModel(name, TIER_FAST, make_model(name)) for name in IA_FAST_MODELS],
+        large=[RoutedModel(name, TIER_LARGE, make_model(name)) for name in large_names],
+        complexity_threshold=ROUTER_COMPLEXITY_THRESHOLD,
+        attempt_timeout_seconds=ROUTER_ATTEMPT_TIMEOUT_SECONDS,
+        slow_seconds=ROUTER_SLOW_SECONDS,
+        error_threshold=ROUTER_ERROR_THRESHOLD,
+        cooldown_seconds=ROUTER_COOLDOWN_SECONDS,
+    )
+
+
+def load_model() -> None:
+    """Importa google.generativeai y construye los modelos (bloqueante)."""
+    global model_router, model_error
+    try:
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        model_router = build_router(lambda name: genai.GenerativeModel(name, system_instruction=PERSONA_PROMPT))
+        model_error = None
+        print(f"Modelos configurados correctamente: {', '.join(m.name for m in model_router.models)}.")
+    except Exception as e:
+        model_error = str(e)
+        print(f"Error al configurar la API de Gemini o cargar el modelo '{IA_GENERATIVE_MODEL_NAME}': {e}")
+        print("Verifica tu clave de API de Gemini o la disponibilidad del modelo especificado en .env para chat.")
+
+
+async def initialize_model() -> None:
+    """Construye los modelos sin bloquear el event loop y, opcionalmente, los calienta."""
+    await asyncio.to_thread(load_model)
+    if model_router is None or not MODEL_WARMUP:
+        return
+    await asyncio.gather(*(warm_up_model(routed) for routed in model_router.models))
+
+
+async def warm_up_model(routed: RoutedModel) -> None:
+    # count_tokens abre la conexión con la API sin consumir cuota de generación
+    count_tokens = getattr(routed.backend, "count_tokens_async", None)
+    if count_tokens is None:
+        return
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(count_tokens("Hola"), timeout=MODEL_WARMUP_TIMEOUT_SECONDS)
+        print(f"Conexión con el modelo '{routed.name}' calentada en {time.perf_counter() - start:.2f}s.")
+    except Exception as e:
+        print(f"No se pudo calentar la conexión con el modelo '{routed.name}': {e}")
+
+
+class ModelUnavailable(Exception):
+    """El modelo no está listo (arrancando o mal configurado)."""
+
+
+_model_init = None # Tarea de initialize_model lanzada por start()
+
+
+async def wait_for_model() -> None:
+    """
+    Espera a que el modelo esté listo (como mucho MODEL_INIT_WAIT_SECONDS).
+    Las primeras peticiones tras el arranque esperan en lugar de fallar.
+    Lanza ModelUnavailable si no lo está a tiempo.
+    """
+    if model_router is not None:
+        return
+    if _model_init is not None and not _model_init.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(_model_init), timeout=MODEL_INIT_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    if model_router is None:
+        raise ModelUnavailable("El asistente se está iniciando o el modelo no está disponible. Inténtalo en unos segundos.")
+
+
+def model_starting() -> bool:
+    """True mientras los modelos se están construyendo en segundo plano."""
+    return _model_init is not None and not _model_init.done()
+
+
+# --- Caché de respuestas ---
+answer_cache = None
+if CACHE_ENABLED:
+    shared_cache = SQLiteCache(CACHE_SQLITE_PATH, ttl_seconds=CACHE_TTL_SECONDS, max_rows=CACHE_SQLITE_MAX_ROWS) if CACHE_SQLITE_PATH else None
+    answer_cache = AnswerCache(MemoryCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS), shared_cache)
+    print(f"Caché de respuestas activada ({'memoria + SQLite' if shared_cache else 'memoria'}).")
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    from cache_semantica import SemanticCache
+    semantic_namespace = hashlib.sha256(f"{IA_GENERATIVE_MODEL_NAME}\x1f{PERSONA_PROMPT}".encode("utf-8")).hexdigest()
+    semantic_cache = SemanticCache(
+        capacity=SEMANTIC_CACHE_CAPACITY,
+        dim=SEMANTIC_CACHE_DIM,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        namespace=semantic_namespace,
+    )
+    if SEMANTIC_CACHE_PATH and semantic_cache.load(SEMANTIC_CACHE_PATH):
+        print(f"Caché semántica cargada desde '{SEMANTIC_CACHE_PATH}' ({semantic_cache.count} entradas).")
+    else:
+        print("Caché semántica activada.")
+
+
+# --- Respuestas precalculadas ---
+# Cambiar de modelo o de prompt invalida el fichero y provoca que se regenere
+precomputed_namespace = hashlib.sha256(f"{IA_GENERATIVE_MODEL_NAME}\x1f{PERSONA_PROMPT}".encode("utf-8")).hexdigest()
+precomputed_answers = None
+if PRECOMPUTED_PATH:
+    precomputed_answers = PrecomputedAnswers(PRECOMPUTED_PATH, precomputed_namespace)
+    if precomputed_answers.load():
+        print(f"Respuestas precalculadas cargadas desde '{PRECOMPUTED_PATH}' ({precomputed_answers.store.count} entradas).")
+
+popularity_log = None
+if POPULARITY_LOG_PATH:
+    popularity_log = PopularityLog(POPULARITY_LOG_PATH)
+    print(f"Registro de popularidad de preguntas activado ('{POPULARITY_LOG_PATH}').")
+
+
+# --- Cola de envío de correo ---
+mail_queue = None
+if EMAIL_SENDING_AVAILABLE:
+    mail_queue = MailQueue(
+        SMTP_SERVER, SMTP_PORT,
+        sender_email=SENDER_EMAIL,
+        sender_name=f"{ASSISTANT_NAME} (Asistente)",
+        username=SENDER_EMAIL,
+        password=SENDER_PASSWORD,
+        use_starttls=SMTP_STARTTLS,
+        use_auth=SMTP_AUTH,
+        workers=MAIL_WORKERS,
+        max_queue=MAIL_QUEUE_SIZE,
+        max_attempts=MAIL_MAX_ATTEMPTS,
+    )
+
+# --- Generación de PDF ---
+pdf_renderer = PdfRenderer(ASSISTANT_NAME, workers=PDF_WORKERS, cache_max_bytes=PDF_CACHE_MAX_BYTES)
+
+# --- Sesiones de conversación ---
+session_store = None
+if SESSIONS_ENABLED:
+    if SESSION_BACKEND == "sqlite":
+        session_store = SQLiteSessionStore(SESSION_SQLITE_PATH, retention_seconds=SESSION_RETENTION_SECONDS)
+    else:
+        session_store = MemorySessionStore(retention_seconds=SESSION_RETENTION_SECONDS, max_sessions=SESSION_MAX_SESSIONS)
+    print(f"Sesiones de conversación activadas (almacén: {SESSION_BACKEND}, retención: {SESSION_RETENTION_SECONDS:.0f}s).")
+
+# --- Índice del corpus de referencia ---
+corpus_index = None
+if RAG_INDEX_PATH:
+    from indice_corpus import CorpusIndex, format_context
+    try:
+        corpus_index = CorpusIndex(RAG_INDEX_PATH)
+        print(f"Índice de referencia cargado desde '{RAG_INDEX_PATH}' ({corpus_index.meta['passages']} pasajes).")
+    except Exception as e:
+        print(f"Error al cargar el índice de referencia '{RAG_INDEX_PATH}': {e}")
+        print("Las respuestas se generarán sin contexto de referencia.")
+
+# --- Control de admisión ---
+admission = AdmissionController(
+    global_rps=RATE_LIMIT_GLOBAL_RPS,
+    global_burst=RATE_LIMIT_GLOBAL_BURST,
+    client_rps=RATE_LIMIT_CLIENT_RPS,
+    client_burst=RATE_LIMIT_CLIENT_BURST,
+    max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+    max_queue=UPSTREAM_MAX_QUEUE,
+    queue_deadline_seconds=UPSTREAM_QUEUE_DEADLINE_SECONDS,
+    max_retries=UPSTREAM_MAX_RETRIES,
+    retry_backoff_seconds=UPSTREAM_RETRY_BACKOFF_SECONDS,
+)
+
+# --- Coalescencia de peticiones idénticas ---
+single_flight = SingleFlight()
+
+# --- Peticiones de cobertura ---
+hedger = None
+if HEDGE_ENABLED:
+    hedger = Hedger(quantile=HEDGE_QUANTILE, max_extra_ratio=HEDGE_MAX_EXTRA_RATIO,
+                    min_delay_seconds=HEDGE_MIN_DELAY_SECONDS)
+    print(f"Peticiones de cobertura activadas (p{HEDGE_QUANTILE * 100:.0f}, hasta un {HEDGE_MAX_EXTRA_RATIO:.0%} de llamadas extra).")
+
+
+async def hedged_upstream_call(fn):
+    """
+    Llama a `fn()` con un hueco del control de admisión y, si HEDGE_ENABLED, lanza
+    una copia (con su propio hueco) cuando tarda más que el umbral de cobertura.
+    La copia solo se lanza si hay capacidad libre, para no quitar sitio a otras preguntas.
+    """
+    if hedger is None:
+        return await admission.call(fn)
+    return await admission.call(lambda: hedger.call(
+        fn, hedge_fn=lambda: admission.call(fn), can_hedge=admission.has_spare_capacity
+    ))
+
+
+# --- NUEVA FUNCIÓN: Clasificación de la pregunta por la IA ---
+async def is_tolkien_related(query: str) -> bool:
+    """
+    Usa el modelo de IA para determinar si una consulta está directamente relacionada
+    con la obra de J.R.R. Tolkien.
+    Los casos obvios se resuelven antes con el pre-clasificador local, sin llamar al modelo.
+    """
+    local_verdict = pre_classify(query)
+    if local_verdict is not None:
+        print(f"Clasificación local para '{query}': {'YES' if local_verdict else 'NO'}")
+        return local_verdict
+
+    classification_prompt = f"""
+    Dada la siguiente consulta de usuario, determina si está directamente relacionada
+    con la historia, personajes, lugares, eventos o mitología de las obras de J.R.R. Tolkien
+    (por ejemplo, El Hobbit, El Señor de los Anillos, El Silmarillion).
+
+    Responde con 'YES' si la consulta es directamente relevante a Tolkien.
+    Responde con 'NO' si es un saludo general, agradecimiento, una meta-pregunta sobre el asistente,
+    una pregunta personal, o cualquier cosa no relacionada directamente con Tolkien.
+
+    Ejemplos:
+    - Consulta: ¿Quién es Gandalf? -> YES
+    - Consulta: Háblame de los Elfos. -> YES
+    - Consulta: ¿Dónde está Mordor? -> YES
+    - Consulta: Gracias por tu respuesta. -> NO
+    - Consulta: Hola. -> NO
+    - Consulta: Tengo otra pregunta. -> NO
+    - Consulta: ¿Cuál es la capital de Francia? -> NO
+    - Consulta: ¿Puedes contarme un chiste? -> NO
+
+    Consulta: {query}
+    ¿Es esta consulta directamente relacionada con Tolkien? (YES/NO):
+    """
+    try:
+        with stage("classification_model"):
+            response = await admission.call(lambda: model_router.call(
+                "classification", query,
+                lambda backend: backend.start_chat(history=[]).send_message_async(
+                    classification_prompt,
+                    generation_config={"temperature": 0.0, "max_output_tokens": 10}
+                )
+            ))
+        record_usage(response, "classification")
+        classification_result = response.text.strip().upper()
+        print(f"Clasificación para '{query}': {classification_result}")
+        return classification_result == 'YES'
+    except Exception as e:
+        print(f"Error durante la clasificación de la pregunta: {e}")
+        return CLASSIFICATION_DEFAULT
+
+
+async def classify_with_timeout(query: str) -> bool:
+    """
+    Ejecuta la clasificación con su propio tiempo máximo. Si se agota,
+    devuelve CLASSIFICATION_DEFAULT en lugar de bloquear la respuesta.
+    """
+    try:
+        with stage("classification"):
+            return await asyncio.wait_for(is_tolkien_related(query), timeout=CLASSIFICATION_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        print(f"Clasificación para '{query}' superó {CLASSIFICATION_TIMEOUT_SECONDS}s; se usa el valor por defecto.")
+        return CLASSIFICATION_DEFAULT
+
+# --- Funciones auxiliares de caché ---
+async def get_cached_answer(message: str) -> Optional[dict]:
+    """
+    Busca una respuesta en la caché exacta, en las precalculadas y en la semántica.
+    Retorna un diccionario con 'response' e 'is_tolkien_related', o None.
+    """
+    with stage("cache_lookup"):
+        cached = await _lookup_caches(message)
+    if cached is not None and cached["is_tolkien_related"]:
+        _record_popularity(message)
+    return cached
+
+
+async def _lookup_caches(message: str) -> Optional[dict]:
+    cache_key = None
+    if answer_cache is not None:
+        cache_key = make_cache_key(message, IA_GENERATIVE_MODEL_NAME, PERSONA_PROMPT)
+        cached = await answer_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    if precomputed_answers is not None:
+        cached = precomputed_answers.get(cache_key or make_cache_key(message, IA_GENERATIVE_MODEL_NAME, PERSONA_PROMPT))
+        if cached is not None:
+            return cached
+    if semantic_cache is not None:
+        # Con índices grandes la búsqueda tarda milisegundos: fuera del event loop
+        cached = await asyncio.to_thread(semantic_cache.lookup, message)
+        if cached is not None:
+            if cache_key is not None:
+                await answer_cache.set(cache_key, cached)
+            return cached
+    return None
+
+
+async def store_answer(message: str, response_text: str, is_query_tolkien_related: bool) -> None:
+    """Guarda la respuesta y el veredicto de clasificación en las cachés activas."""
+    value = {
+        "response": response_text,
+        "is_tolkien_related": is_query_tolkien_related,
+    }
+    if answer_cache is not None:
+        await answer_cache.set(make_cache_key(message, IA_GENERATIVE_MODEL_NAME, PERSONA_PROMPT), value)
+    if semantic_cache is not None:
+        await asyncio.to_thread(semantic_cache.add, message, value)
+    if is_query_tolkien_related:
+        _record_popularity(message)
+
+
+def _record_popularity(message: str) -> None:
+    """Cuenta la pregunta en el registro de popularidad, si está activado."""
+    if popularity_log is not None:
+        popularity_log.record(message)
+
+
+def retrieve_context(message: str) -> tuple:
+    """
+    Consulta el índice local de referencia.
+    Retorna (mensaje para el modelo, respuesta directa o None). Con RAG_RETRIEVAL_ONLY,
+    las preguntas que solo nombran un término del glosario se responden sin llamar al modelo.
+    """
+    if corpus_index is None:
+        return message, None
+    try:
+        with stage("retrieval"):
+            if RAG_RETRIEVAL_ONLY:
+                entry = corpus_index.glossary_answer(message)
+                if entry is not None:
+                    return message, f"{entry['text']}\n\n(Fuente: {entry['source']})"
+            results = corpus_index.search(message, top_k=RAG_TOP_K)
+    except Exception as e:
+        print(f"Error al consultar el índice de referencia: {e}")
+        return message, None
+    if not results:
+        return message, None
+    context = format_context(results, max_chars=RAG_CONTEXT_MAX_CHARS)
+    return (
+        "Usa los siguientes pasajes de referencia si son pertinentes para responder. "
+        "Si no bastan, responde con tu conocimiento del canon indicando la limitación.\n\n"
+        f"Pasajes de referencia:\n{context}\n\n"
+        f"Pregunta: {message}"
+    ), None
+
+# Un candado por sesión: las preguntas simultáneas de una misma conversación (p. ej.
+# varias en vuelo por el canal WebSocket) no deben pisarse el historial al guardarlo
+_session_locks = weakref.WeakValueDictionary()
+
+
+async def save_turn(session_id: Optional[str], question: str, answer: str) -> None:
+    """
+    Añade el turno a la sesión, compactando el historial si supera el presupuesto.
+    El historial se relee bajo el candado de la sesión, así que no se pierden los
+    turnos que otra petición guardó mientras esta generaba su respuesta.
+    """
+    if session_store is None or session_id is None:
+        return
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = _session_locks[session_id] = asyncio.Lock()
+    with stage("session_save"):
+        async with lock:
+            history = await session_store.load(session_id)
+            history = append_turn(history, question, answer, SESSION_TOKEN_BUDGET, SESSION_MAX_TURNS)
+            await session_store.save(session_id, history)
+
+
+async def generate_answer(message: str, model_message: str, history: list, classify=classify_with_timeout) -> tuple:
+    """
+    Genera la respuesta y clasifica la pregunta en paralelo, de modo que la
+    latencia total es la de la llamada más lenta y no la suma.
+    `classify` permite usar otra clasificación (p. ej. la de /chat/batch, por grupos).
+    Retorna (texto de la respuesta, veredicto de is_tolkien_related).
+    """
+    classification_task = asyncio.create_task(classify(message))
+    try:
+        with stage("generation"):
+            response = await asyncio.wait_for(
+                hedged_upstream_call(lambda: model_router.call(
+                    "answer", message,
+                    lambda backend: backend.start_chat(history=history).send_message_async(model_message)
+                )),
+                timeout=CHAT_TIMEOUT_SECONDS
+            )
+        record_usage(response, "chat")
+        with stage("classification_wait"):
+            is_query_tolkien_related = await classification_task
+        return response.text, is_query_tolkien_related
+    finally:
+        # Si la generación falló, no dejar la clasificación huérfana
+        if not classification_task.done():
+            classification_task.cancel()
+
+
+async def generate_and_store_answer(message: str, model_message: str, classify=classify_with_timeout) -> tuple:
+    """Genera una respuesta sin historial y la guarda en las cachés."""
+    ai_response_text, is_query_tolkien_related = await generate_answer(message, model_message, [], classify)
+    await store_answer(message, ai_response_text, is_query_tolkien_related)
+    return ai_response_text, is_query_tolkien_related
+
+async def send_classification_prompt(prompt: str, max_output_tokens: int) -> str:
+    """Envía un prompt de clasificación en lote y devuelve el texto de la respuesta."""
+    with stage("classification_batch"):
+        response = await admission.call(lambda: model_router.call(
+            "classification", prompt,
+            lambda backend: backend.start_chat(history=[]).send_message_async(
+                prompt,
+                generation_config={"temperature": 0.0, "max_output_tokens": max_output_tokens}
+            )
+        ))
+    record_usage(response, "classification")
+    return response.text
+
+
+
+async def stream_answer(message: str, model_message: str, history: list):
+    """
+    Genera la respuesta en streaming y devuelve sus fragmentos de texto según llegan.
+    El hueco de llamada al modelo se mantiene durante todo el streaming y el tiempo
+    total está limitado por CHAT_TIMEOUT_SECONDS (asyncio.TimeoutError si se supera).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CHAT_TIMEOUT_SECONDS
+    generation_start = time.perf_counter()
+    first_chunk = True
+    async with admission.upstream_slot():
+        # La conmutación a otro modelo solo es posible antes del primer fragmento
+        response = await asyncio.wait_for(
+            admission.retry(lambda: model_router.call(
+                "answer", message,
+                lambda backend: backend.start_chat(history=history).send_message_async(model_message, stream=True)
+            )),
+            timeout=CHAT_TIMEOUT_SECONDS
+        )
+        chunks = response.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(deadline - loop.time(), 0))
+            except StopAsyncIteration:
+                break
+            if chunk.text:
+                if first_chunk:
+                    record_stage("generation_first_chunk", generation_start, time.perf_counter())
+                    first_chunk = False
+                yield chunk.text
+    # Incluye el tiempo que el consumidor tarda en procesar los fragmentos
+    record_stage("generation_stream", generation_start, time.perf_counter())
+    record_usage(response, "chat")
+
+
+async def answer_events(question: str, history: list = None, session_id: Optional[str] = None,
+                        client_id: Optional[str] = None):
+    """
+    Tubería común de las respuestas en streaming (/chat/stream, el canal WebSocket
+    y el asistente de consola): caché (solo sin historial), glosario o modelo en
+    streaming con la clasificación en paralelo; guarda la respuesta en las cachés
+    y el turno en la sesión. Cada punto de entrada solo presenta los eventos:
+
+    - ("start", origen) al superar las comprobaciones previas: "cache", "glossary" o "model".
+    - ("chunk", texto) con cada fragmento de la respuesta.
+    - ("done", veredicto de is_tolkien_related) al terminar.
+
+    Con `session_id` el historial se lee de la sesión; si no, se usa `history`.
+    Antes de "start" lanza ModelUnavailable o AdmissionRejected (límite de tasa de
+    `client_id`); después, AdmissionRejected, asyncio.TimeoutError o el error del
+    modelo. Debe consumirse con `aclosing` para liberar el hueco del modelo si se
+    abandona a medias.
+    """
+    if session_store is not None and session_id is not None:
+        with stage("session_load"):
+            history = await session_store.load(session_id)
+    history = history or []
+
+    # Respuestas que no necesitan el modelo: caché o entrada del glosario
+    cached = await get_cached_answer(question) if not history else None
+    if cached is not None:
+        yield "start", "cache"
+        yield "chunk", cached["response"]
+        await save_turn(session_id, question, cached["response"])
+        yield "done", cached["is_tolkien_related"]
+        return
+    model_message, direct_answer = retrieve_context(question)
+    if direct_answer is not None:
+        await store_answer(question, direct_answer, True)
+        yield "start", "glossary"
+        yield "chunk", direct_answer
+        await save_turn(session_id, question, direct_answer)
+        yield "done", True
+        return
+
+    await wait_for_model()
+    if client_id is not None:
+        admission.check_rate(client_id)
+    yield "start", "model"
+
+    classification_task = asyncio.create_task(classify_with_timeout(question))
+    parts = []
+    try:
+        async with aclosing(stream_answer(question, model_message, history)) as chunks:
+            async for text in chunks:
+                parts.append(text)
+                yield "chunk", text
+        with stage("classification_wait"):
+            is_query_tolkien_related = await classification_task
+        answer = "".join(parts)
+        if not history:
+            await store_answer(question, answer, is_query_tolkien_related)
+        await save_turn(session_id, question, answer)
+        yield "done", is_query_tolkien_related
+    finally:
+        # Si el consumidor abandona o la generación falla, no dejar la clasificación huérfana
+        if not classification_task.done():
+            classification_task.cancel()
+
+
+async def precompute_answer(question: str) -> tuple:
+    """Respuesta y veredicto para el precálculo, sin historial ni cachés."""
+    model_message, direct_answer = retrieve_context(question)
+    if direct_answer is not None:
+        return direct_answer, True
+    return await generate_answer(question, model_message, [])
+
+
+async def rebuild_precomputed(path: str = None, limit: int = None, concurrency: int = None) -> int:
+    """
+    Recalcula el fichero de respuestas precalculadas con las preguntas frecuentes,
+    las populares y las del fichero anterior. Retorna el número de entradas.
+    """
+    path = path or PRECOMPUTED_PATH
+    limit = limit or PRECOMPUTED_TOP_N
+    previous = precomputed_answers.questions() if precomputed_answers is not None else []
+    popular = []
+    if popularity_log is not None:
+        await asyncio.to_thread(popularity_log.flush)
+        popular = await asyncio.to_thread(popularity_log.top, limit, POPULARITY_MIN_COUNT)
+    questions = select_questions(read_seed_questions(PRECOMPUTED_SEED_PATH), popular, previous, limit)
+    if not questions:
+        return 0
+    # Tras un arranque, el modelo puede tardar más que MODEL_INIT_WAIT_SECONDS
+    if model_router is None and _model_init is not None:
+        await asyncio.shield(_model_init)
+    await wait_for_model()
+    entries = await precompute(
+        questions, precompute_answer,
+        lambda question: make_cache_key(question, IA_GENERATIVE_MODEL_NAME, PERSONA_PROMPT),
+        concurrency or PRECOMPUTED_CONCURRENCY,
+    )
+    if entries:
+        await asyncio.to_thread(write_store, path, precomputed_namespace, entries)
+    return len(entries)
+
+
+async def _flush_popularity_periodically(interval_seconds: float) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(popularity_log.flush)
+        except Exception as e:
+            print(f"Error al guardar el registro de popularidad: {e}")
+
+
+# --- Arranque y parada ---
+_background_tasks = []
+
+
+async def start() -> None:
+    """
+    Arranca los servicios del núcleo. Los modelos se construyen en segundo plano:
+    quien necesite el modelo espera con wait_for_model().
+    Lanza ConfigurationError si falta la clave de API o el nombre del modelo.
+    """
+    global _model_init
+    try:
+        check_config()
+    except ConfigurationError as e:
+        print(f"Error: {e}")
+        raise
+    _model_init = asyncio.create_task(initialize_model())
+    # Los workers de correo abren su conexión SMTP con el primer envío
+    if mail_queue is not None:
+        mail_queue.start()
+    # El pool de procesos de PDF crea sus procesos con el primer PDF
+    pdf_renderer.start()
+    if session_store is not None:
+        # Elimina periódicamente las sesiones que superan la ventana de retención
+        _background_tasks.append(asyncio.create_task(
+            purge_expired_periodically(session_store, min(SESSION_RETENTION_SECONDS, 300))
+        ))
+    if answer_cache is not None and answer_cache.shared is not None:
+        # Elimina las entradas caducadas y las que superan CACHE_SQLITE_MAX_ROWS
+        _background_tasks.append(asyncio.create_task(
+            purge_expired_answers_periodically(answer_cache, CACHE_SQLITE_PURGE_SECONDS)
+        ))
+    if precomputed_answers is not None and PRECOMPUTED_REFRESH:
+        # Recarga el fichero si otro worker lo regeneró y lo regenera si está desfasado
+        _background_tasks.append(asyncio.create_task(refresh_periodically(
+            precomputed_answers, rebuild_precomputed, PRECOMPUTED_CHECK_SECONDS, PRECOMPUTED_MAX_AGE_SECONDS
+        )))
+    if popularity_log is not None:
+        _background_tasks.append(asyncio.create_task(_flush_popularity_periodically(POPULARITY_FLUSH_SECONDS)))
+
+
+async def stop() -> None:
+    """Para los servicios del núcleo, esperando a los correos pendientes."""
+    for task in _background_tasks + [_model_init]:
+        if task is not None:
+            task.cancel()
+    _background_tasks.clear()
+    pdf_renderer.stop()
+    # Espera a que terminen los envíos pendientes y cierra las conexiones SMTP
+    if mail_queue is not None:
+        await mail_queue.stop()
+    if popularity_log is not None:
+        try:
+            await asyncio.to_thread(popularity_log.flush)
+        except Exception as e:
+            print(f"Error al guardar el registro de popularidad: {e}")
+    # Guarda la caché semántica para que los workers arranquen en caliente
+    if semantic_cache is not None and SEMANTIC_CACHE_PATH:
+        try:
+            semantic_cache.save(SEMANTIC_CACHE_PATH)
+            print(f"Caché semántica guardada en '{SEMANTIC_CACHE_PATH}'.")
+        except Exception as e:
+            print(f"Error al guardar la caché semántica: {e}")
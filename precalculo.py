@@ -0,0 +1,547 @@
+"""
+Respuestas precalculadas para que los primeros usuarios tras un despliegue no
+paguen la latencia completa de Gemini.
+
+Las preguntas salen de una lista de preguntas frecuentes (preguntas_frecuentes.txt)
+y, si se activa POPULARITY_LOG_PATH, de un registro de popularidad: un SQLite con
+el texto normalizado (minúsculas, sin acentos ni puntuación) de las preguntas
+sobre Tolkien y cuántas veces se han hecho. No se guardan respuestas, sesiones
+ni direcciones, y solo entran en el precálculo las que superan un mínimo de
+repeticiones.
+
+Las respuestas y sus veredictos de clasificación se calculan en segundo plano,
+con concurrencia acotada, y se escriben en un fichero compacto:
+
+- Cabecera: firma, versión, espacio de nombres (hash del modelo y del prompt),
+  fecha de creación y número de entradas.
+- Índice ordenado por clave: 16 bytes de la clave de caché, desplazamiento,
+  longitudes y marcas (veredicto y compresión), 36 bytes por entrada.
+- Datos: la pregunta y la respuesta (comprimida con zlib) de cada entrada.
+
+Los workers lo abren con mmap al arrancar y buscan por búsqueda binaria sobre
+el índice, sin cargarlo en memoria: comparten las páginas del sistema de
+ficheros. Si cambia el modelo o PERSONA_PROMPT, el espacio de nombres ya no
+coincide, las entradas se ignoran y el fichero se regenera en segundo plano
+(también cuando supera su antigüedad máxima). Un fichero de bloqueo, que se
+actualiza mientras dura la regeneración, evita que varios workers lo regeneren
+a la vez; los demás recargan el nuevo al detectarlo. Si la regeneración falla,
+se reintenta con espera exponencial en lugar de en cada comprobación.
+
+Uso:
+    python precalculo.py build [--salida precalculadas.bin] [--top 500] [--concurrencia 2]
+    python precalculo.py show precalculadas.bin
+    python precalculo.py bench
+"""
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import Optional
+
+from clasificador_local import normalize_text
+
+_MAGIC = b"EPRE"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHH32sdI4x")  # firma, versión, reservado, espacio de nombres, creado, entradas
+_RECORD = struct.Struct("<16sQIII")  # clave, desplazamiento, longitud pregunta, longitud respuesta, marcas
+_FLAG_TOLKIEN = 1
+_FLAG_COMPRESSED = 2
+
+# Preguntas más largas que esto no se registran: es raro que se repitan y es más
+# probable que contengan datos personales
+POPULARITY_MAX_CHARS = 200
+
+
+def _key_bytes(key: str) -> bytes:
+    return bytes.fromhex(key)[:16]
+
+
+def write_store(path: str, namespace: str, entries: list) -> int:
+    """
+    Escribe el fichero de forma atómica. `entries`: (clave de caché, pregunta,
+    respuesta, veredicto). Retorna el tamaño en bytes.
+    """
+    records = sorted(((_key_bytes(key), question, answer, verdict) for key, question, answer, verdict in entries),
+                     key=lambda record: record[0])
+    data_start = _HEADER.size + _RECORD.size * len(records)
+    index, blobs = [], []
+    offset = data_start
+    for key, question, answer, verdict in records:
+        question_bytes = question.encode("utf-8")
+        answer_bytes = answer.encode("utf-8")
+        flags = _FLAG_TOLKIEN if verdict else 0
+        compressed = zlib.compress(answer_bytes, 6)
+        if len(compressed) < len(answer_bytes):
+            answer_bytes = compressed
+            flags |= _FLAG_COMPRESSED
+        index.append(_RECORD.pack(key, offset, len(question_bytes), len(answer_bytes), flags))
+        blobs.append(question_bytes + answer_bytes)
+        offset += len(question_bytes) + len(answer_bytes)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, 0, bytes.fromhex(namespace), time.time(), len(records)))
+        f.write(b"".join(index))
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return offset
+
+
+class PrecomputedStore:
+    """Fichero de respuestas precalculadas abierto con mmap (solo lectura)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _reserved, namespace, created_at, count = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self._mmap.close()
+            raise ValueError(f"'{path}' no es un fichero de respuestas precalculadas (versión {_VERSION}).")
+        self.namespace = namespace.hex()
+        self.created_at = created_at
+        self.count = count
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def _record(self, index: int) -> tuple:
+        return _RECORD.unpack_from(self._mmap, _HEADER.size + index * _RECORD.size)
+
+    def _entry(self, record: tuple) -> dict:
+        _key, offset, question_length, answer_length, flags = record
+        answer = self._mmap[offset + question_length:offset + question_length + answer_length]
+        if flags & _FLAG_COMPRESSED:
+            answer = zlib.decompress(answer)
+        return {"response": answer.decode("utf-8"), "is_tolkien_related": bool(flags & _FLAG_TOLKIEN)}
+
+    def get(self, key: str) -> Optional[dict]:
+        """Búsqueda binaria de la clave de caché en el índice."""
+        target = _key_bytes(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = _HEADER.size + middle * _RECORD.size
+            current = self._mmap[start:start + 16]
+            if current < target:
+                low = middle + 1
+            elif current > target:
+                high = middle
+            else:
+                return self._entry(self._record(middle))
+        return None
+
+    def questions(self) -> list:
+        result = []
+        for index in range(self.count):
+            _key, offset, question_length, _answer_length, _flags = self._record(index)
+            result.append(self._mmap[offset:offset + question_length].decode("utf-8"))
+        return result
+
+    def entries(self):
+        for index in range(self.count):
+            record = self._record(index)
+            _key, offset, question_length, _answer_length, _flags = record
+            yield self._mmap[offset:offset + question_length].decode("utf-8"), self._entry(record)
+
+
+class PrecomputedAnswers:
+    """
+    Respuestas precalculadas de un worker: abre el fichero, lo recarga cuando otro
+    proceso lo regenera e ignora su contenido si es de otro modelo o prompt.
+    """
+
+    def __init__(self, path: str, namespace: str):
+        self.path = path
+        self.namespace = namespace
+        self.store = None  # Solo si el espacio de nombres coincide
+        self.stale_questions = []  # Preguntas de un fichero de otro modelo o prompt
+        self._identity = None
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0, "rebuilds": 0, "rebuild_errors": 0}
+
+    def load(self) -> bool:
+        """(Re)abre el fichero si cambió. Retorna True si hay entradas utilizables."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self._identity == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            return self.store is not None
+        try:
+            store = PrecomputedStore(self.path)
+        except Exception as e:
+            print(f"Error al abrir las respuestas precalculadas de '{self.path}': {e}")
+            return False
+        if self._identity is not None:
+            self.stats["reloads"] += 1
+        self._identity = store.identity
+        if self.store is not None:
+            self.store.close()
+        if store.namespace == self.namespace:
+            self.store, self.stale_questions = store, []
+            return True
+        print("Respuestas precalculadas: el fichero corresponde a otro modelo o prompt; se regenerará.")
+        self.stale_questions = store.questions()
+        self.store = None
+        store.close()
+        return False
+
+    def get(self, key: str) -> Optional[dict]:
+        if self.store is None:
+            return None
+        value = self.store.get(key)
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    def questions(self) -> list:
+        return self.store.questions() if self.store is not None else list(self.stale_questions)
+
+    def needs_refresh(self, max_age_seconds: float) -> bool:
+        """Sin fichero, de otro modelo o prompt, o más antiguo que `max_age_seconds` (0 = sin límite)."""
+        if self.store is None:
+            return True
+        return max_age_seconds > 0 and time.time() - self.store.created_at > max_age_seconds
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "entries": self.store.count if self.store is not None else 0,
+            "age_seconds": round(time.time() - self.store.created_at) if self.store is not None else None,
+            "path": self.path,
+        }
+
+
+class PopularityLog:
+    """
+    Recuento de preguntas normalizadas en SQLite, compartido entre workers. Los
+    recuentos se acumulan en memoria y se vuelcan periódicamente con flush().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS popularity ("
+                " question TEXT PRIMARY KEY,"
+                " count INTEGER NOT NULL,"
+                " last_seen REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    def record(self, question: str) -> None:
+        normalized = normalize_text(question)
+        if normalized and len(normalized) <= POPULARITY_MAX_CHARS:
+            self._pending[normalized] += 1
+
+    def flush(self) -> int:
+        """Vuelca los recuentos pendientes (bloqueante). Retorna cuántas preguntas se actualizaron."""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            if not pending:
+                return 0
+            now = time.time()
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT INTO popularity (question, count, last_seen) VALUES (?, ?, ?)"
+                    " ON CONFLICT(question) DO UPDATE SET count = count + excluded.count, last_seen = excluded.last_seen",
+                    [(question, count, now) for question, count in pending.items()],
+                )
+        return len(pending)
+
+    def top(self, limit: int, min_count: int) -> list:
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT question FROM popularity WHERE count >= ? ORDER BY count DESC, last_seen DESC LIMIT ?",
+                (min_count, limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+def read_seed_questions(path: Optional[str]) -> list:
+    """Preguntas de la lista curada (una por línea; se ignoran las vacías y las que empiezan por #)."""
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def select_questions(seeds: list, popular: list, previous: list, limit: int) -> list:
+    """Preguntas frecuentes, después las populares y después las del fichero anterior, sin repetir."""
+    selected, seen = [], set()
+    for question in seeds + popular + previous:
+        normalized = normalize_text(question)
+        if normalized and normalized not in seen:
+            seen.add(normalized)
+            selected.append(question)
+            if len(selected) >= limit:
+                break
+    return selected
+
+
+async def precompute(questions: list, answer_fn, make_key, concurrency: int) -> list:
+    """
+    Calcula las respuestas con `answer_fn(pregunta)` -> (respuesta, veredicto),
+    como mucho `concurrency` a la vez. Las preguntas que fallan se omiten.
+    Retorna las entradas para write_store().
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    entries, errors = [], 0
+
+    async def one(question: str) -> None:
+        nonlocal errors
+        async with semaphore:
+            try:
+                answer, verdict = await answer_fn(question)
+            except Exception as e:
+                errors += 1
+                print(f"Precálculo: error en '{question}': {e}")
+                return
+        if answer:
+            entries.append((make_key(question), question, answer, verdict))
+
+    await asyncio.gather(*(one(question) for question in questions))
+    if errors:
+        print(f"Precálculo: {errors}/{len(questions)} preguntas fallaron y se omiten.")
+    return entries
+
+
+# Un fichero de bloqueo sin actualizar durante este tiempo es de un worker que murió;
+# el que regenera lo actualiza cada LOCK_REFRESH_SECONDS
+LOCK_STALE_SECONDS = 3600
+LOCK_REFRESH_SECONDS = 60
+# Espera máxima entre reintentos tras regeneraciones fallidas seguidas
+MAX_RETRY_BACKOFF_SECONDS = 3600
+
+
+def _acquire_lock(path: str, stale_seconds: float = LOCK_STALE_SECONDS) -> bool:
+    """Fichero de bloqueo entre workers; uno abandonado hace más de `stale_seconds` se ignora."""
+    try:
+        if time.time() - os.path.getmtime(path) > stale_seconds:
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+
+
+async def _keep_lock_fresh(path: str, interval_seconds: float) -> None:
+    """Actualiza la fecha del bloqueo mientras se regenera, para que no se tome por abandonado."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            os.utime(path)
+        except OSError as e:
+            print(f"No se pudo actualizar el bloqueo '{path}': {e}")
+
+
+def _read_failures(path: str) -> tuple:
+    """(regeneraciones fallidas seguidas, fecha de la última) según el fichero `path`."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return int(f.read().strip() or 0), os.path.getmtime(path)
+    except (OSError, ValueError):
+        return 0, 0.0
+
+
+def _record_failure(path: str) -> int:
+    """Anota una regeneración fallida (visible para todos los workers). Retorna las fallidas seguidas."""
+    failures = _read_failures(path)[0] + 1
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(str(failures))
+    except OSError as e:
+        print(f"No se pudo anotar el fallo del precálculo en '{path}': {e}")
+    return failures
+
+
+def retry_delay(failures: int, interval_seconds: float, max_backoff_seconds: float = MAX_RETRY_BACKOFF_SECONDS) -> float:
+    """Espera antes de reintentar tras `failures` regeneraciones fallidas seguidas (exponencial)."""
+    if failures <= 0:
+        return 0.0
+    return min(interval_seconds * 2 ** failures, max_backoff_seconds)
+
+
+async def refresh_periodically(answers: PrecomputedAnswers, rebuild, interval_seconds: float,
+                               max_age_seconds: float, max_backoff_seconds: float = MAX_RETRY_BACKOFF_SECONDS) -> None:
+    """
+    Cada `interval_seconds`, recarga el fichero si otro worker lo regeneró y, si
+    falta, es de otro modelo o prompt o es demasiado antiguo, lo regenera con
+    `rebuild()` (un solo worker a la vez).
+
+    Una regeneración que falla o no obtiene ninguna respuesta se anota en un
+    fichero `.failed` junto al de respuestas. Así ningún worker la repite en cada
+    comprobación gastando cuota: la espera se duplica con cada fallo seguido,
+    hasta `max_backoff_seconds`.
+    """
+    lock_path = answers.path + ".lock"
+    failed_path = answers.path + ".failed"
+    while True:
+        answers.load()
+        failures, failed_at = _read_failures(failed_path)
+        backing_off = time.time() - failed_at < retry_delay(failures, interval_seconds, max_backoff_seconds)
+        if answers.needs_refresh(max_age_seconds) and not backing_off and _acquire_lock(lock_path):
+            heartbeat = asyncio.create_task(_keep_lock_fresh(lock_path, LOCK_REFRESH_SECONDS))
+            try:
+                start = time.perf_counter()
+                count = await rebuild()
+                answers.load()
+                if count:
+                    answers.stats["rebuilds"] += 1
+                    try:
+                        os.remove(failed_path)
+                    except FileNotFoundError:
+                        pass
+                    print(f"Respuestas precalculadas regeneradas: {count} entradas en {time.perf_counter() - start:.1f}s.")
+                else:
+                    answers.stats["rebuild_errors"] += 1
+                    failures = _record_failure(failed_path)
+                    print("No se obtuvo ninguna respuesta precalculada; se reintentará en "
+                          f"{retry_delay(failures, interval_seconds, max_backoff_seconds):.0f}s.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                answers.stats["rebuild_errors"] += 1
+                failures = _record_failure(failed_path)
+                print(f"Error al regenerar las respuestas precalculadas: {e}; se reintentará en "
+                      f"{retry_delay(failures, interval_seconds, max_backoff_seconds):.0f}s.")
+            finally:
+                heartbeat.cancel()
+                os.remove(lock_path)
+        await asyncio.sleep(interval_seconds)
+
+
+# --- Benchmark ---
+
+def _rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_benchmark(sizes=(1_000, 10_000, 100_000), lookups: int = 20_000) -> list:
+    """Tamaño en disco, tiempo de apertura, memoria y latencia de búsqueda frente a un JSON."""
+    import hashlib
+    import random
+    import tempfile
+
+    answer_text = ("Gandalf es uno de los Istari, enviados a la Tierra Media en la Tercera Edad. " * 12).strip()
+    namespace = hashlib.sha256(b"bench").hexdigest()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            entries = [(hashlib.sha256(f"pregunta {i}".encode()).hexdigest(), f"pregunta {i}",
+                        f"{answer_text} ({i})", i % 3 != 0) for i in range(size)]
+            store_path = os.path.join(directory, f"{size}.bin")
+            json_path = os.path.join(directory, f"{size}.json")
+            write_store(store_path, namespace, entries)
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump({key: {"response": answer, "is_tolkien_related": verdict}
+                           for key, _question, answer, verdict in entries}, f, ensure_ascii=False)
+            keys = [random.choice(entries)[0] for _ in range(lookups)]
+
+            rss = _rss_mb()
+            start = time.perf_counter()
+            store = PrecomputedStore(store_path)
+            open_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            for key in keys:
+                store.get(key)
+            lookup_us = (time.perf_counter() - start) / lookups * 1e6
+            store_rss = _rss_mb() - rss
+            store.close()
+
+            rss = _rss_mb()
+            start = time.perf_counter()
+            with open(json_path, encoding="utf-8") as f:
+                table = json.load(f)
+            json_ms = (time.perf_counter() - start) * 1000
+            json_rss = _rss_mb() - rss
+            del table
+
+            results.append({
+                "entries": size,
+                "store_mb": os.path.getsize(store_path) / 2**20,
+                "json_mb": os.path.getsize(json_path) / 2**20,
+                "open_ms": open_ms,
+                "json_load_ms": json_ms,
+                "lookup_us": lookup_us,
+                "store_rss_mb": store_rss,
+                "json_rss_mb": json_rss,
+            })
+    return results
+
+
+# --- Línea de comandos ---
+
+async def _build(args) -> int:
+    # Este proceso ya regenera el fichero: sin la regeneración en segundo plano del núcleo
+    os.environ["PRECOMPUTED_REFRESH"] = "false"
+    import nucleo
+
+    try:
+        await nucleo.start()
+    except nucleo.ConfigurationError:
+        return 1
+    try:
+        count = await nucleo.rebuild_precomputed(args.salida, args.top, args.concurrencia)
+    finally:
+        await nucleo.stop()
+    print(f"{count} respuestas precalculadas en '{args.salida}' ({os.path.getsize(args.salida) / 1024:.0f} KB).")
+    return 0 if count else 1
+
+
+def main(argv: list) -> int:
+    parser = argparse.ArgumentParser(description="Respuestas precalculadas de las preguntas frecuentes y populares.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Calcula las respuestas con el modelo configurado en .env")
+    build_parser.add_argument("--salida", default=os.getenv("PRECOMPUTED_PATH") or "precalculadas.bin")
+    build_parser.add_argument("--top", type=int, default=int(os.getenv("PRECOMPUTED_TOP_N", 500)))
+    build_parser.add_argument("--concurrencia", type=int, default=int(os.getenv("PRECOMPUTED_CONCURRENCY", 2)))
+    show_parser = commands.add_parser("show", help="Muestra las preguntas de un fichero")
+    show_parser.add_argument("path")
+    commands.add_parser("bench", help="Compara el fichero con mmap frente a cargar un JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        return asyncio.run(_build(args))
+    if args.command == "show":
+        store = PrecomputedStore(args.path)
+        age = time.time() - store.created_at
+        print(f"{store.count} entradas, espacio de nombres {store.namespace[:12]}, creado hace {age / 3600:.1f} h.")
+        for question, entry in store.entries():
+            verdict = "YES" if entry["is_tolkien_related"] else "NO"
+            print(f"[{verdict:>3}] {question} ({len(entry['response'])} caracteres)")
+        return 0
+    for result in run_benchmark():
+        print(f"{result['entries']:>7} entradas: fichero {result['store_mb']:.1f} MB (JSON {result['json_mb']:.1f} MB); "
+              f"apertura {result['open_ms']:.2f} ms (JSON {result['json_load_ms']:.0f} ms); "
+              f"memoria +{result['store_rss_mb']:.1f} MB (JSON +{result['json_rss_mb']:.1f} MB); "
+              f"búsqueda {result['lookup_us']:.1f} µs")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
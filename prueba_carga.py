@@ -0,0 +1,415 @@
+"""
+Pruebas de carga sin gastar cuota de la API.
+
+Sustituye Gemini por el modelo falso de `modelo_falso.py` y lanza cargas
+guionizadas contra la app de main.py:
+
+- chat: POST /chat con un conjunto de preguntas (se repiten, así que la caché
+  y la coalescencia influyen como en producción).
+- stream: POST /chat/stream; mide también el tiempo hasta el primer fragmento.
+- email: POST /send-email contra un servidor SMTP local (requiere `aiosmtpd`)
+  y espera a que cada envío quede en estado `sent`.
+- pdf: POST /generate-pdf con respuestas largas.
+
+Modos: `inproc` (la app en el mismo proceso, con httpx.ASGITransport) y
+`uvicorn` (la app en un proceso servidor aparte, a través de HTTP). Se informa
+de rendimiento, latencias p50/p95/p99, errores y memoria (RSS), y el resultado
+se guarda en JSON junto con el commit para comparar ejecuciones.
+
+Uso:
+    python prueba_carga.py run [--mode inproc|uvicorn|both] [--workloads chat,stream,email,pdf]
+                               [--requests 200] [--concurrency 20] [--latency lognormal:0.4:0.5]
+                               [--error-rate 0] [--rate-limit-rate 0] [--seed 0] [--output resultados_carga]
+    python prueba_carga.py compare anterior.json nuevo.json [--threshold 0.10]
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+WORKLOADS = ("chat", "stream", "email", "pdf")
+
+QUESTIONS = [
+    "¿Quién es Gandalf?", "¿Qué es un Silmaril?", "Háblame de Fëanor.", "¿Dónde está Mordor?",
+    "¿Quién forjó el Anillo Único?", "¿Qué son los Ents?", "¿Quién fue Túrin Turambar?",
+    "¿Cómo murió Boromir?", "¿Qué es el Palantír?", "¿Quién es Galadriel?",
+    "¿Qué ocurrió en la Batalla de los Cinco Ejércitos?", "¿Quiénes son los Istari?",
+    "¿Qué es Númenor?", "¿Quién es Tom Bombadil?", "¿Qué idioma hablan los elfos?",
+    "¿Quién era Sauron antes de ser el Señor Oscuro?",
+]
+
+LONG_ANSWER = "Gandalf, llamado Mithrandir por los elfos, es uno de los Istari. " * 200
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _summary(latencies: list, errors: int, status_counts: dict, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "ok": len(latencies),
+        "errors": errors,
+        "status_counts": status_counts,
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        "elapsed_seconds": elapsed,
+    }
+
+
+def _rss_mb(pid: str = "self") -> dict:
+    """RSS actual y máximo de un proceso (Linux, /proc); vacío en otros sistemas."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, amount, _unit = line.split()
+                    values["rss_mb" if key == "VmRSS:" else "peak_rss_mb"] = int(amount) / 1024
+    except OSError:
+        if pid == "self":
+            # ru_maxrss está en KB en Linux y en bytes en macOS
+            divisor = 2**20 if sys.platform == "darwin" else 1024
+            values["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+    return values
+
+
+async def _run_requests(total: int, concurrency: int, one_request) -> dict:
+    """Ejecuta `total` peticiones con `concurrency` clientes en bucle cerrado."""
+    latencies = []
+    extra = {"ttfb": []}
+    status_counts = {}
+    errors = 0
+    counter = iter(range(total))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                status_code, ttfb = await one_request(i)
+            except Exception as e:
+                status_code, ttfb = type(e).__name__, None
+            elapsed = time.perf_counter() - start
+            status_counts[str(status_code)] = status_counts.get(str(status_code), 0) + 1
+            if status_code in (200, 202):
+                latencies.append(elapsed)
+                if ttfb is not None:
+                    extra["ttfb"].append(ttfb)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    summary = _summary(latencies, errors, status_counts, time.perf_counter() - start)
+    if extra["ttfb"]:
+        ttfb = sorted(extra["ttfb"])
+        summary["ttfb_p50_ms"] = _percentile(ttfb, 0.50) * 1000
+        summary["ttfb_p95_ms"] = _percentile(ttfb, 0.95) * 1000
+        summary["ttfb_p99_ms"] = _percentile(ttfb, 0.99) * 1000
+    return summary
+
+
+async def _chat(client, i: int) -> tuple:
+    response = await client.post("/chat", json={"message": QUESTIONS[i % len(QUESTIONS)]})
+    return response.status_code, None
+
+
+async def _stream(client, i: int) -> tuple:
+    start = time.perf_counter()
+    ttfb = None
+    # Preguntas distintas de las de `chat` para que no salgan de la caché
+    message = f"{QUESTIONS[i % len(QUESTIONS)]} (detalle {i})"
+    async with client.stream("POST", "/chat/stream", json={"message": message}) as response:
+        status_code = response.status_code
+        async for line in response.aiter_lines():
+            if ttfb is None and line.startswith("event: chunk"):
+                ttfb = time.perf_counter() - start
+            if line.startswith("event: error"):
+                status_code = "sse_error"
+    return status_code, ttfb
+
+
+async def _email(client, i: int) -> tuple:
+    response = await client.post("/send-email", json={
+        "recipient_email": f"lector{i}@example.com",
+        "subject": "Información de Tolkien",
+        "body": LONG_ANSWER[:2000],
+    })
+    if response.status_code != 202:
+        return response.status_code, None
+    job_id = response.json()["job_id"]
+    # La latencia de la carga `email` incluye la entrega completa
+    while True:
+        job = (await client.get(f"/send-email/{job_id}")).json()
+        if job["status"] == "sent":
+            return 202, None
+        if job["status"] == "failed":
+            return "failed", None
+        await asyncio.sleep(0.01)
+
+
+async def _pdf(client, i: int) -> tuple:
+    # Cada pregunta se pide dos veces: la segunda puede salir de la caché de PDF
+    response = await client.post("/generate-pdf", json={"question": f"Pregunta {i // 2}", "answer": LONG_ANSWER})
+    return response.status_code, None
+
+
+_REQUESTS = {"chat": _chat, "stream": _stream, "email": _email, "pdf": _pdf}
+
+
+async def _run_workloads(client, workloads: list, total: int, concurrency: int) -> dict:
+    results = {}
+    for name in workloads:
+        print(f"  {name}: {total} peticiones, concurrencia {concurrency}...")
+        results[name] = await _run_requests(total, concurrency, lambda i, f=_REQUESTS[name]: f(client, i))
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_smtp_sink():
+    """Servidor SMTP local que descarta los mensajes. Retorna (controller, puerto) o (None, None)."""
+    try:
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.handlers import Sink
+    except ImportError:
+        return None, None
+    port = _free_port()
+    controller = Controller(Sink(), hostname="127.0.0.1", port=port)
+    controller.start()
+    return controller, port
+
+
+def _benchmark_env(smtp_port) -> dict:
+    """Variables de entorno de la app durante la prueba (las ya definidas tienen prioridad)."""
+    env = {
+        "RATE_LIMIT_CLIENT_RPS": "0",  # Todas las peticiones vienen del mismo cliente
+        "CACHE_SQLITE_PATH": "",
+        "SESSIONS_ENABLED": "false",
+        "TRACE_LOG_PATH": "",
+    }
+    if smtp_port is not None:
+        env.update({
+            "EMAIL_ADDRESS": "elendur@localhost",
+            "EMAIL_PASSWORD": "sin-uso",
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(smtp_port),
+            "SMTP_STARTTLS": "false",
+            "SMTP_AUTH": "false",
+            "MAIL_QUEUE_SIZE": "10000",
+        })
+    return {key: os.environ.get(key, value) for key, value in env.items()}
+
+
+async def run_inproc(workloads: list, total: int, concurrency: int, fake_options: dict) -> dict:
+    """La app en este mismo proceso: mide el coste del pipeline sin red."""
+    import httpx
+    import modelo_falso
+
+    modelo_falso.install(**fake_options)
+    import main
+    import nucleo
+
+    memory_before = _rss_mb()
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://prueba", timeout=120) as client:
+            results = await _run_workloads(client, workloads, total, concurrency)
+    # ASGITransport entrega la respuesta completa de golpe: el primer fragmento no es medible aquí
+    for summary in results.values():
+        for key in ("ttfb_p50_ms", "ttfb_p95_ms", "ttfb_p99_ms"):
+            summary.pop(key, None)
+    return {
+        "workloads": results,
+        "model_calls": {routed.name: dict(routed.backend.stats) for routed in nucleo.model_router.models},
+        "memory": {"before": memory_before, "after": _rss_mb()},
+    }
+
+
+async def run_uvicorn(workloads: list, total: int, concurrency: int, fake_options: dict) -> dict:
+    """La app en un proceso uvicorn aparte, a través de HTTP."""
+    import httpx
+    import modelo_falso
+
+    port = _free_port()
+    env = {**os.environ, modelo_falso.OPTIONS_ENV: json.dumps(fake_options)}
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120,
+                                     limits=httpx.Limits(max_connections=concurrency * 2)) as client:
+            # Se espera a que el modelo esté listo para no medir el arranque
+            for _ in range(300):
+                try:
+                    if (await client.get("/health/ready")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    if server.poll() is not None:
+                        raise RuntimeError("El servidor uvicorn terminó al arrancar.")
+                await asyncio.sleep(0.1)
+            memory_before = _rss_mb(str(server.pid))
+            results = await _run_workloads(client, workloads, total, concurrency)
+            memory_after = _rss_mb(str(server.pid))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return {"workloads": results, "memory": {"before": memory_before, "after": memory_after}}
+
+
+def serve(port: int) -> None:
+    """Proceso servidor del modo uvicorn: instala el modelo falso y arranca la app."""
+    import modelo_falso
+    import uvicorn
+
+    modelo_falso.install_from_env()
+    import main
+
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "desconocido"
+    except OSError:
+        return "desconocido"
+
+
+def run(args) -> int:
+    workloads = [w for w in args.workloads.split(",") if w]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        print(f"Cargas desconocidas: {', '.join(sorted(unknown))}")
+        return 1
+    fake_options = {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "seed": args.seed,
+    }
+
+    smtp, smtp_port = (None, None)
+    if "email" in workloads:
+        smtp, smtp_port = _start_smtp_sink()
+        if smtp is None:
+            print("aiosmtpd no está instalado: se omite la carga 'email'.")
+            workloads.remove("email")
+    os.environ.update(_benchmark_env(smtp_port))
+
+    modes = ["inproc", "uvicorn"] if args.mode == "both" else [args.mode]
+    report = {
+        "commit": _git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "config": {"requests": args.requests, "concurrency": args.concurrency,
+                   "workloads": workloads, "fake_model": fake_options},
+        "modes": {},
+    }
+    try:
+        for mode in modes:
+            print(f"Modo {mode}:")
+            runner = run_inproc if mode == "inproc" else run_uvicorn
+            report["modes"][mode] = asyncio.run(runner(workloads, args.requests, args.concurrency, fake_options))
+    finally:
+        if smtp is not None:
+            smtp.stop()
+
+    for mode, result in report["modes"].items():
+        for name, summary in result["workloads"].items():
+            line = (f"[{mode}] {name:<6} {summary['throughput_rps']:7.1f} pet/s  p50 {summary['p50_ms']:7.1f} ms  "
+                    f"p95 {summary['p95_ms']:7.1f} ms  p99 {summary['p99_ms']:7.1f} ms  errores {summary['errors']}")
+            if "ttfb_p50_ms" in summary:
+                line += f"  primer fragmento p50 {summary['ttfb_p50_ms']:.1f} ms"
+            print(line)
+        memory = result["memory"]["after"]
+        if memory:
+            print(f"[{mode}] memoria: RSS {memory.get('rss_mb', 0):.0f} MB, pico {memory.get('peak_rss_mb', 0):.0f} MB")
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{datetime.now():%Y%m%d-%H%M%S}_{report['commit']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Resultados guardados en '{path}'.")
+    return 0
+
+
+def compare(args) -> int:
+    """Compara dos ejecuciones y marca las regresiones que superan el umbral."""
+    with open(args.before, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)
+    print(f"{before['commit']} -> {after['commit']}")
+    regressions = 0
+    for mode, result in after["modes"].items():
+        for name, summary in result["workloads"].items():
+            old = before["modes"].get(mode, {}).get("workloads", {}).get(name)
+            if old is None:
+                continue
+            # En latencia, subir es peor; en rendimiento, bajar es peor
+            for metric, higher_is_worse in (("throughput_rps", False), ("p50_ms", True),
+                                            ("p95_ms", True), ("p99_ms", True)):
+                if not old[metric]:
+                    continue
+                change = (summary[metric] - old[metric]) / old[metric]
+                worse = change > args.threshold if higher_is_worse else change < -args.threshold
+                regressions += worse
+                print(f"[{mode}] {name:<6} {metric:<15} {old[metric]:9.1f} -> {summary[metric]:9.1f} "
+                      f"({change:+.1%}){'  REGRESIÓN' if worse else ''}")
+    return 1 if regressions else 0
+
+
+def main(argv: list) -> int:
+    parser = argparse.ArgumentParser(description="Pruebas de carga con un modelo Gemini falso.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Lanza las cargas y guarda los resultados")
+    run_parser.add_argument("--mode", choices=("inproc", "uvicorn", "both"), default="both")
+    run_parser.add_argument("--workloads", default=",".join(WORKLOADS))
+    run_parser.add_argument("--requests", type=int, default=200, help="Peticiones por carga")
+    run_parser.add_argument("--concurrency", type=int, default=20)
+    run_parser.add_argument("--latency", default="lognormal:0.4:0.5", help="Distribución de latencia del modelo")
+    run_parser.add_argument("--error-rate", type=float, default=0.0)
+    run_parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", default="resultados_carga")
+
+    compare_parser = commands.add_parser("compare", help="Compara dos ficheros de resultados")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="Cambio relativo que se considera regresión")
+
+    serve_parser = commands.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--port", type=int, required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    if args.command == "compare":
+        return compare(args)
+    serve(args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
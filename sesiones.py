@@ -0,0 +1,269 @@
+"""
+Sesiones de conversación en el servidor.
+
+Cada sesión guarda el historial de la conversación en el formato que acepta
+`model.start_chat(history=...)`. Para que el tamaño del prompt (y con él la
+latencia y el coste) no crezca sin límite, el historial se compacta cuando
+supera un presupuesto de tokens: los turnos más antiguos se sustituyen por un
+resumen extractivo breve de las preguntas anteriores.
+
+Hay dos almacenes intercambiables:
+- MemorySessionStore: un solo worker.
+- SQLiteSessionStore: varios workers comparten el fichero.
+
+Las sesiones inactivas durante más de la ventana de retención se eliminan.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+# Longitud máxima de cada pregunta dentro del resumen de turnos antiguos
+_SUMMARY_QUESTION_CHARS = 120
+_SUMMARY_PREFIX = "Resumen de la conversación anterior. Preguntas del usuario:"
+# Marca al final de un texto recortado para que quepa en el presupuesto
+_TRUNCATION_MARK = " […]"
+
+
+def is_summary_turn(turn: dict) -> bool:
+    """Indica si el turno es el resumen que deja la compactación del historial."""
+    return turn["role"] == "user" and turn["parts"][0].startswith(_SUMMARY_PREFIX)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata de tokens (unos 4 caracteres por token)."""
+    return len(text) // 4 + 1
+
+
+def history_tokens(history: list) -> int:
+    return sum(estimate_tokens(part) for turn in history for part in turn["parts"])
+
+
+def _summarize(turns: list, max_chars: int) -> str:
+    """Resumen extractivo: lista de las preguntas del usuario, recortada."""
+    questions = []
+    for turn in turns:
+        if turn["role"] != "user":
+            continue
+        text = turn["parts"][0]
+        if text.startswith(_SUMMARY_PREFIX):
+            # Resumen de una compactación anterior: conservar sus preguntas
+            questions.extend(line[2:] for line in text.splitlines()[1:] if line.startswith("- "))
+        else:
+            questions.append(text[:_SUMMARY_QUESTION_CHARS])
+    lines = []
+    total = len(_SUMMARY_PREFIX)
+    # Se conservan las preguntas más recientes si no caben todas
+    for question in reversed(questions):
+        total += len(question) + 3
+        if total > max_chars:
+            break
+        lines.append(f"- {question}")
+    return "\n".join([_SUMMARY_PREFIX] + list(reversed(lines)))
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Recorta el texto para que no supere `max_tokens` tokens estimados."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(0, (max_tokens - 1) * 4 - len(_TRUNCATION_MARK))
+    return text[:max_chars] + _TRUNCATION_MARK
+
+
+def _truncate_pair(pair: list, max_tokens: int) -> list:
+    """Recorta un par pregunta/respuesta: la pregunta ocupa como mucho una cuarta parte."""
+    question = _truncate(pair[0]["parts"][0], max(1, max_tokens // 4))
+    answer = _truncate(pair[1]["parts"][0], max(1, max_tokens - estimate_tokens(question)))
+    return [
+        {"role": "user", "parts": [question]},
+        {"role": "model", "parts": [answer]},
+    ]
+
+
+def compact_history(history: list, token_budget: int, max_turns: int) -> list:
+    """
+    Reduce el historial para que no supere `token_budget` tokens ni `max_turns` turnos.
+    Los pares pregunta/respuesta más antiguos se resumen en un único par inicial y
+    un par que por sí solo no cabe en la mitad del presupuesto se recorta.
+    """
+    if history_tokens(history) <= token_budget and len(history) <= max_turns:
+        return history
+
+    # Se conservan los pares más recientes que quepan en la mitad del presupuesto,
+    # para no tener que compactar en cada turno
+    keep = []
+    used = 0
+    for i in range(len(history) - 2, -1, -2):
+        pair = history[i:i + 2]
+        pair_tokens = history_tokens(pair)
+        if not keep and pair_tokens > token_budget // 2:
+            # El par más reciente se conserva siempre, recortado si es demasiado largo
+            pair = _truncate_pair(pair, token_budget // 2)
+            pair_tokens = history_tokens(pair)
+        if keep and (used + pair_tokens > token_budget // 2 or len(keep) + 2 > max_turns - 2):
+            break
+        keep = pair + keep
+        used += pair_tokens
+    dropped = history[:len(history) - len(keep)]
+    if not dropped:
+        return keep
+
+    # El resumen ocupa como mucho una cuarta parte del presupuesto (~4 caracteres por token)
+    summary = _summarize(dropped, max_chars=token_budget)
+    return [
+        {"role": "user", "parts": [summary]},
+        {"role": "model", "parts": ["Entendido."]},
+    ] + keep
+
+
+class MemorySessionStore:
+    """Sesiones en memoria del proceso, con límite de sesiones y caducidad por inactividad."""
+
+    def __init__(self, retention_seconds: float = 1800, max_sessions: int = 10000):
+        self.retention_seconds = retention_seconds
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # id -> (último acceso, historial)
+        self.stats = {"evicted_idle": 0, "evicted_capacity": 0}
+
+    async def load(self, session_id: str) -> list:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return []
+        last_access, history = entry
+        if time.time() - last_access > self.retention_seconds:
+            del self._sessions[session_id]
+            self.stats["evicted_idle"] += 1
+            return []
+        return list(history)
+
+    async def save(self, session_id: str, history: list) -> None:
+        self._sessions[session_id] = (time.time(), history)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.stats["evicted_capacity"] += 1
+
+    async def delete(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    async def purge_expired(self) -> int:
+        limit = time.time() - self.retention_seconds
+        # OrderedDict ordenado por último acceso: los caducados están al principio
+        expired = 0
+        while self._sessions:
+            session_id, (last_access, _) = next(iter(self._sessions.items()))
+            if last_access >= limit:
+                break
+            del self._sessions[session_id]
+            expired += 1
+        self.stats["evicted_idle"] += expired
+        return expired
+
+    async def get_stats(self) -> dict:
+        return {**self.stats, "backend": "memory", "sessions": len(self._sessions)}
+
+
+class SQLiteSessionStore:
+    """
+    Sesiones en SQLite, compartidas entre workers. El acceso se hace en un hilo y
+    cada hilo usa su propia conexión, abierta la primera vez y reutilizada después.
+    """
+
+    def __init__(self, path: str, retention_seconds: float = 1800):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {"evicted_idle": 0}
+        # Conexión temporal: los workers creados con fork no deben heredar una abierta
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY,"
+                " history TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+        return conn
+
+    def _load(self, session_id: str) -> list:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT history, updated_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return []
+            history, updated_at = row
+            if time.time() - updated_at > self.retention_seconds:
+                conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                self.stats["evicted_idle"] += 1
+                return []
+        return json.loads(history)
+
+    def _save(self, session_id: str, history: list) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, history, updated_at) VALUES (?, ?, ?)",
+                (session_id, json.dumps(history, ensure_ascii=False), time.time()),
+            )
+
+    def _delete(self, session_id: str) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _purge_expired(self) -> int:
+        with self._lock, self._connect() as conn:
+            expired = conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.retention_seconds,)
+            ).rowcount
+        self.stats["evicted_idle"] += expired
+        return expired
+
+    def _count(self) -> int:
+        with self._lock, self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    async def load(self, session_id: str) -> list:
+        return await asyncio.to_thread(self._load, session_id)
+
+    async def save(self, session_id: str, history: list) -> None:
+        await asyncio.to_thread(self._save, session_id, history)
+
+    async def delete(self, session_id: str) -> None:
+        await asyncio.to_thread(self._delete, session_id)
+
+    async def purge_expired(self) -> int:
+        return await asyncio.to_thread(self._purge_expired)
+
+    async def get_stats(self) -> dict:
+        return {**self.stats, "backend": "sqlite", "sessions": await asyncio.to_thread(self._count)}
+
+
+async def purge_expired_periodically(store, interval_seconds: float) -> None:
+    """Tarea de fondo que elimina las sesiones caducadas cada `interval_seconds`."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            expired = await store.purge_expired()
+            if expired:
+                print(f"Sesiones caducadas eliminadas: {expired}")
+        except Exception as e:
+            print(f"Error al eliminar sesiones caducadas: {e}")
+
+
+def append_turn(history: list, question: str, answer: str, token_budget: int, max_turns: int) -> list:
+    """Añade un par pregunta/respuesta al historial y lo compacta si hace falta."""
+    history = history + [
+        {"role": "user", "parts": [question]},
+        {"role": "model", "parts": [answer]},
+    ]
+    return compact_history(history, token_budget, max_turns)
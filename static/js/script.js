@@ -13,6 +13,80 @@ let lastQuestion = ""; // Variable para almacenar la última pregunta del usuari
 let currentInteractionDiv = null; // Para gestionar la burbuja de interacción (email/pdf)
 let expectingEmailAddress = false; // Estado para saber si estamos esperando un correo
 let isEmailSendingAvailable = false; // Variable para almacenar el estado del envío de correo del backend
+let questionsInFlight = 0; // Preguntas enviadas por el canal WebSocket que aún no han terminado
+
+// --- Canal WebSocket: una sola conexión para todas las preguntas, correos y PDFs ---
+// Si el navegador no lo soporta o la conexión se cae, se usan las rutas HTTP.
+const channel = {
+    socket: null,
+    ready: false,
+    nextId: 1,
+    maxInFlight: 4,
+    handlers: new Map(), // id -> función que recibe los mensajes de esa petición
+    binaryHandler: null, // Recibe el frame binario que sigue a un mensaje 'pdf'
+    retryDelayMs: 1000,
+};
+
+function connectChannel() {
+    if (!window.WebSocket) return;
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${protocol}//${window.location.host}/ws`);
+    channel.socket = socket;
+
+    socket.addEventListener('message', (event) => {
+        if (typeof event.data !== 'string') {
+            const handler = channel.binaryHandler;
+            channel.binaryHandler = null;
+            if (handler) handler(event.data);
+            return;
+        }
+        const data = JSON.parse(event.data);
+        if (data.type === 'hello') {
+            channel.ready = true;
+            channel.retryDelayMs = 1000;
+            channel.maxInFlight = data.max_in_flight;
+            isEmailSendingAvailable = data.email_available;
+            return;
+        }
+        const handler = channel.handlers.get(data.id);
+        if (!handler) return;
+        if (data.type === 'pdf') {
+            // El documento llega en el siguiente frame, binario
+            channel.binaryHandler = (blob) => handler(data, blob);
+            return;
+        }
+        handler(data);
+    });
+
+    socket.addEventListener('close', () => {
+        channel.ready = false;
+        channel.socket = null;
+        channel.binaryHandler = null;
+        // Las peticiones en curso reciben 'disconnected' y deciden si repetir por HTTP
+        const pending = Array.from(channel.handlers.entries());
+        channel.handlers.clear();
+        for (const [id, handler] of pending) handler({ type: 'disconnected', id });
+        // Reconectar con espera creciente
+        setTimeout(connectChannel, channel.retryDelayMs);
+        channel.retryDelayMs = Math.min(channel.retryDelayMs * 2, 30000);
+    });
+}
+
+function channelReady() {
+    return channel.ready && channel.socket && channel.socket.readyState === WebSocket.OPEN;
+}
+
+// Envía una petición por el canal; `onMessage` recibe sus mensajes hasta channelFinish(id)
+function channelRequest(type, payload, onMessage) {
+    const id = String(channel.nextId++);
+    channel.handlers.set(id, onMessage);
+    channel.socket.send(JSON.stringify({ type, id, ...payload }));
+    return id;
+}
+
+function channelFinish(id) {
+    channel.handlers.delete(id);
+}
 
 // Función para mostrar mensajes en el modal
 function showMessageModal(message, title = "Mensaje") {
@@ -47,6 +121,21 @@ function removeInteractionElements() {
     }
 }
 
+// Función para consultar el estado de un envío encolado hasta que termine (o se agote el tiempo)
+async function waitForEmailJob(jobId, timeoutMs = 30000, intervalMs = 1000) {
+    const deadline = Date.now() + timeoutMs;
+    let data = { status: 'queued' };
+    while (Date.now() < deadline) {
+        const response = await fetch(`/send-email/${jobId}`);
+        data = await response.json();
+        if (!response.ok || data.status === 'sent' || data.status === 'failed') {
+            return data;
+        }
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
+    return data;
+}
+
 // Función para enviar el correo (nueva función separada)
 async function sendEmailToUser(recipientEmail, emailBody, emailSubject) {
     // Deshabilitar input y botón mientras se envía
@@ -58,6 +147,10 @@ async function sendEmailToUser(recipientEmail, emailBody, emailSubject) {
     const sendingMessage = appendMessage('ai', `Intentando enviar el correo a ${recipientEmail}...`);
 
     try {
+        // Por el canal, el servidor avisa cuando termina el envío y no hace falta consultarlo
+        if (channelReady() && await sendEmailByChannel(recipientEmail, emailBody, emailSubject, sendingMessage)) {
+            return;
+        }
         const response = await fetch('/send-email', {
             method: 'POST',
             headers: {
@@ -70,14 +163,24 @@ async function sendEmailToUser(recipientEmail, emailBody, emailSubject) {
             }),
         });
 
-        const data = await response.json();
+        let data = await response.json();
+
+        // El backend encola el envío (202) y devuelve un job_id: consultar su estado
+        // hasta que termine, sin bloquear la conversación más de lo necesario
+        if (response.ok && data.job_id) {
+            data = await waitForEmailJob(data.job_id);
+        }
 
         sendingMessage.remove(); // Eliminar el mensaje de "enviando..."
 
-        if (response.ok) {
+        if (response.ok && data.status === 'sent') {
             appendMessage('ai', `¡Listo! He enviado la información a ${recipientEmail}.`);
             lastAnswer = ""; // Limpiar la última respuesta guardada después del éxito
             lastQuestion = ""; // Limpiar la última pregunta
+        } else if (response.ok && data.status !== 'failed') {
+            appendMessage('ai', `El envío a ${recipientEmail} está en curso. Recibirás el correo en unos minutos.`);
+            lastAnswer = "";
+            lastQuestion = "";
         } else {
             appendMessage('ai', `Lo siento, no pude enviar el correo a ${recipientEmail}. Error: ${data.detail || 'Hubo un problema.'}`);
         }
@@ -95,6 +198,66 @@ async function sendEmailToUser(recipientEmail, emailBody, emailSubject) {
     }
 }
 
+// Función para enviar el correo por el canal WebSocket. Se resuelve en cuanto el envío
+// queda en cola (la conversación sigue) y avisa en el chat cuando termina.
+// Devuelve false si el canal se cae antes de encolarlo, para repetir por HTTP.
+function sendEmailByChannel(recipientEmail, emailBody, emailSubject, sendingMessage) {
+    return new Promise((resolve) => {
+        let queued = false;
+        const id = channelRequest('email', {
+            recipient_email: recipientEmail,
+            subject: emailSubject || `Información de Tolkien de Elendur`,
+            body: emailBody
+        }, (data) => {
+            if (data.type === 'email' && data.status === 'queued') {
+                queued = true;
+                sendingMessage.textContent = `El envío a ${recipientEmail} está en cola; puedes seguir preguntando.`;
+                lastAnswer = "";
+                lastQuestion = "";
+                resolve(true);
+                return;
+            }
+            channelFinish(id);
+            sendingMessage.remove();
+            if (data.type === 'email' && data.status === 'sent') {
+                appendMessage('ai', `¡Listo! He enviado la información a ${recipientEmail}.`);
+            } else if (data.type === 'email') {
+                appendMessage('ai', data.message);
+            } else if (data.type === 'error') {
+                appendMessage('ai', `Lo siento, no pude enviar el correo a ${recipientEmail}. Error: ${data.detail || 'Hubo un problema.'}`);
+            } else if (queued) { // Desconexión con el correo ya en cola
+                appendMessage('ai', `El envío a ${recipientEmail} está en curso. Recibirás el correo en unos minutos.`);
+            }
+            resolve(data.type !== 'disconnected' || queued);
+        });
+    });
+}
+
+// Función para iniciar la descarga de un archivo recibido
+function downloadBlob(blob, filename) {
+    const url = window.URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.style.display = 'none';
+    a.href = url;
+    a.download = filename; // Nombre del archivo
+    document.body.appendChild(a);
+    a.click();
+    window.URL.revokeObjectURL(url);
+}
+
+// Función para pedir el PDF por el canal WebSocket. Devuelve null si el canal se cae
+// (para repetir por HTTP) o {blob} / {error}.
+function generatePdfByChannel(question, answer) {
+    return new Promise((resolve) => {
+        const id = channelRequest('pdf', { question, answer }, (data, blob) => {
+            channelFinish(id);
+            if (data.type === 'pdf') resolve({ blob, filename: data.filename });
+            else if (data.type === 'error') resolve({ error: data.detail });
+            else resolve(null);
+        });
+    });
+}
+
 // Función para añadir la pregunta de correo/PDF al chat
 function appendEmailPdfPrompt() {
     removeInteractionElements(); // Limpiar interacciones anteriores si las hay
@@ -138,6 +301,18 @@ function appendEmailPdfPrompt() {
         appendMessage('ai', "Generando tu documento PDF, por favor espera...");
 
         try {
+            const viaChannel = channelReady() ? await generatePdfByChannel(lastQuestion, lastAnswer) : null;
+            if (viaChannel && viaChannel.blob) {
+                downloadBlob(viaChannel.blob, viaChannel.filename);
+                appendMessage('ai', "¡Listo! Tu PDF ha sido generado y la descarga debería comenzar en breve.");
+                lastAnswer = "";
+                lastQuestion = "";
+                return;
+            }
+            if (viaChannel && viaChannel.error) {
+                appendMessage('ai', `Lo siento, no pude generar el PDF. Error: ${viaChannel.error}`);
+                return;
+            }
             const response = await fetch('/generate-pdf', {
                 method: 'POST',
                 headers: {
@@ -150,15 +325,7 @@ function appendEmailPdfPrompt() {
             });
 
             if (response.ok) {
-                const blob = await response.blob();
-                const url = window.URL.createObjectURL(blob);
-                const a = document.createElement('a');
-                a.style.display = 'none';
-                a.href = url;
-                a.download = 'consulta_Elendur.pdf'; // Nombre del archivo
-                document.body.appendChild(a);
-                a.click();
-                window.URL.revokeObjectURL(url);
+                downloadBlob(await response.blob(), 'consulta_Elendur.pdf');
                 appendMessage('ai', "¡Listo! Tu PDF ha sido generado y la descarga debería comenzar en breve.");
                 lastAnswer = ""; // Limpiar después de la descarga
                 lastQuestion = ""; // Limpiar la pregunta
@@ -190,6 +357,138 @@ function appendEmailPdfPrompt() {
 }
 
 
+// Función para procesar la respuesta del asistente cuando termina (común a /chat y /chat/stream)
+function handleAnswerCompleted(question, answer, askForDownload, emailAvailable) {
+    lastQuestion = question; // Con varias preguntas en vuelo, la última en terminar
+    lastAnswer = answer; // Guardar la última respuesta
+    isEmailSendingAvailable = emailAvailable; // Actualizar el estado del envío de correo
+
+    // Usar ask_for_download para la lógica de email/pdf
+    if (askForDownload) {
+        appendEmailPdfPrompt(); // Llamar a la función para mostrar la pregunta de correo/pdf
+    }
+}
+
+// Función para pedir la respuesta completa a /chat (sin streaming)
+async function askClassic(question, thinkingMessage) {
+    const response = await fetch('/chat', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ message: question }),
+    });
+
+    const data = await response.json();
+
+    thinkingMessage.remove(); // Eliminar el mensaje de "pensando"
+
+    if (response.ok) {
+        appendMessage('ai', data.response); // Añadir la respuesta del asistente
+        handleAnswerCompleted(question, data.response, data.ask_for_download, data.email_available);
+    } else {
+        appendMessage('ai', `Error: ${data.detail || 'No se pudo obtener una respuesta.'}`);
+        lastAnswer = "";
+        lastQuestion = "";
+    }
+}
+
+// Función para pedir la respuesta a /chat/stream y mostrarla a medida que llega (SSE)
+async function askStreaming(question, thinkingMessage) {
+    const response = await fetch('/chat/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ message: question }),
+    });
+
+    if (!response.ok || !response.body) {
+        // Si el endpoint de streaming no está disponible, volver a /chat
+        await askClassic(question, thinkingMessage);
+        return;
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let answer = '';
+    let answerDiv = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Los eventos SSE se separan por una línea en blanco
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, separatorIndex);
+            buffer = buffer.slice(separatorIndex + 2);
+
+            let eventName = 'message';
+            let eventData = '';
+            for (const line of rawEvent.split('\n')) {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) eventData += line.slice(6);
+            }
+            const data = eventData ? JSON.parse(eventData) : {};
+
+            if (eventName === 'chunk') {
+                if (!answerDiv) {
+                    thinkingMessage.remove(); // Eliminar el mensaje de "pensando" con el primer fragmento
+                    answerDiv = appendMessage('ai', '');
+                }
+                answer += data.text;
+                answerDiv.textContent = answer;
+                chatHistory.scrollTop = chatHistory.scrollHeight;
+            } else if (eventName === 'done') {
+                if (!answerDiv) thinkingMessage.remove();
+                handleAnswerCompleted(question, answer, data.ask_for_download, data.email_available);
+            } else if (eventName === 'error') {
+                if (!answerDiv) thinkingMessage.remove();
+                appendMessage('ai', `Error: ${data.detail || 'No se pudo obtener una respuesta.'}`);
+                lastAnswer = "";
+                lastQuestion = "";
+            }
+        }
+    }
+}
+
+// Función para pedir la respuesta por el canal WebSocket (fragmentos con el id de la pregunta).
+// Si el canal se cae antes del primer fragmento, se repite por HTTP.
+function askByChannel(question, thinkingMessage) {
+    return new Promise((resolve, reject) => {
+        let answer = '';
+        let answerDiv = null;
+        const id = channelRequest('ask', { message: question }, (data) => {
+            if (data.type === 'chunk') {
+                if (!answerDiv) {
+                    thinkingMessage.remove(); // Eliminar el mensaje de "pensando" con el primer fragmento
+                    answerDiv = appendMessage('ai', '');
+                }
+                answer += data.text;
+                answerDiv.textContent = answer;
+                chatHistory.scrollTop = chatHistory.scrollHeight;
+                return;
+            }
+            channelFinish(id);
+            if (data.type === 'done') {
+                if (!answerDiv) thinkingMessage.remove();
+                handleAnswerCompleted(question, answer, data.ask_for_download, data.email_available);
+                resolve();
+            } else if (data.type === 'disconnected' && !answerDiv) {
+                askStreaming(question, thinkingMessage).then(resolve, reject);
+            } else {
+                if (!answerDiv) thinkingMessage.remove();
+                appendMessage('ai', `Error: ${data.detail || 'Se perdió la conexión con el asistente.'}`);
+                resolve();
+            }
+        });
+    });
+}
+
+
 // Event listener para el botón principal de "Enviar"
 askButton.addEventListener('click', async () => {
     const question = questionInput.value.trim();
@@ -225,42 +524,27 @@ askButton.addEventListener('click', async () => {
     lastQuestion = question; // Guardar la última pregunta
     questionInput.value = ''; // Limpiar el input
 
-    // Deshabilitar botón y mostrar spinner
-    askButton.disabled = true;
-    askButtonText.classList.add('d-none');
-    askSpinner.classList.remove('d-none');
+    // Por el canal se pueden hacer varias preguntas a la vez: el botón solo se
+    // deshabilita al llegar al límite de la conexión (o siempre, por HTTP)
+    const useChannel = channelReady();
+    if (useChannel) questionsInFlight++;
+    if (!useChannel || questionsInFlight >= channel.maxInFlight) {
+        askButton.disabled = true;
+        askButtonText.classList.add('d-none');
+        askSpinner.classList.remove('d-none');
+    }
 
     // Mostrar mensaje de "pensando"
     const thinkingMessage = appendMessage('ai', "Elendur está pensando...");
 
     try {
-        // Realizar la solicitud a la API de FastAPI para la pregunta
-        const response = await fetch('/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({ message: question }),
-        });
-
-        const data = await response.json();
-
-        thinkingMessage.remove(); // Eliminar el mensaje de "pensando"
-
-        if (response.ok) {
-            appendMessage('ai', data.response); // Añadir la respuesta del asistente
-            lastAnswer = data.response; // Guardar la última respuesta
-            isEmailSendingAvailable = data.email_available; // Actualizar el estado del envío de correo
-
-            // Usar ask_for_download para la lógica de email/pdf
-            if (data.ask_for_download) {
-                appendEmailPdfPrompt(); // Llamar a la función para mostrar la pregunta de correo/pdf
-            }
-
+        // Pedir la respuesta por el canal WebSocket; si no, en streaming o, si el navegador no lo soporta, a /chat
+        if (useChannel) {
+            await askByChannel(question, thinkingMessage);
+        } else if (window.ReadableStream && window.TextDecoder) {
+            await askStreaming(question, thinkingMessage);
         } else {
-            appendMessage('ai', `Error: ${data.detail || 'No se pudo obtener una respuesta.'}`);
-            lastAnswer = "";
-            lastQuestion = "";
+            await askClassic(question, thinkingMessage);
         }
     } catch (error) {
         console.error('Error al preguntar a Elendur:', error);
@@ -269,9 +553,12 @@ askButton.addEventListener('click', async () => {
         lastAnswer = "";
         lastQuestion = "";
     } finally {
+        if (useChannel) questionsInFlight--;
         // Habilitar botón y ocultar spinner
         askButton.disabled = false;
         askButtonText.classList.remove('d-none');
         askSpinner.classList.add('d-none');
     }
-});
\ No newline at end of file
+});
+
+connectChannel();
\ No newline at end of file
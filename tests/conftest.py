@@ -0,0 +1,66 @@
+"""
+Configuración común de las pruebas.
+
+La app se importa con el modelo falso (modelo_falso.py) y sin servicios
+externos: sin correo, sin ficheros compartidos (SQLite, trazas, precálculo) y
+sin límite de tasa por cliente. Cada prueba arranca la app con su lifespan y
+un modelo falso con las latencias que necesite (fixture `run_app`).
+"""
+import asyncio
+import os
+
+import httpx
+import pytest
+
+# Antes de importar nucleo/main: su configuración se lee al importarlos
+for _name in ("CACHE_SQLITE_PATH", "TRACE_LOG_PATH", "PRECOMPUTED_PATH", "POPULARITY_LOG_PATH",
+              "SEMANTIC_CACHE_PATH", "RAG_INDEX_PATH", "IA_FAST_MODELS", "IA_FALLBACK_MODELS",
+              "EMAIL_ADDRESS", "EMAIL_PASSWORD", "SMTP_SERVER"):
+    os.environ[_name] = ""
+os.environ.update({
+    "RATE_LIMIT_CLIENT_RPS": "0",
+    "SESSIONS_ENABLED": "false",
+    "SEMANTIC_CACHE_ENABLED": "false",
+    "HEDGE_ENABLED": "false",
+    "MODEL_WARMUP": "false",
+    "PDF_WORKERS": "0",
+})
+
+import modelo_falso  # noqa: E402
+
+modelo_falso.install()
+
+import main  # noqa: E402
+import nucleo  # noqa: E402
+
+
+def _run_app(scenario, **fake_options):
+    """
+    Arranca la app con un modelo falso con `fake_options` (ver modelo_falso.DEFAULT_OPTIONS)
+    y ejecuta `await scenario(client)` con un cliente httpx sobre ASGI. Retorna su resultado.
+    """
+    modelo_falso.install(**fake_options)
+
+    async def run():
+        async with main.app.router.lifespan_context(main.app):
+            # No basta wait_for_model(): el modelo de la prueba anterior sigue asignado
+            # mientras se construye el nuevo
+            await nucleo._model_init
+            if nucleo.answer_cache is not None:
+                await nucleo.answer_cache.purge()
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://elendur.test") as client:
+                return await scenario(client)
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def run_app():
+    return _run_app
+
+
+@pytest.fixture
+def fake_model():
+    """Modelo falso que atiende la generación (el primero del nivel grande)."""
+    return lambda: nucleo.model_router.models[0].backend
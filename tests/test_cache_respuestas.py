@@ -0,0 +1,29 @@
+"""Limpieza de la caché SQLite compartida."""
+import time
+
+from cache_respuestas import SQLiteCache
+
+
+def test_purge_expired_removes_expired_rows(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=0.05)
+    cache.set("a", {"response": "A", "is_tolkien_related": True})
+    cache.set("b", {"response": "B", "is_tolkien_related": True})
+    time.sleep(0.1)
+    cache.ttl_seconds = 3600
+    cache.set("c", {"response": "C", "is_tolkien_related": True})
+
+    assert cache.purge_expired() == 2
+    assert cache.get_stats()["size"] == 1
+    assert cache.get("c")[1]["response"] == "C"
+
+
+def test_purge_expired_trims_oldest_rows_over_max_rows(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"), max_rows=3)
+    for i in range(5):
+        cache.set(f"k{i}", {"response": str(i), "is_tolkien_related": False})
+        time.sleep(0.001)
+
+    assert cache.purge_expired() == 2
+    assert cache.get("k0") is None and cache.get("k1") is None
+    assert [cache.get(f"k{i}")[1]["response"] for i in range(2, 5)] == ["2", "3", "4"]
+    assert cache.get_stats()["evictions"] == 2
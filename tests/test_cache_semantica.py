@@ -0,0 +1,69 @@
+"""Embedding de la caché semántica: qué preguntas se consideran la misma."""
+import asyncio
+
+import pytest
+
+from cache_semantica import SemanticCache, embed
+
+DIM = 512
+THRESHOLD = 0.75  # SEMANTIC_CACHE_THRESHOLD por defecto
+
+
+def similarity(a: str, b: str) -> float:
+    return float(embed(a, DIM) @ embed(b, DIM))
+
+
+@pytest.mark.parametrize("a, b", [
+    ("¿Dónde nació Frodo?", "¿Cuándo nació Frodo?"),
+    ("¿Quién mató a Smaug?", "¿A quién mató Smaug?"),
+    ("Who is Sauron?", "¿Quién es Sauron?"),
+    ("¿Quién es Gandalf?", "¿Quién es Galadriel?"),
+    ("¿En qué año murió Boromir?", "¿En qué año murió Faramir?"),
+    ("¿Cuántos años vivió Bilbo Bolsón?", "¿Cuántos años vivió Frodo Bolsón?"),
+    ("¿Quién es Gandalf?", "¿Quién no es Gandalf?"),
+    ("¿Gandalf murió en Moria?", "¿Gandalf nunca murió en Moria?"),
+    ("¿Cuál es la capital de Francia?", "¿Cuál es la capital de Alemania?"),
+])
+def test_different_questions_stay_below_threshold(a, b):
+    assert similarity(a, b) < THRESHOLD
+
+
+@pytest.mark.parametrize("a, b", [
+    ("¿quién era Gandalf?", "háblame de Gandalf el Gris"),
+    ("¿Qué es un Silmaril?", "Háblame de los Silmarils"),
+    ("Who was Gandalf?", "Tell me about Gandalf"),
+    ("¿Quién era Gandalf?", "¿Quién es Gandalf?"),
+    ("¿Quién era Gandalf?", "¿Quién fue Gandalf el Gris?"),
+    ("¿Qué son los Silmarils?", "¿Qué eran los Silmarils?"),
+    ("¿Quién forjó el Anillo Único?", "¿Quién forjó el anillo único de Sauron?"),
+])
+def test_rephrasings_reach_threshold(a, b):
+    assert similarity(a, b) >= THRESHOLD
+
+
+def test_lookup_does_not_return_another_questions_answer():
+    cache = SemanticCache(capacity=16, dim=DIM, threshold=THRESHOLD)
+    cache.add("¿Dónde nació Frodo?", {"response": "En la Comarca.", "is_tolkien_related": True})
+    assert cache.lookup("¿Cuándo nació Frodo?") is None
+    assert cache.lookup("¿Dónde nacio Frodo?")["response"] == "En la Comarca."
+
+
+def test_negated_question_does_not_reuse_the_answer():
+    cache = SemanticCache(capacity=16, dim=DIM, threshold=THRESHOLD)
+    cache.add("¿Quién es Gandalf?", {"response": "Un Maia.", "is_tolkien_related": True})
+    assert cache.lookup("¿Quién no es Gandalf?") is None
+    assert cache.lookup("háblame de Gandalf el Gris")["response"] == "Un Maia."
+
+
+def test_concurrent_lookups_and_adds_from_threads():
+    cache = SemanticCache(capacity=64, dim=DIM, threshold=THRESHOLD)
+
+    async def run():
+        await asyncio.gather(*(
+            asyncio.to_thread(cache.add, f"¿Quién es el personaje {i} de Gondor?", {"response": str(i)})
+            for i in range(100)
+        ), *(asyncio.to_thread(cache.lookup, "¿Quién es Faramir?") for _ in range(100)))
+
+    asyncio.run(run())
+    assert cache.count == 64
+    assert cache.stats["evictions"] == 36
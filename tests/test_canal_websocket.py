@@ -0,0 +1,111 @@
+"""
+Canal WebSocket: dos preguntas en vuelo sobre la misma sesión guardan ambos
+turnos, y los frames binarios o demasiado grandes (en bytes) se rechazan sin
+cerrar la conexión.
+
+La app se llama directamente por ASGI, dentro del event loop de la prueba.
+"""
+import asyncio
+import json
+import uuid
+
+import main
+import nucleo
+from sesiones import MemorySessionStore
+
+# El pre-clasificador no las decide y no están en la caché: ambas pasan por el modelo
+QUESTIONS = [
+    "¿Qué opinas de la poesía épica medieval?",
+    "Háblame de las sagas nórdicas antiguas.",
+]
+
+
+class WebSocketClient:
+    """Cliente WebSocket mínimo sobre ASGI."""
+
+    def __init__(self, path: str):
+        self.scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "scheme": "ws", "path": path, "raw_path": path.encode(), "root_path": "",
+            "query_string": b"", "headers": [(b"host", b"elendur.test")],
+            "client": ("127.0.0.1", 50000), "server": ("elendur.test", 80), "subprotocols": [],
+        }
+        self.inbound = asyncio.Queue()
+        self.outbound = asyncio.Queue()
+        self.app_task = None
+
+    async def connect(self, query_string: str = "") -> dict:
+        self.scope["query_string"] = query_string.encode()
+        await self.inbound.put({"type": "websocket.connect"})
+        self.app_task = asyncio.create_task(main.app(self.scope, self.inbound.get, self.outbound.put))
+        accepted = await asyncio.wait_for(self.outbound.get(), timeout=5)
+        assert accepted["type"] == "websocket.accept"
+        hello = await self.receive_json()
+        assert hello["type"] == "hello"
+        return hello
+
+    async def send_json(self, message: dict) -> None:
+        await self.inbound.put({"type": "websocket.receive", "text": json.dumps(message, ensure_ascii=False)})
+
+    async def send_raw(self, frame: dict) -> None:
+        await self.inbound.put({"type": "websocket.receive", **frame})
+
+    async def receive_json(self) -> dict:
+        message = await asyncio.wait_for(self.outbound.get(), timeout=5)
+        assert message["type"] == "websocket.send"
+        return json.loads(message["text"])
+
+    async def close(self) -> None:
+        await self.inbound.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.app_task, timeout=5)
+
+
+def test_concurrent_asks_keep_every_turn(run_app, monkeypatch):
+    store = MemorySessionStore()
+    monkeypatch.setattr(main, "session_store", store)
+    monkeypatch.setattr(nucleo, "session_store", store)
+    session_id = uuid.uuid4().hex
+
+    async def scenario(client):
+        ws = WebSocketClient("/ws")
+        hello = await ws.connect(f"session_id={session_id}")
+        assert hello["session_id"] == session_id
+        for index, question in enumerate(QUESTIONS):
+            await ws.send_json({"type": "ask", "id": str(index), "message": question})
+        done = set()
+        while len(done) < len(QUESTIONS):
+            message = await ws.receive_json()
+            assert message["type"] in ("chunk", "done"), message
+            if message["type"] == "done":
+                done.add(message["id"])
+        await ws.close()
+        return await store.load(session_id)
+
+    history = run_app(scenario, latency="fixed:0.2", classification_latency="fixed:0.01")
+    questions = [turn["parts"][0] for turn in history if turn["role"] == "user"]
+    assert sorted(questions) == sorted(QUESTIONS)
+    assert len(history) == 4
+
+
+def test_binary_and_oversized_frames_are_rejected(run_app):
+    async def scenario(client):
+        ws = WebSocketClient("/ws")
+        await ws.connect()
+        await ws.send_raw({"bytes": b"\x00\x01"})
+        binary_error = await ws.receive_json()
+        # Menos caracteres que el límite, pero más bytes en UTF-8
+        oversized = json.dumps({"type": "ask", "id": "1", "message": "ñ" * (main.WS_MAX_MESSAGE_BYTES // 2 + 10)},
+                               ensure_ascii=False)
+        assert len(oversized) < main.WS_MAX_MESSAGE_BYTES < len(oversized.encode("utf-8"))
+        await ws.send_raw({"text": oversized})
+        size_error = await ws.receive_json()
+        # La conexión sigue abierta
+        await ws.send_json({"type": "nada", "id": "2"})
+        unknown_error = await ws.receive_json()
+        await ws.close()
+        return binary_error, size_error, unknown_error
+
+    binary_error, size_error, unknown_error = run_app(scenario)
+    assert binary_error["type"] == "error" and "texto" in binary_error["detail"]
+    assert size_error["type"] == "error" and "demasiado grande" in size_error["detail"]
+    assert unknown_error["type"] == "error" and unknown_error["id"] == "2"
@@ -0,0 +1,65 @@
+"""
+/chat genera la respuesta y clasifica la pregunta en paralelo: la latencia es la
+de la llamada más lenta y no la suma, y una clasificación que se pasa de
+CLASSIFICATION_TIMEOUT_SECONDS no retrasa la respuesta más allá de ese plazo.
+"""
+import time
+
+import nucleo
+from clasificador_local import pre_classify
+
+# Margen para la sobrecarga de la app y del event loop
+TOLERANCE_SECONDS = 0.15
+
+# Sin términos de Tolkien ni fórmulas de cortesía: el pre-clasificador no decide
+# y la clasificación pasa por el modelo
+QUESTIONS = [
+    "¿Qué opinas de la poesía épica medieval?",
+    "Háblame de las sagas nórdicas antiguas.",
+    "¿Cómo se escribía un poema aliterativo?",
+]
+
+
+def test_questions_need_model_classification():
+    for question in QUESTIONS:
+        assert pre_classify(question) is None
+
+
+async def _timed_chat(client, question):
+    start = time.perf_counter()
+    response = await client.post("/chat", json={"message": question})
+    return response, time.perf_counter() - start
+
+
+def test_latency_is_generation_when_it_is_slower(run_app):
+    async def scenario(client):
+        return await _timed_chat(client, QUESTIONS[0])
+
+    response, elapsed = run_app(scenario, latency="fixed:0.4", classification_latency="fixed:0.3")
+    assert response.status_code == 200
+    assert response.json()["ask_for_download"] is True
+    assert 0.4 <= elapsed < 0.4 + TOLERANCE_SECONDS
+
+
+def test_latency_is_classification_when_it_is_slower(run_app):
+    async def scenario(client):
+        return await _timed_chat(client, QUESTIONS[1])
+
+    response, elapsed = run_app(scenario, latency="fixed:0.2", classification_latency="fixed:0.5")
+    assert response.status_code == 200
+    assert response.json()["ask_for_download"] is True
+    assert 0.5 <= elapsed < 0.5 + TOLERANCE_SECONDS
+
+
+def test_slow_classification_falls_back_to_default(run_app, monkeypatch):
+    monkeypatch.setattr(nucleo, "CLASSIFICATION_TIMEOUT_SECONDS", 0.3)
+
+    async def scenario(client):
+        return await _timed_chat(client, QUESTIONS[2])
+
+    response, elapsed = run_app(scenario, latency="fixed:0.1", classification_latency="fixed:3")
+    assert response.status_code == 200
+    assert response.json()["response"]
+    assert response.json()["ask_for_download"] is nucleo.CLASSIFICATION_DEFAULT
+    # La respuesta espera como mucho el plazo de la clasificación, no sus 3 s
+    assert elapsed < 0.3 + TOLERANCE_SECONDS
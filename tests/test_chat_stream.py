@@ -0,0 +1,88 @@
+"""
+/chat/stream (SSE): el primer fragmento llega mucho antes que la respuesta
+completa, y si el cliente se desconecta se corta la lectura del modelo y se
+libera su hueco de llamada.
+
+La app se llama directamente por ASGI para ver cada fragmento en el momento en
+que se envía (el transporte ASGI de httpx entrega la respuesta completa).
+"""
+import asyncio
+import json
+import time
+
+import main
+import nucleo
+
+# Pregunta que el pre-clasificador resuelve: solo hay una llamada al modelo
+QUESTION = "¿Quién es Gandalf?"
+
+
+async def stream_chat(message: str, disconnect_after_chunks: int = None) -> dict:
+    """
+    POST /chat/stream por ASGI. Retorna los fragmentos con el instante en que se
+    enviaron y el cuerpo completo. Con `disconnect_after_chunks`, el cliente se
+    desconecta tras recibir ese número de fragmentos.
+    """
+    body = json.dumps({"message": message}).encode("utf-8")
+    disconnected = asyncio.Event()
+    request_sent = False
+    start = time.perf_counter()
+    chunks = []
+    received = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] != "http.response.body":
+            return
+        received.append(message.get("body", b""))
+        if b"event: chunk" in message.get("body", b""):
+            chunks.append(time.perf_counter() - start)
+            if disconnect_after_chunks is not None and len(chunks) >= disconnect_after_chunks:
+                disconnected.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/chat/stream", "raw_path": b"/chat/stream",
+        "root_path": "", "query_string": b"", "client": ("127.0.0.1", 50000), "server": ("elendur.test", 80),
+        "headers": [(b"host", b"elendur.test"), (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())],
+    }
+    await main.app(scope, receive, send)
+    return {"chunks": chunks, "body": b"".join(received).decode("utf-8"), "elapsed": time.perf_counter() - start}
+
+
+def test_first_chunk_arrives_long_before_the_full_answer(run_app):
+    async def scenario(client):
+        return await stream_chat(QUESTION)
+
+    # El modelo falso envía el primer fragmento al 25 % de la latencia y el resto hasta el final
+    result = run_app(scenario, latency="fixed:1.0", stream_chunks=8)
+    assert result["body"].count("event: chunk") == 8
+    assert "event: done" in result["body"]
+    assert result["chunks"][0] < 0.4
+    assert result["elapsed"] >= 0.95
+    assert result["chunks"][0] < result["elapsed"] / 2
+
+
+def test_client_disconnect_stops_the_upstream_stream(run_app):
+    async def scenario(client):
+        result = await stream_chat(QUESTION, disconnect_after_chunks=1)
+        in_flight = nucleo.admission.get_stats()["in_flight"]
+        cached = await nucleo.get_cached_answer(QUESTION)
+        return result, in_flight, cached
+
+    result, in_flight, cached = run_app(scenario, latency="fixed:2.0", stream_chunks=8)
+    # La respuesta termina enseguida y no en los 2 s del modelo
+    assert result["elapsed"] < 1.0
+    assert len(result["chunks"]) == 1
+    assert "event: done" not in result["body"]
+    # El hueco de llamada al modelo se libera y la respuesta parcial no se guarda
+    assert in_flight == 0
+    assert cached is None
@@ -0,0 +1,40 @@
+"""Decisiones del pre-clasificador local (sin modelo)."""
+import pytest
+
+from clasificador_local import pre_classify, run_benchmark
+
+
+@pytest.mark.parametrize("query", [
+    "¿Dónde compro mandos para la consola?",
+    "¿Cuál es la comarca más poblada de Aragón?",
+    "Que arda Troya",
+    "Blancanieves y los siete enanos",
+    "Mi abuelo se moría de risa",
+    "Se me rompió el bolsón",
+    "¿Cuántos elfos tiene Papá Noel?",
+    "¿Cuánto pesa un caballo shire?",
+])
+def test_common_spanish_words_are_not_decided_locally(query):
+    # Solas no bastan: las decide el modelo
+    assert pre_classify(query) is None
+
+
+@pytest.mark.parametrize("query", [
+    "¿Quiénes son los enanos de Erebor?",
+    "¿Qué juicio dictó Mandos sobre los Noldor?",
+    "¿Dónde está la Comarca en la Tierra Media?",
+    "¿Quién era el Balrog de Moria?",
+    "¿Dónde vivía Bilbo Bolsón?",
+    "¿Cómo despertaron los elfos en Cuiviénen según Tolkien?",
+])
+def test_weak_terms_with_a_second_signal_are_tolkien(query):
+    assert pre_classify(query) is True
+
+
+@pytest.mark.parametrize("query", ["Hola Elendur", "Gracias por tu respuesta.", "¿Quién eres?"])
+def test_smalltalk_is_not_tolkien(query):
+    assert pre_classify(query) is False
+
+
+def test_benchmark_has_no_wrong_local_decisions():
+    assert run_benchmark(repetitions=1)["accuracy_on_decided"] == 1.0
@@ -0,0 +1,29 @@
+"""
+N peticiones /chat idénticas y simultáneas comparten una sola llamada al modelo
+(y una sola clasificación).
+"""
+import asyncio
+
+import nucleo
+
+CONCURRENCY = 20
+
+# El pre-clasificador no la decide: la clasificación también pasa por el modelo
+QUESTION = "¿Qué opinas de la poesía épica medieval?"
+
+
+def test_identical_concurrent_chats_make_one_upstream_call(run_app, fake_model):
+    async def scenario(client):
+        return await asyncio.gather(*(
+            client.post("/chat", json={"message": QUESTION}) for _ in range(CONCURRENCY)
+        ))
+
+    calls_before = nucleo.single_flight.stats["upstream_calls"]
+    responses = run_app(scenario, latency="fixed:0.3", classification_latency="fixed:0.1")
+
+    assert all(response.status_code == 200 for response in responses)
+    assert len({response.json()["response"] for response in responses}) == 1
+    stats = fake_model().stats
+    assert stats["classification_calls"] == 1
+    assert stats["calls"] - stats["classification_calls"] == 1
+    assert nucleo.single_flight.stats["upstream_calls"] - calls_before == 1
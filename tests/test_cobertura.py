@@ -0,0 +1,96 @@
+"""Peticiones de cobertura contra modelos falsos: cuándo se lanza la copia y cuánto cuesta."""
+import asyncio
+import time
+
+from cobertura import Hedger
+from modelo_falso import FakeGenerativeModel
+
+QUESTION = "¿Quién es Gandalf?"
+
+
+def _warm_hedger(**options) -> Hedger:
+    """Hedger con 20 latencias recientes de 50 ms: el umbral (p90) es 50 ms."""
+    hedger = Hedger(min_samples=20, **options)
+    for _ in range(20):
+        hedger.window.add(0.05)
+    return hedger
+
+
+def _caller(model: FakeGenerativeModel, cancelled: list = None):
+    async def call():
+        try:
+            return await model.start_chat(history=[]).send_message_async(QUESTION)
+        except asyncio.CancelledError:
+            if cancelled is not None:
+                cancelled.append(model.model_name)
+            raise
+    return call
+
+
+def test_no_hedge_before_the_latency_percentile():
+    hedger = _warm_hedger()
+    primary = FakeGenerativeModel("principal", latency="fixed:0.01")
+    backup = FakeGenerativeModel("copia", latency="fixed:0.01")
+
+    asyncio.run(hedger.call(_caller(primary), _caller(backup)))
+    assert hedger.stats["hedged"] == 0
+    assert backup.stats["calls"] == 0
+
+
+def test_no_hedge_without_enough_samples():
+    hedger = Hedger(min_samples=20)
+    primary = FakeGenerativeModel("principal", latency="fixed:0.2")
+    backup = FakeGenerativeModel("copia", latency="fixed:0.01")
+
+    asyncio.run(hedger.call(_caller(primary), _caller(backup)))
+    assert hedger.stats["hedged"] == 0
+    assert backup.stats["calls"] == 0
+
+
+def test_slow_call_is_hedged_after_the_threshold_and_the_loser_is_cancelled():
+    hedger = _warm_hedger()
+    primary = FakeGenerativeModel("principal", latency="fixed:2.0")
+    backup = FakeGenerativeModel("copia", latency="fixed:0.01")
+    cancelled = []
+
+    async def scenario():
+        start = time.perf_counter()
+        response = await hedger.call(_caller(primary, cancelled), _caller(backup, cancelled))
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0)  # la cancelación se entrega en la siguiente vuelta del loop
+        return response, elapsed
+
+    response, elapsed = asyncio.run(scenario())
+    assert response.text
+    # La copia sale al superar el umbral (50 ms) y gana mucho antes que la original
+    assert 0.05 <= elapsed < 1.0
+    assert hedger.stats["hedged"] == 1
+    assert hedger.stats["hedge_wins"] == 1
+    assert backup.stats["calls"] == 1
+    assert cancelled == ["principal"]
+
+
+def test_no_hedge_once_the_budget_is_exhausted():
+    # Sin fichas nuevas: solo queda la ficha inicial
+    hedger = _warm_hedger(max_extra_ratio=0.0)
+    primary = FakeGenerativeModel("principal", latency="fixed:0.2")
+    backup = FakeGenerativeModel("copia", latency="fixed:0.01")
+
+    async def scenario():
+        for _ in range(3):
+            await hedger.call(_caller(primary), _caller(backup))
+
+    asyncio.run(scenario())
+    assert hedger.stats["hedged"] == 1
+    assert hedger.stats["budget_denied"] == 2
+    assert backup.stats["calls"] == 1
+
+
+def test_can_hedge_veto_blocks_the_copy():
+    hedger = _warm_hedger()
+    primary = FakeGenerativeModel("principal", latency="fixed:0.2")
+    backup = FakeGenerativeModel("copia", latency="fixed:0.01")
+
+    asyncio.run(hedger.call(_caller(primary), _caller(backup), can_hedge=lambda: False))
+    assert hedger.stats["capacity_denied"] == 1
+    assert backup.stats["calls"] == 0
@@ -0,0 +1,100 @@
+"""Reintentos y reconexiones de la cola de correo, con un servidor SMTP falso."""
+import asyncio
+import smtplib
+
+import pytest
+
+import cola_correo
+from cola_correo import MailQueue, JOB_SENT, JOB_FAILED
+
+
+class FakeSMTP:
+    """Sustituye a smtplib.SMTP. `errors` son las excepciones de los siguientes envíos (None = éxito)."""
+    errors = []
+    connections = []
+
+    def __init__(self, host, port, timeout=None):
+        self.logins = 0
+        self.sent = 0
+        FakeSMTP.connections.append(self)
+
+    def ehlo(self):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, username, password):
+        self.logins += 1
+
+    def noop(self):
+        return 250, b"OK"
+
+    def send_message(self, msg):
+        error = FakeSMTP.errors.pop(0) if FakeSMTP.errors else None
+        if error is not None:
+            raise error
+        self.sent += 1
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fake_smtp(monkeypatch):
+    FakeSMTP.errors = []
+    FakeSMTP.connections = []
+    monkeypatch.setattr(cola_correo.smtplib, "SMTP", FakeSMTP)
+
+
+def deliver(errors: list, **options) -> dict:
+    """Envía un correo con los errores indicados y retorna el trabajo terminado."""
+    FakeSMTP.errors = list(errors)
+
+    async def run():
+        queue = MailQueue("smtp.test", 587, "elendur@test", "Elendur", username="elendur@test",
+                          password="secreto", workers=1, backoff_seconds=0.01, **options)
+        queue.start()
+        job_id = queue.enqueue("lector@test", "Asunto", "Cuerpo")
+        await queue.stop()
+        return queue.get_job(job_id)
+
+    return asyncio.run(run())
+
+
+def test_permanent_rejection_is_not_retried():
+    job = deliver([smtplib.SMTPRecipientsRefused({"lector@test": (550, b"No such user")})])
+    assert job["status"] == JOB_FAILED
+    assert job["attempts"] == 1
+    assert len(FakeSMTP.connections) == 1
+
+
+def test_permanent_data_error_is_not_resent_on_a_new_connection():
+    job = deliver([smtplib.SMTPDataError(554, b"Message rejected")])
+    assert job["status"] == JOB_FAILED
+    assert job["attempts"] == 1
+    assert sum(connection.sent for connection in FakeSMTP.connections) == 0
+    assert len(FakeSMTP.connections) == 1
+
+
+def test_disconnect_reconnects_and_resends_once():
+    job = deliver([smtplib.SMTPServerDisconnected("Connection unexpectedly closed")])
+    assert job["status"] == JOB_SENT
+    assert job["attempts"] == 1
+    assert len(FakeSMTP.connections) == 2
+
+
+def test_temporary_error_is_retried_with_backoff():
+    job = deliver([smtplib.SMTPDataError(451, b"Try again later")])
+    assert job["status"] == JOB_SENT
+    assert job["attempts"] == 2
+
+
+def test_login_is_always_done_with_credentials():
+    deliver([])
+    assert FakeSMTP.connections[0].logins == 1
+
+
+def test_login_can_be_disabled_for_local_servers():
+    deliver([], use_auth=False)
+    assert FakeSMTP.connections[0].logins == 0
@@ -0,0 +1,19 @@
+"""La configuración incompleta falla al arrancar el núcleo, no al importarlo."""
+import asyncio
+
+import pytest
+
+import nucleo
+
+
+@pytest.mark.parametrize("name", ["GEMINI_API_KEY", "IA_GENERATIVE_MODEL_NAME"])
+def test_start_raises_configuration_error(monkeypatch, name):
+    monkeypatch.setattr(nucleo, name, None)
+    with pytest.raises(nucleo.ConfigurationError):
+        asyncio.run(nucleo.start())
+    # No se llegó a lanzar nada en segundo plano
+    assert nucleo._background_tasks == []
+
+
+def test_complete_configuration_passes():
+    nucleo.check_config()
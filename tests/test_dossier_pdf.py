@@ -0,0 +1,27 @@
+"""El dossier de una sesión compactada no incluye el resumen de la compactación."""
+from dossier_pdf import entries_from_history
+from sesiones import compact_history, is_summary_turn
+
+
+def _history(pairs: int) -> list:
+    history = []
+    for i in range(pairs):
+        history.append({"role": "user", "parts": [f"Pregunta {i} sobre los Istari " + "x" * 200]})
+        history.append({"role": "model", "parts": [f"Respuesta {i} " + "y" * 400]})
+    return history
+
+
+def test_summary_pair_is_skipped():
+    compacted = compact_history(_history(12), token_budget=600, max_turns=20)
+    assert is_summary_turn(compacted[0])
+
+    entries = entries_from_history(compacted)
+    assert len(entries) == (len(compacted) - 2) // 2
+    for question, answer in entries:
+        assert question.startswith("Pregunta ")
+        assert answer.startswith("Respuesta ")
+
+
+def test_plain_history_is_unchanged():
+    entries = entries_from_history(_history(3))
+    assert [question[:10] for question, _ in entries] == ["Pregunta 0", "Pregunta 1", "Pregunta 2"]
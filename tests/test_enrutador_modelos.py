@@ -0,0 +1,56 @@
+"""Enrutador de modelos contra modelos falsos locales (modelo_falso.py)."""
+import asyncio
+import time
+
+from enrutador_modelos import ModelRouter, RoutedModel, TIER_FAST, TIER_LARGE
+from modelo_falso import FakeGenerativeModel
+
+SCHOLARLY_QUESTION = "Compara la evolución de Sauron en los manuscritos y borradores con su papel en El Silmarillion"
+
+
+def _router(**large_options):
+    fast = RoutedModel("rapido", TIER_FAST, FakeGenerativeModel("rapido", latency="fixed:0.001"))
+    large = RoutedModel("grande", TIER_LARGE, FakeGenerativeModel("grande", latency="fixed:0.001", **large_options))
+    backup = RoutedModel("respaldo", TIER_LARGE, FakeGenerativeModel("respaldo", latency="fixed:0.001"))
+    return ModelRouter(fast=[fast], large=[large, backup], cooldown_seconds=30)
+
+
+def _ask(router, purpose, message):
+    async def send(backend):
+        response = await backend.start_chat(history=[]).send_message_async(message)
+        return backend.model_name, response.text
+
+    return asyncio.run(router.call(purpose, message, send))
+
+
+def test_rate_limit_fails_over_to_next_model():
+    router = _router(rate_limit_rate=1.0)
+    name, _text = _ask(router, "answer", SCHOLARLY_QUESTION)
+
+    assert name == "respaldo"
+    assert router.stats["failovers"] == 1
+    large = router.large[0]
+    assert large.health.stats["rate_limited"] == 1
+    # El 429 deja el modelo enfriándose: la siguiente llamada ya no lo prueba primero
+    assert large.health.cooldown_until > time.monotonic()
+    assert router.candidates("answer", SCHOLARLY_QUESTION)[0].name == "respaldo"
+
+
+def test_cooling_down_model_is_ranked_behind_healthy_ones():
+    router = _router()
+    router.large[0].health.cooldown_until = time.monotonic() + 30
+
+    names = [c.name for c in router.candidates("answer", SCHOLARLY_QUESTION)]
+    # Detrás incluso de los modelos sanos del otro nivel
+    assert names == ["respaldo", "rapido", "grande"]
+
+
+def test_classification_always_goes_to_fast_tier():
+    router = _router()
+    for message in ("Hola", SCHOLARLY_QUESTION + " ¿Y por qué? ¿Y su etimología en quenya?"):
+        assert router.candidates("classification", message)[0].tier == TIER_FAST
+        name, _text = _ask(router, "classification", f"{message} (YES/NO)")
+        assert name == "rapido"
+    assert router.stats["routed_fast"] == 2
+    assert router.stats["routed_large"] == 0
+    assert all(m.backend.stats["calls"] == 0 for m in router.large)
@@ -0,0 +1,61 @@
+"""Caché de PDF con la fecha actual y recuperación del pool tras la muerte de un worker."""
+import asyncio
+import os
+
+import generador_pdf
+from generador_pdf import PdfRenderer, TIMESTAMP_PLACEHOLDER
+
+
+class _FrozenDatetime:
+    """Sustituye a `datetime` con una hora fija que la prueba puede avanzar."""
+    current = "2026-01-01 10:00:00"
+
+    @classmethod
+    def now(cls):
+        return cls
+
+    @classmethod
+    def strftime(cls, fmt):
+        return cls.current
+
+
+def test_cache_hits_a_minute_later_with_the_current_date(monkeypatch):
+    monkeypatch.setattr(generador_pdf, "datetime", _FrozenDatetime)
+    renderer = PdfRenderer("Elendur", workers=0)
+
+    async def scenario():
+        _FrozenDatetime.current = "2026-01-01 10:00:00"
+        first = await renderer.render("¿Quién es Gandalf?", "Un Istar.")
+        _FrozenDatetime.current = "2026-01-01 10:01:30"
+        later = await renderer.render("¿Quién es Gandalf?", "Un Istar.")
+        return first, later
+
+    first, later = asyncio.run(scenario())
+    assert renderer.stats["rendered"] == 1
+    assert renderer.stats["cache_hits"] == 1
+    assert b"2026-01-01 10:00:00" in first
+    assert b"2026-01-01 10:01:30" in later
+    assert b"10:00:00" not in later
+    assert TIMESTAMP_PLACEHOLDER.encode() not in later
+    assert len(later) == len(first)
+
+
+def test_broken_pool_is_recreated():
+    renderer = PdfRenderer("Elendur", workers=1)
+    renderer.start()
+
+    async def scenario():
+        # Un worker que muere deja el pool roto para todas las peticiones siguientes
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(renderer._executor, os._exit, 1)
+        except Exception:
+            pass
+        return await renderer.render("¿Quién es Gandalf?", "Un Istar.")
+
+    try:
+        pdf = asyncio.run(scenario())
+    finally:
+        renderer.stop()
+    assert pdf.startswith(b"%PDF")
+    assert renderer.stats["pool_restarts"] == 1
@@ -0,0 +1,28 @@
+"""Identificación del cliente para el límite de tasa, con y sin proxies de confianza."""
+from starlette.requests import Request
+
+import main
+
+
+def _request(forwarded_for=None):
+    headers = [(b"x-forwarded-for", forwarded_for.encode())] if forwarded_for else []
+    return Request({"type": "http", "headers": headers, "client": ("10.0.0.1", 5000)})
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMIT_TRUSTED_PROXIES", 0)
+    assert main._client_id(_request("203.0.113.7")) == "10.0.0.1"
+
+
+def test_forwarded_for_counts_trusted_proxies_from_the_end(monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMIT_TRUSTED_PROXIES", 1)
+    # El cliente puede inventarse la primera entrada; la última la añade el proxy
+    assert main._client_id(_request("198.51.100.1, 203.0.113.7")) == "203.0.113.7"
+    monkeypatch.setattr(main, "RATE_LIMIT_TRUSTED_PROXIES", 2)
+    assert main._client_id(_request("198.51.100.1, 203.0.113.7, 10.0.0.2")) == "203.0.113.7"
+
+
+def test_missing_forwarded_for_falls_back_to_connection(monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMIT_TRUSTED_PROXIES", 2)
+    assert main._client_id(_request("203.0.113.7")) == "10.0.0.1"
+    assert main._client_id(_request()) == "10.0.0.1"
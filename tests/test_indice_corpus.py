@@ -0,0 +1,74 @@
+"""Ranking BM25 del corpus y respuestas directas del glosario."""
+import pytest
+
+from indice_corpus import CorpusIndex, build_index, iter_passages
+
+GLOSSARY = """\
+Silmaril: cada una de las tres joyas que forjó Fëanor con la luz de los Dos Árboles.
+Mithril: metal de Moria, ligero y más duro que el acero.
+Anillo Único: anillo que forjó Sauron en el Monte del Destino.
+Anillo de Barahir: anillo que Finrod dio a Barahir.
+"""
+
+STORIES = {
+    "relatos.txt": "Fëanor forjó los Silmarils en Valinor y juró recuperarlos cuando Morgoth los robó. "
+                   "Los hijos de Fëanor repitieron el juramento.",
+    "viajes.txt": "Frodo y Sam cruzaron Mordor hasta el Monte del Destino. "
+                  "Gollum los guió por las escaleras de Cirith Ungol.",
+}
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    corpus = tmp_path_factory.mktemp("corpus")
+    (corpus / "glosario.txt").write_text(GLOSSARY, encoding="utf-8")
+    for name, text in STORIES.items():
+        (corpus / name).write_text(text, encoding="utf-8")
+    index_dir = tmp_path_factory.mktemp("indice")
+    meta = build_index(iter_passages(str(corpus)), str(index_dir))
+    assert meta["passages"] == 6
+    return CorpusIndex(str(index_dir))
+
+
+def test_search_ranks_the_passage_that_matches_more_terms_first(index):
+    results = index.search("¿Quién forjó los Silmarils?", top_k=3)
+    assert results[0][1]["source"] == "relatos.txt"
+    assert [score for score, _ in results] == sorted((score for score, _ in results), reverse=True)
+
+    results = index.search("¿Cómo cruzaron Frodo y Sam Mordor?")
+    assert results[0][1]["source"] == "viajes.txt"
+
+
+def test_search_without_known_terms_returns_nothing(index):
+    assert index.search("¿Cuál es la capital de Francia?") == []
+
+
+@pytest.mark.parametrize("query, term", [
+    ("¿Qué es un Silmaril?", "Silmaril"),
+    ("¿Qué es el mithril?", "Mithril"),
+    ("¿Qué es el Anillo Único?", "Anillo Único"),
+])
+def test_definitional_question_is_answered_from_the_glossary(index, query, term):
+    answer = index.glossary_answer(query)
+    assert answer is not None
+    assert answer["term"] == term
+
+
+@pytest.mark.parametrize("query", [
+    # Más de 4 términos: no es una pregunta de definición
+    "¿Por qué juró Fëanor recuperar los Silmarils robados por Morgoth?",
+    # El término del mejor pasaje no cubre "moria"
+    "¿Qué es el mithril de Moria?",
+    # El mejor pasaje no es del glosario
+    "¿Quién forjó los Silmarils?",
+])
+def test_non_definitional_question_goes_to_the_model(index, query):
+    assert index.glossary_answer(query) is None
+
+
+def test_glossary_answer_requires_a_clear_margin(index):
+    # "Anillo de Barahir" y "Anillo Único" puntúan casi igual para "anillo"
+    results = index.search("¿Qué es un anillo?", top_k=2)
+    assert results[1][0] * 1.5 > results[0][0]
+    assert index.glossary_answer("¿Qué es un anillo?") is None
+    assert index.glossary_answer("¿Qué es un anillo?", min_margin=1.0)["term"] == "Anillo de Barahir"
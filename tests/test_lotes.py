@@ -0,0 +1,71 @@
+"""Clasificación agrupada, punto de control del cliente y deduplicación de /chat/batch."""
+import asyncio
+import json
+
+from lotes import classify_batch, load_done_ids, parse_classification
+
+# El pre-clasificador no la decide: clasificación y generación pasan por el modelo
+QUESTION = "¿Qué opinas de la poesía épica medieval?"
+
+
+def test_parse_classification_reads_each_numbered_line():
+    assert parse_classification("1: YES\n2. no\n3) Yes", 3) == [True, False, True]
+
+
+def test_garbled_reply_leaves_positions_without_verdict():
+    # Línea 2 ausente, número fuera de rango y texto sin formato
+    text = "1: YES\n7: NO\nLa tercera creo que sí.\n4 - NO"
+    assert parse_classification(text, 4) == [True, None, None, False]
+    assert parse_classification("", 2) == [None, None]
+
+
+def test_classify_batch_falls_back_to_default_per_position():
+    async def partial_reply(prompt, max_output_tokens):
+        assert "2. ¿Y el clima?" in prompt
+        return "1: YES\n3: NO"
+
+    async def failing_reply(prompt, max_output_tokens):
+        raise RuntimeError("sin conexión")
+
+    queries = ["¿Quién es Gandalf?", "¿Y el clima?", "Hola"]
+    assert asyncio.run(classify_batch(queries, partial_reply, default=True, timeout_seconds=1)) == [True, True, False]
+    assert asyncio.run(classify_batch(queries, failing_reply, default=False, timeout_seconds=1)) == [False] * 3
+
+
+def test_load_done_ids_retries_errors_and_skips_a_truncated_line(tmp_path):
+    output = tmp_path / "respuestas.ndjson"
+    lines = [
+        {"id": "a", "response": "A", "error": None},
+        {"id": "b", "response": "B", "error": None},
+        {"id": "c", "response": None, "error": "El modelo no respondió."},
+        {"id": "b", "response": None, "error": "El modelo no respondió."},
+        {"id": "c", "response": "C", "error": None},
+    ]
+    text = "".join(json.dumps(line) + "\n" for line in lines)
+    # Última línea a medias: el proceso murió escribiéndola
+    text += '{"id": "d", "respo'
+    output.write_text(text, encoding="utf-8")
+
+    assert load_done_ids(str(output)) == {"a", "c"}
+    assert load_done_ids(str(tmp_path / "no_existe.ndjson")) == set()
+
+
+def test_batch_answers_identical_questions_once(run_app, fake_model):
+    items = [
+        {"id": "1", "message": QUESTION},
+        {"id": "2", "message": QUESTION},
+        {"id": "3", "message": QUESTION},
+    ]
+
+    async def scenario(client):
+        return await client.post("/chat/batch", json={"items": items})
+
+    response = run_app(scenario, latency="fixed:0.05")
+    assert response.status_code == 200
+    records = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+    assert sorted(record["id"] for record in records) == ["1", "2", "3"]
+    assert all(record["error"] is None for record in records)
+    assert len({record["response"] for record in records}) == 1
+    stats = fake_model().stats
+    assert stats["calls"] - stats["classification_calls"] == 1
+    assert stats["classification_calls"] == 1
@@ -0,0 +1,94 @@
+"""Formato de texto de Prometheus, tipos de /metrics y escritura de trazas en un hilo."""
+import asyncio
+import json
+
+from metricas import Histogram, MetricsMiddleware, render_stats, stage
+
+
+def _types(text: str) -> dict:
+    """Nombre de métrica -> tipo, según las líneas `# TYPE`."""
+    return {
+        line.split()[2]: line.split()[3]
+        for line in text.splitlines() if line.startswith("# TYPE ")
+    }
+
+
+def test_histogram_renders_cumulative_buckets_sum_and_count():
+    histogram = Histogram("prueba_seconds", "Prueba.", ("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, "generation")
+
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP prueba_seconds Prueba.", "# TYPE prueba_seconds histogram"]
+    assert lines[2:] == [
+        'prueba_seconds_bucket{stage="generation",le="0.1"} 2',
+        'prueba_seconds_bucket{stage="generation",le="1.0"} 3',
+        'prueba_seconds_bucket{stage="generation",le="+Inf"} 4',
+        'prueba_seconds_sum{stage="generation"} 3.65',
+        'prueba_seconds_count{stage="generation"} 4',
+    ]
+
+
+def test_render_stats_exports_gauges_and_counters():
+    text = render_stats("elendur_prueba", {"hits": 3, "size": 10, "ratio": 0.5, "path": "x", "ready": True},
+                        gauges={"size", "ratio"})
+    assert _types(text) == {
+        "elendur_prueba_hits": "counter",
+        "elendur_prueba_size": "gauge",
+        "elendur_prueba_ratio": "gauge",
+    }
+    assert "elendur_prueba_hits 3" in text.splitlines()
+
+
+def test_metrics_endpoint_types_counters_and_gauges(run_app):
+    async def scenario(client):
+        await client.post("/chat", json={"message": "¿Quién es Gandalf?"})
+        return await client.get("/metrics")
+
+    response = run_app(scenario)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    types = _types(response.text)
+    assert types["elendur_stage_seconds"] == "histogram"
+    assert types["elendur_http_request_seconds"] == "histogram"
+    assert types["elendur_cache_hits"] == "counter"
+    assert types["elendur_cache_misses"] == "counter"
+    assert types["elendur_cache_size"] == "gauge"
+    assert types["elendur_admission_admitted"] == "counter"
+    assert types["elendur_admission_in_flight"] == "gauge"
+    assert types["elendur_classifier_hit_ratio"] == "gauge"
+    assert types["elendur_router_model_calls"] == "counter"
+    assert types["elendur_router_model_latency_ewma_seconds"] == "gauge"
+    # El registro es global: otras pruebas también han medido /chat
+    assert 'elendur_http_request_seconds_count{route="/chat",method="POST",status="200"} ' in response.text
+
+
+def test_traces_are_written_by_the_background_writer(tmp_path):
+    path = tmp_path / "trazas.jsonl"
+
+    async def app(scope, receive, send):
+        with stage("generation"):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    middleware = MetricsMiddleware(app, trace_log_path=str(path))
+
+    async def scenario():
+        for _ in range(3):
+            await middleware({"type": "http", "path": "/chat", "method": "POST"}, receive, send)
+
+    asyncio.run(scenario())
+    middleware.trace_writer.close()
+
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert len(records) == 3
+    assert len({record["trace_id"] for record in records}) == 3
+    assert records[0]["status"] == 200
+    assert records[0]["spans"][0]["stage"] == "generation"
+    assert records[0]["response_start_ms"] is not None
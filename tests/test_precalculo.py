@@ -0,0 +1,119 @@
+"""Fichero de respuestas precalculadas y su regeneración en segundo plano: reintentos y bloqueo."""
+import asyncio
+import hashlib
+import os
+import time
+
+import precalculo
+from cache_respuestas import make_cache_key
+from precalculo import PrecomputedAnswers, refresh_periodically, retry_delay, write_store
+
+
+def _run_refresher(answers, rebuild, checks: int, interval_seconds: float = 0.02):
+    async def run():
+        task = asyncio.create_task(refresh_periodically(answers, rebuild, interval_seconds, 0))
+        await asyncio.sleep(interval_seconds * checks)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+
+
+def test_failed_rebuild_backs_off(tmp_path):
+    answers = PrecomputedAnswers(str(tmp_path / "precalculadas.bin"), "ns")
+    attempts = []
+
+    async def rebuild():
+        attempts.append(time.monotonic())
+        raise RuntimeError("cuota agotada")
+
+    # Con interval 0.02 s, el primer reintento espera 0.04 s y el segundo 0.08 s
+    _run_refresher(answers, rebuild, checks=10)
+    assert 2 <= len(attempts) <= 4
+    assert answers.stats["rebuild_errors"] == len(attempts)
+    # El fallo queda anotado para los demás workers y el bloqueo se libera
+    assert os.path.exists(answers.path + ".failed")
+    assert not os.path.exists(answers.path + ".lock")
+
+
+def test_empty_rebuild_counts_as_failure(tmp_path):
+    answers = PrecomputedAnswers(str(tmp_path / "precalculadas.bin"), "ns")
+    attempts = []
+
+    async def rebuild():
+        attempts.append(1)
+        return 0
+
+    # Dos comprobaciones: la segunda cae dentro de la espera tras el fallo
+    _run_refresher(answers, rebuild, checks=1.6, interval_seconds=0.05)
+    assert len(attempts) == 1
+    assert answers.stats["rebuild_errors"] == 1
+
+
+def test_retry_delay_is_exponential_and_bounded():
+    assert retry_delay(0, 300) == 0
+    assert retry_delay(1, 300) == 600
+    assert retry_delay(2, 300) == 1200
+    assert retry_delay(10, 300) == precalculo.MAX_RETRY_BACKOFF_SECONDS
+
+
+def test_lock_is_refreshed_during_long_rebuild(tmp_path, monkeypatch):
+    monkeypatch.setattr(precalculo, "LOCK_REFRESH_SECONDS", 0.01)
+    answers = PrecomputedAnswers(str(tmp_path / "precalculadas.bin"), "ns")
+    lock_path = answers.path + ".lock"
+    other_worker_got_lock = []
+
+    async def rebuild():
+        os.utime(lock_path, (time.time() - 100, time.time() - 100))
+        await asyncio.sleep(0.05)
+        # Un bloqueo que se actualiza no parece abandonado a otro worker
+        other_worker_got_lock.append(precalculo._acquire_lock(lock_path, stale_seconds=50))
+        return 0
+
+    _run_refresher(answers, rebuild, checks=3, interval_seconds=0.1)
+    assert other_worker_got_lock == [False]
+
+
+def _namespace(model_name: str) -> str:
+    return hashlib.sha256(f"{model_name}\x1fpersona".encode("utf-8")).hexdigest()
+
+
+def _entry(question: str, answer: str, verdict: bool = True) -> tuple:
+    return make_cache_key(question, "modelo", "persona"), question, answer, verdict
+
+
+def test_store_lookup_namespace_and_reload(tmp_path):
+    path = str(tmp_path / "precalculadas.bin")
+    namespace = _namespace("modelo")
+    long_answer = "Mithrandir, uno de los Istari. " * 50  # se guarda comprimida
+    write_store(path, namespace, [
+        _entry("¿Quién es Gandalf?", long_answer),
+        _entry("Hola", "¡Saludos!", verdict=False),
+    ])
+
+    answers = PrecomputedAnswers(path, namespace)
+    assert answers.load()
+    assert not answers.needs_refresh(0)
+    # La clave de caché normaliza mayúsculas, acentos y puntuación
+    assert answers.get(make_cache_key("quien es gandalf", "modelo", "persona")) == {
+        "response": long_answer, "is_tolkien_related": True}
+    assert answers.get(make_cache_key("¡Hola!", "modelo", "persona"))["is_tolkien_related"] is False
+    assert answers.get(make_cache_key("¿Quién es Frodo?", "modelo", "persona")) is None
+    assert answers.stats["hits"] == 2 and answers.stats["misses"] == 1
+
+    # Otro modelo o prompt: sin aciertos, hay que regenerar y se conservan las preguntas
+    other = PrecomputedAnswers(path, _namespace("otro-modelo"))
+    assert not other.load()
+    assert other.get(make_cache_key("¿Quién es Gandalf?", "modelo", "persona")) is None
+    assert other.needs_refresh(0)
+    assert sorted(other.questions()) == ["Hola", "¿Quién es Gandalf?"]
+
+    # Otro proceso reescribe el fichero: se recarga al detectarlo
+    write_store(path, namespace, [_entry("¿Quién es Frodo?", "Un hobbit de la Comarca.")])
+    assert answers.load()
+    assert answers.stats["reloads"] == 1
+    assert answers.get(make_cache_key("¿Quién es Frodo?", "modelo", "persona"))["response"] == "Un hobbit de la Comarca."
+    assert answers.get(make_cache_key("¿Quién es Gandalf?", "modelo", "persona")) is None
@@ -0,0 +1,112 @@
+"""Compactación del historial y almacenes de sesiones."""
+import asyncio
+import threading
+import time
+
+from sesiones import (
+    MemorySessionStore,
+    SQLiteSessionStore,
+    append_turn,
+    history_tokens,
+    is_summary_turn,
+)
+
+
+def test_compaction_keeps_recent_turns_and_summarizes_earlier_questions():
+    history = []
+    for i in range(12):
+        history = append_turn(history, f"Pregunta {i} sobre Gondor", "Respuesta " * 40, token_budget=400, max_turns=20)
+
+    assert history_tokens(history) <= 400
+    assert is_summary_turn(history[0])
+    assert history[-2]["parts"][0] == "Pregunta 11 sobre Gondor"
+    # Las preguntas de compactaciones anteriores siguen en el resumen
+    summary = history[0]["parts"][0]
+    assert "- Pregunta 0 sobre Gondor" in summary
+    for i in range(12):
+        if not any(turn["parts"][0] == f"Pregunta {i} sobre Gondor" for turn in history[2:]):
+            assert f"- Pregunta {i} sobre Gondor" in summary
+
+
+def test_compaction_respects_max_turns():
+    history = []
+    for i in range(10):
+        history = append_turn(history, f"P{i}", f"R{i}", token_budget=4000, max_turns=6)
+    assert len(history) <= 6
+    assert history[-1]["parts"][0] == "R9"
+
+
+def test_a_single_oversized_pair_is_truncated():
+    history = []
+    for _ in range(3):
+        history = append_turn(history, "¿" + "q" * 40000, "a" * 40000, token_budget=2000, max_turns=20)
+    assert history_tokens(history) <= 2000
+    assert history[-1]["parts"][0].endswith("[…]")
+
+    first = append_turn([], "q" * 40000, "a" * 40000, token_budget=2000, max_turns=20)
+    assert len(first) == 2
+    assert history_tokens(first) <= 2000
+
+
+def test_memory_store_evicts_idle_and_over_capacity_sessions():
+    store = MemorySessionStore(retention_seconds=0.05, max_sessions=2)
+
+    async def scenario():
+        await store.save("a", [{"role": "user", "parts": ["hola"]}])
+        time.sleep(0.1)
+        idle = await store.load("a")
+        for session_id in ("b", "c", "d"):
+            await store.save(session_id, [])
+        return idle
+
+    assert asyncio.run(scenario()) == []
+    stats = asyncio.run(store.get_stats())
+    assert stats["evicted_idle"] == 1
+    assert stats["evicted_capacity"] == 1
+    assert stats["sessions"] == 2
+
+
+def test_memory_store_purges_expired_sessions():
+    store = MemorySessionStore(retention_seconds=0.05)
+
+    async def scenario():
+        await store.save("viejo", [])
+        time.sleep(0.1)
+        await store.save("nuevo", [])
+        return await store.purge_expired()
+
+    assert asyncio.run(scenario()) == 1
+    assert asyncio.run(store.load("nuevo")) == []
+    assert asyncio.run(store.get_stats())["sessions"] == 1
+
+
+def test_sqlite_store_round_trip_and_purge(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sesiones.sqlite3"), retention_seconds=3600)
+    history = append_turn([], "¿Quién es Éowyn?", "La sobrina de Théoden.", token_budget=4000, max_turns=20)
+
+    async def scenario():
+        await store.save("s1", history)
+        loaded = await store.load("s1")
+        store.retention_seconds = 0
+        time.sleep(0.01)
+        expired = await store.purge_expired()
+        return loaded, expired, await store.load("s1")
+
+    loaded, expired, after = asyncio.run(scenario())
+    assert loaded == history
+    assert expired == 1
+    assert after == []
+
+
+def test_sqlite_store_reuses_one_connection_per_thread(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sesiones.sqlite3"))
+    store._save("s1", [])
+    connection = store._connect()
+    store._load("s1")
+    assert store._connect() is connection
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(store._connect()))
+    thread.start()
+    thread.join()
+    assert other[0] is not connection
@@ -0,0 +1,50 @@
+"""
+/chat/stream, el canal WebSocket y el asistente de consola usan la misma tubería
+(nucleo.answer_events): lo que responde uno lo reutilizan los demás, y los
+errores previos al streaming se traducen al código HTTP correspondiente.
+"""
+import json
+
+import nucleo
+from asistente_conversacion import answer_question
+
+QUESTION = "¿Qué opinas de la poesía épica medieval?"
+
+
+def _sse_events(body: str) -> list:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_console_reuses_answer_streamed_by_web(run_app, fake_model):
+    async def scenario(client):
+        response = await client.post("/chat/stream", json={"message": QUESTION})
+        console = await answer_question(QUESTION, [])
+        return response, console
+
+    response, (answer, verdict, source, _first_chunk_seconds) = run_app(
+        scenario, latency="fixed:0.05", classification_latency="fixed:0.01"
+    )
+    events = _sse_events(response.text)
+    streamed = "".join(data["text"] for kind, data in events if kind == "chunk")
+    assert events[-1][0] == "done"
+    assert source == "cache"
+    assert answer == streamed
+    assert verdict == events[-1][1]["ask_for_download"]
+    # Una sola generación: la consola la sirvió desde la caché
+    stats = fake_model().stats
+    assert stats["calls"] - stats["classification_calls"] == 1
+
+
+def test_stream_answers_503_before_starting_when_model_unavailable(run_app, monkeypatch):
+    async def scenario(client):
+        monkeypatch.setattr(nucleo, "model_router", None)
+        return await client.post("/chat/stream", json={"message": QUESTION})
+
+    response = run_app(scenario)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+